@@ -38,7 +38,7 @@ function Dashboard() {
             setUsername(response.data.userData.username);
             setEmail(response.data.userData.email);
             setImgUrl(
-              `/api/profile-picture/${response.data.userData.username}`
+              `${response.data.userData.profilePictureUrl}&size=128`
             );
           }
         }
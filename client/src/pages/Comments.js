@@ -5,6 +5,9 @@ import axios from "axios";
 import { FiTrash2 } from "react-icons/fi";
 import ClipLoader from "react-spinners/ClipLoader";
 
+// Number of comments that are requested from the backend at a time.
+const PAGE_SIZE = 20;
+
 function Comments() {
   const [loggedIn, setLoggedIn] = useState(true);
   const [notFound, setNotFound] = useState(false);
@@ -15,12 +18,21 @@ function Comments() {
   const [podcastOwnerUsername, setPodcastOwnerUsername] = useState("");
   const [currentUserUsername, setCurrentUserUsername] = useState("");
   const [comments, setComments] = useState([{}]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   const { podcastId } = useParams();
 
-  useEffect(() => {
+  // Loads the newest comments, or the comments after 'before' when it is given.
+  const loadComments = (before) => {
+    const params = { limit: PAGE_SIZE };
+    if (before) {
+      params.before = before;
+    }
+    setLoadingMore(true);
     axios
       .get(`/api/comments/${podcastId}`, {
+        params,
         headers: {
           "x-access-token": localStorage.getItem("token"),
         },
@@ -36,15 +48,39 @@ function Comments() {
             setPodcastTitle(response.data.podcastTitle);
             setPodcastOwnerUsername(response.data.podcastOwnerUsername);
             setCurrentUserUsername(response.data.currentUserUsername);
-            setComments(response.data.comments);
+            if (before) {
+              setComments((comments) => [...comments, ...response.data.comments]);
+            } else {
+              setComments(response.data.comments);
+            }
+            setNextCursor(response.data.nextCursor);
           } else {
             setNotFound(true);
           }
         }
+        setLoadingMore(false);
       });
+  };
+
+  useEffect(() => {
+    loadComments(null);
     setLoading(false);
   }, [podcastId]);
 
+  // Load the next page once the user scrolls near the bottom of the page.
+  useEffect(() => {
+    const handleScroll = () => {
+      const nearBottom =
+        window.innerHeight + window.scrollY >=
+        document.body.offsetHeight - 500;
+      if (nearBottom && nextCursor && !loadingMore) {
+        loadComments(nextCursor);
+      }
+    };
+    window.addEventListener("scroll", handleScroll);
+    return () => window.removeEventListener("scroll", handleScroll);
+  }, [nextCursor, loadingMore]);
+
   const deleteComment = (id) => {
     axios
       .post(`/api/delete-comment/${id}`, id, {
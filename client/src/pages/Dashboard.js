@@ -244,7 +244,7 @@ function Dashboard() {
                             />
                           )}
                           <ReactAudioPlayer
-                            src={"/api/return-podcast/" + podcast.podcast_id}
+                            src={podcast.audioUrl}
                             controls
                             controlsList={"nodownload"}
                           />
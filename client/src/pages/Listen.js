@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from "react";
+import React, { useState, useEffect, useRef } from "react";
 import { Redirect, Link } from "react-router-dom";
 import { LoggedInNavbar } from "../components/Navbar";
 import axios from "axios";
@@ -6,31 +6,92 @@ import { AiOutlineHeart, AiFillHeart, AiOutlineComment } from "react-icons/ai";
 import ClipLoader from "react-spinners/ClipLoader";
 import ReactAudioPlayer from "react-audio-player";
 
+// Number of podcasts that are requested from the backend at a time.
+const PAGE_SIZE = 20;
+// Time to wait after the user stops typing before searching.
+const SEARCH_DELAY = 300;
+
 function Listen() {
   const [loggedIn, setLoggedIn] = useState(true);
   const [podcasts, setPodcasts] = useState([{}]);
   const [loading, setLoading] = useState(true);
   const [notFound, setNotFound] = useState(false);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [searchQuery, setSearchQuery] = useState("");
+  // Either "newest" or "trending".
+  const [sort, setSort] = useState("newest");
+  // The search that the most recent request was made for. Responses for older searches are ignored.
+  const activeQuery = useRef("");
+  const activeSort = useRef("newest");
 
-  useEffect(() => {
+  // Podcasts are searched when there is a search query, otherwise every podcast is listed.
+  const loadPodcasts = (cursor, query, sort) => {
+    const params = { limit: PAGE_SIZE };
+    if (cursor) {
+      params.cursor = cursor;
+    }
+    if (query) {
+      params.q = query;
+    } else {
+      params.sort = sort;
+    }
+    activeQuery.current = query;
+    activeSort.current = sort;
+    setLoadingMore(true);
     axios
-      .get("/api/listen", {
+      .get(query ? "/api/search" : "/api/listen", {
+        params,
         headers: {
           "x-access-token": localStorage.getItem("token"),
         },
       })
       .then((response) => {
+        if (activeQuery.current !== query || activeSort.current !== sort) {
+          return;
+        }
         if (response.data.message !== "Verification successful.") {
           setLoggedIn(false);
           localStorage.removeItem("token");
         }
 
         if (response.data.message === "Verification successful.") {
-          setPodcasts(response.data.podcasts);
+          if (cursor) {
+            setPodcasts((podcasts) => [...podcasts, ...response.data.podcasts]);
+          } else {
+            setPodcasts(response.data.podcasts);
+          }
+          setNextCursor(response.data.nextCursor);
         }
+        setLoadingMore(false);
       });
-    setLoading(false);
-  }, []);
+  };
+
+  useEffect(() => {
+    const query = searchQuery.trim();
+    const timeout = setTimeout(
+      () => {
+        loadPodcasts(null, query, sort);
+        setLoading(false);
+      },
+      query ? SEARCH_DELAY : 0
+    );
+    return () => clearTimeout(timeout);
+  }, [searchQuery, sort]);
+
+  // Load the next page once the user scrolls near the bottom of the page.
+  useEffect(() => {
+    const handleScroll = () => {
+      const nearBottom =
+        window.innerHeight + window.scrollY >=
+        document.body.offsetHeight - 500;
+      if (nearBottom && nextCursor && !loadingMore) {
+        loadPodcasts(nextCursor, activeQuery.current, activeSort.current);
+      }
+    };
+    window.addEventListener("scroll", handleScroll);
+    return () => window.removeEventListener("scroll", handleScroll);
+  }, [nextCursor, loadingMore]);
 
   if (!localStorage.getItem("token") || !loggedIn) {
     return <Redirect to="/login" />;
@@ -120,6 +181,23 @@ function Listen() {
           <div className="flex flex-col">
             <div className="mb-8 flex flex-col">
               <h1 className="text-2xl mb-2 tracking-widest">Listen.</h1>
+              <input
+                type="search"
+                value={searchQuery}
+                onChange={(e) => setSearchQuery(e.target.value)}
+                placeholder="Search podcasts"
+                className="md:w-1/2 w-full p-4 border-b-2 focus:border-gray-100 outline-none tracking-wide"
+              />
+              {!searchQuery.trim() && (
+                <select
+                  value={sort}
+                  onChange={(e) => setSort(e.target.value)}
+                  className="md:w-1/4 w-full mt-4 p-2 border-b-2 outline-none tracking-wide bg-white"
+                >
+                  <option value="newest">Newest</option>
+                  <option value="trending">Trending</option>
+                </select>
+              )}
             </div>
             <div>
               <div className="md:flex md:justify-center">
@@ -197,7 +275,7 @@ function Listen() {
                               />
                             )}
                             <ReactAudioPlayer
-                              src={"/api/return-podcast/" + podcast.podcast_id}
+                              src={podcast.audioUrl}
                               controls
                               controlsList={"nodownload"}
                             />
@@ -213,7 +291,11 @@ function Listen() {
                       </div>
                     ))
                   ) : (
-                    <p>No podcasts yet. Be the first to upload!</p>
+                    <p>
+                      {searchQuery.trim()
+                        ? "No podcasts match your search."
+                        : "No podcasts yet. Be the first to upload!"}
+                    </p>
                   )
                 ) : (
                   <p>Loading...</p>
@@ -3,6 +3,7 @@ import { Redirect } from "react-router-dom";
 import { LoggedInNavbar } from "../components/Navbar";
 import axios from "axios";
 import ClipLoader from "react-spinners/ClipLoader";
+import Sha256 from "../sha256";
 
 function UploadPodcast() {
   const [loggedIn, setLoggedIn] = useState(true);
@@ -11,6 +12,8 @@ function UploadPodcast() {
   const [podcastFile, setPodcastFile] = useState(null);
   const [podcastUploaded, setPodcastUploaded] = useState(false);
   const [loading, setLoading] = useState(true);
+  const [uploading, setUploading] = useState(false);
+  const [errorMessage, setErrorMessage] = useState("");
 
   useEffect(() => {
     axios
@@ -32,32 +35,130 @@ function UploadPodcast() {
     return <Redirect to="/login" />;
   }
 
-  const uploadPodcast = (event) => {
-    event.preventDefault();
+  const handleResponse = (response) => {
+    if (response.data.message !== "Verification successful.") {
+      setLoggedIn(false);
+      localStorage.removeItem("token");
+      const error = new Error(response.data.message);
+      error.loggedOut = true;
+      throw error;
+    }
+    return response.data;
+  };
 
-    const data = new FormData();
-    data.append("podcastFile", podcastFile);
-    data.append("podcastTitle", podcastTitle);
-    data.append("podcastDescription", podcastDescription);
+  /*
+  The podcast file is uploaded in chunks. If a chunk fails, the upload asks the
+  backend where it left off and continues from there instead of starting over.
+  The checksum of the file is worked out one chunk at a time as the chunks are
+  read, so the whole file is never loaded into memory. A chunk that is sent
+  again after a failure has already been hashed, so it is not hashed twice.
 
-    axios
-      .post("/api/upload-podcast", data, {
-        headers: {
-          "x-access-token": localStorage.getItem("token"),
+  Anything that stops the upload (the upload could not be started, a chunk still
+  fails after five retries, the upload no longer exists or the checksum does not
+  match) throws an error, which is shown above the form.
+  */
+  const uploadFailed = (message) =>
+    new Error(message || "The podcast could not be uploaded. Please try again.");
+
+  const uploadOffset = (data) => {
+    if (!data.uploadExists) {
+      throw uploadFailed("The upload has expired. Please try again.");
+    }
+    return data.offset;
+  };
+
+  const sendPodcastFile = async () => {
+    const headers = { "x-access-token": localStorage.getItem("token") };
+
+    const init = handleResponse(
+      await axios.post(
+        "/api/upload-podcast/init",
+        {
+          data: {
+            podcastTitle,
+            podcastDescription,
+            filename: podcastFile.name,
+            fileSize: podcastFile.size,
+          },
         },
-      })
-      .then((response) => {
-        if (response.data.message !== "Verification successful.") {
-          setLoggedIn(false);
-          localStorage.removeItem("token");
-        }
+        { headers }
+      )
+    );
+    if (!init.uploadStarted) {
+      throw uploadFailed(init.error);
+    }
 
-        if (response.data.message === "Verification successful.") {
-          if (response.data.podcastUploaded) {
-            setPodcastUploaded(true);
+    const hash = new Sha256();
+    let hashedSize = 0;
+    let offset = init.offset;
+    let retries = 0;
+    while (offset < podcastFile.size) {
+      const chunk = new Uint8Array(
+        await podcastFile.slice(offset, offset + init.chunkSize).arrayBuffer()
+      );
+      if (offset === hashedSize) {
+        hash.update(chunk);
+        hashedSize += chunk.length;
+      }
+      try {
+        const data = handleResponse(
+          await axios.put(`/api/upload-podcast/${init.uploadId}`, chunk, {
+            params: { offset },
+            headers: { ...headers, "Content-Type": "application/octet-stream" },
+          })
+        );
+        offset = uploadOffset(data);
+        retries = 0;
+      } catch (error) {
+        if (error.loggedOut || !error.isAxiosError || retries >= 5) {
+          throw error;
+        }
+        retries += 1;
+        await new Promise((resolve) => setTimeout(resolve, 1000 * retries));
+        // If the backend cannot be reached either, the same chunk is sent again.
+        try {
+          const data = handleResponse(
+            await axios.get(`/api/upload-podcast/${init.uploadId}`, { headers })
+          );
+          offset = uploadOffset(data);
+        } catch (offsetError) {
+          if (offsetError.loggedOut || !offsetError.isAxiosError) {
+            throw offsetError;
           }
         }
-      });
+      }
+    }
+
+    const checksum = hash.hexDigest();
+    const data = handleResponse(
+      await axios.post(
+        `/api/upload-podcast/${init.uploadId}/finalize`,
+        { data: { checksum } },
+        { headers }
+      )
+    );
+    if (!data.podcastUploaded) {
+      throw uploadFailed(data.error);
+    }
+  };
+
+  const uploadPodcast = async (event) => {
+    event.preventDefault();
+    setErrorMessage("");
+    setUploading(true);
+    try {
+      await sendPodcastFile();
+      setPodcastUploaded(true);
+    } catch (error) {
+      if (!error.loggedOut) {
+        setErrorMessage(
+          error.isAxiosError
+            ? "The podcast could not be uploaded. Please try again."
+            : error.message
+        );
+      }
+      setUploading(false);
+    }
   };
 
   if (podcastUploaded) {
@@ -85,6 +186,7 @@ function UploadPodcast() {
           <div className="form w-full md:w-2/3">
             <div className="tracking-wider mb-10">
               <h1 className="md:text-3xl text-2xl mb-2">Upload Podcast</h1>
+              {errorMessage ? <span>{errorMessage}</span> : <></>}
             </div>
             <form onSubmit={uploadPodcast} encType="multipart/form-data">
               <input
@@ -126,8 +228,9 @@ function UploadPodcast() {
               <button
                 type="submit"
                 className="p-4 bg-red-500 text-white rounded-xl"
+                disabled={uploading}
               >
-                Upload Podcast
+                {uploading ? "Uploading..." : "Upload Podcast"}
               </button>
             </form>
           </div>
@@ -48,7 +48,7 @@ function User() {
             setUserFollowers(response.data.followers);
             setUserFollowing(response.data.following);
             setPodcasts(response.data.podcasts);
-            setImgUrl(`/api/profile-picture/${response.data.username}`);
+            setImgUrl(`${response.data.profilePictureUrl}&size=128`);
             setCurrentUserUsername(response.data.currentUserUsername);
             if (response.data.currentUserFollowingUser) {
               setFollowing(true);
@@ -323,7 +323,7 @@ function User() {
                             />
                           )}
                           <ReactAudioPlayer
-                            src={"/api/return-podcast/" + podcast.podcast_id}
+                            src={podcast.audioUrl}
                             controls
                             controlsList={"nodownload"}
                           />
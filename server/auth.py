@@ -0,0 +1,83 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from flask import request, jsonify, g
+from configs import app
+from models import User
+from cache import LRUCache
+from functools import wraps
+import jwt
+import os
+import time
+
+
+'''
+Decoded tokens are cached so that a token is only decoded once every
+'TOKEN_CACHE_TTL' seconds instead of on every request. An entry never outlives the
+token itself, so an expired token is never accepted from the cache.
+'''
+token_cache = LRUCache(maxsize=10000, ttl=app.config['TOKEN_CACHE_TTL'])
+
+
+# Auth verification
+def verify_authentication():
+    '''
+    The code below will first try to get the token that was
+    sent in the header from the frontend in order to retrieve user
+    details.
+
+    If something goes wrong, it will send an error message stating that.
+
+    If the token has been expired, then it will send an error message stating
+    that the token has expired.
+
+    If there is a decoding error, then it will state that there was a decoding error.
+
+    If the token does not have an 'id' and an 'exp' claim (for example the password reset
+    token, which is signed with the same key), it is not a login token, so it will send
+    'Something went wrong.'
+
+    If everything is fine, then it will return 'Verification successful', along with the
+    current user's public id in case any data needs to be retrieved. This information is sent through
+    a tuple making it easily accessible.
+    '''
+    token = request.headers.get('x-access-token')
+    if not token:
+        return "Something went wrong."
+    user_id = token_cache.get(token)
+    if user_id:
+        return ("Verification successful.", user_id)
+    try:
+        decoded_id = jwt.decode(token, os.environ.get(
+            'JWT_SECRET_KEY'), algorithms=['HS256'], options={'require': ['exp', 'id']})
+    except jwt.exceptions.ExpiredSignatureError:
+        return "This token has expired."
+    except jwt.exceptions.DecodeError:
+        return "Decoding error."
+    except jwt.exceptions.InvalidTokenError:
+        return "Something went wrong."
+    ttl = min(app.config['TOKEN_CACHE_TTL'],
+              decoded_id['exp'] - time.time())
+    if ttl > 0:
+        token_cache.set(token, decoded_id['id'], ttl=ttl)
+    return ("Verification successful.", decoded_id['id'])
+
+
+def token_required(route):
+    '''
+    Routes that require a user to be logged in are wrapped with this decorator. It will
+    verify the token, load the current user once and store them in 'g.current_user' so
+    that the route does not have to query for them again. If the token is not valid, the
+    same error messages as before are sent to the frontend and the route is not called.
+    '''
+    @wraps(route)
+    def decorated_route(*args, **kwargs):
+        response = verify_authentication()
+        if response[0] == "Verification successful.":
+            g.current_user = User.query.filter_by(
+                public_id=response[1]).first()
+            if g.current_user == None:
+                return jsonify({"message": "Something went wrong."})
+            return route(*args, **kwargs)
+        return jsonify({"message": response})
+    return decorated_route
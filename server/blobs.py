@@ -0,0 +1,138 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import db
+from models import Blob
+from jobs import job_handler, enqueue_job
+from storage import storage
+from sqlalchemy import text, bindparam
+import datetime
+import os
+import re
+
+
+'''
+Media files are stored by their contents instead of under a random name. Every distinct
+file that is uploaded (a podcast file or a profile picture) is a Blob, which is identified
+by the SHA-256 hash of its bytes, and its files are stored under that hash in the media
+storage (see storage.py). They are the uploaded file itself, which is called 'original',
+along with every file that is made from it, like the compressed rendition and HLS segments
+of a podcast or the sizes of a profile picture. If the same bytes are uploaded again, the existing blob is
+used, so identical files are only stored (and transcoded) once.
+
+The files of a blob are named after its contents, so the file at a given path never
+changes and can be cached forever (see the '/api/media' route).
+
+A blob's 'refcount' is the number of podcasts and users that use it. Podcasts and users
+add a reference with 'acquire_blob_with_files()' and give it back with 'release_blob()', in
+the same transaction as the change that creates or deletes them. Once the count drops to
+zero, a background job removes the blob and its files.
+'''
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def blob_key(sha256, filename):
+    '''The storage key of one of the files of a blob.'''
+    return f'{sha256}/{filename}'
+
+
+def acquire_blob(sha256, size):
+    '''
+    The code below will add a reference to the blob with the given hash, creating the blob
+    if it does not exist yet, and return it. Both are done by a single INSERT ... ON CONFLICT
+    statement, so two uploads of the same new file at the same time cannot create two blobs.
+
+    The statement also locks the blob's row until the caller commits, so the blob cannot be
+    removed by 'remove_blob()' in the meantime. New files are added to the blob with
+    'acquire_blob_with_files()', which puts them into storage before calling this.
+    '''
+    db.session.execute(text('''INSERT INTO blob (sha256, size, refcount, created_at)
+                               VALUES (:sha256, :size, 1, :created_at)
+                               ON CONFLICT (sha256) DO UPDATE SET refcount = blob.refcount + 1''').bindparams(
+        bindparam('created_at', type_=db.DateTime)),
+        {'sha256': sha256, 'size': size, 'created_at': datetime.datetime.utcnow()})
+    return Blob.query.filter_by(sha256=sha256).populate_existing().first()
+
+
+def acquire_blob_with_files(sha256, size, filename, put_files):
+    '''
+    The code below will add a reference to the blob with the given hash like 'acquire_blob()'
+    and make sure that the blob has its files. 'put_files()' puts the files of the blob into
+    storage from local copies that it keeps, and the blob has them once it has 'filename'.
+
+    The files are put into storage before the blob is acquired, since acquiring it starts a
+    write transaction that lasts until the caller commits, and uploading a large file to S3
+    while holding it would keep every other writer waiting. The transaction that the caller
+    has open is committed first for the same reason, so nothing should be changed before
+    this is called. The keys of the files are named after the contents of the blob, so
+    putting a file that is already there changes nothing. The blob may be removed by
+    'remove_blob()' between the two steps, so the files are put again if they are missing
+    once the blob has been acquired, which is rare. The caller commits.
+    '''
+    key = blob_key(sha256, filename)
+    db.session.commit()
+    if not storage.exists(key):
+        put_files()
+    blob = acquire_blob(sha256, size)
+    if not storage.exists(key):
+        put_files()
+    return blob
+
+
+def acquire_blob_with_file(sha256, size, filename, source_path):
+    '''Like 'acquire_blob_with_files()' for a single local file, which is removed afterwards.'''
+    try:
+        return acquire_blob_with_files(sha256, size, filename, lambda: storage.put(
+            blob_key(sha256, filename), source_path, keep_source=True))
+    finally:
+        os.remove(source_path)
+
+
+def release_blob(blob):
+    '''
+    The code below will take away one reference to a blob. If nothing uses the blob
+    anymore, it is queued to be removed. The caller commits.
+    '''
+    if blob == None:
+        return
+    Blob.query.filter_by(id=blob.id).update(
+        {Blob.refcount: Blob.refcount - 1}, synchronize_session=False)
+    refcount = db.session.query(Blob.refcount).filter_by(id=blob.id).scalar()
+    if refcount != None and refcount <= 0:
+        enqueue_job('remove_blob', blob_id=blob.id, sha256=blob.sha256)
+
+
+@job_handler('remove_blob')
+def remove_blob(blob_id, sha256):
+    '''
+    The code below will remove a blob and its files. The same file may have been uploaded
+    again since the job was queued, so the blob is only removed if its 'refcount' is still
+    zero. The row is deleted before the files so that an upload of the same file has to
+    wait until the files are gone, and then creates a new blob.
+    '''
+    deleted = Blob.query.filter_by(id=blob_id, refcount=0).delete(
+        synchronize_session=False)
+    if deleted:
+        storage.delete_tree(sha256)
+    db.session.commit()
+
+
+def remove_orphaned_blob(sha256):
+    '''
+    The code below will remove the files of a blob that has no row in the Blob table (see
+    cleanup.py) and return whether they were removed. An upload of the same file could
+    start using the files while they are being removed, so a row without references is
+    inserted for the blob first. Like in 'remove_blob()', this makes 'acquire_blob()' wait
+    until the files are gone. If the blob already has a row again, nothing is removed.
+    '''
+    inserted = db.session.execute(text('''INSERT INTO blob (sha256, size, refcount, created_at)
+                                          VALUES (:sha256, 0, 0, :created_at)
+                                          ON CONFLICT (sha256) DO NOTHING''').bindparams(
+        bindparam('created_at', type_=db.DateTime)),
+        {'sha256': sha256, 'created_at': datetime.datetime.utcnow()}).rowcount
+    if inserted:
+        storage.delete_tree(sha256)
+        Blob.query.filter_by(sha256=sha256, refcount=0).delete(
+            synchronize_session=False)
+    db.session.commit()
+    return bool(inserted)
@@ -0,0 +1,101 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import app
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    '''
+    A small thread-safe in-process cache. Once the cache holds 'maxsize' entries, the
+    least recently used entry is evicted to make room for a new one. If a 'ttl' (in
+    seconds) is given, entries also expire that long after they were set. A ttl can also
+    be passed to set() for entries that should expire sooner.
+
+    Entries can be given tags when they are set. 'invalidate()' will then remove every
+    entry with a given tag, so a write only has to know what it changed and not which
+    keys were built from it.
+
+    Every worker process has its own cache, so anything that is cached here should either
+    be safe to serve slightly out of date until it expires, or never change at all.
+    '''
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None:
+                return default
+            value, expires_at, tags = entry
+            if expires_at != None and expires_at <= time.monotonic():
+                self._remove(key)
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, tags=()):
+        ttl = ttl if ttl != None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl != None else None
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (value, expires_at, tuple(tags))
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self._remove(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def invalidate(self, *tags):
+        '''Remove every entry that was set with any of the given tags.'''
+        with self.lock:
+            for tag in tags:
+                for key in self.tags.pop(tag, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def _remove(self, key):
+        '''Remove an entry and its tags. The lock must already be held.'''
+        entry = self.entries.pop(key, None)
+        if entry == None:
+            return
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys != None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+
+'''
+The shared parts of podcast listings (the podcasts on a page of the Listen page and the
+podcasts and details on a page of a user's profile) are cached here. Anything that only
+depends on who is looking at the page, like whether they have liked a podcast, is added
+after the page is read from the cache.
+
+The entries are tagged with what they were built from so that every write can remove
+exactly the pages that it changed:
+'podcast:<id>' - every page that contains the podcast.
+'owner:<id>' - every page that contains a podcast owned by the user.
+'user:<id>' - every page of the user's profile.
+'listen:first' - the first page of the Listen page, which is where new podcasts appear.
+'listen:trending' - every page of the trending order of the Listen page, which changes
+whenever a podcast is uploaded or its likes or comments change.
+'listen' - every page of the Listen page.
+'''
+response_cache = LRUCache(maxsize=app.config['RESPONSE_CACHE_SIZE'],
+                          ttl=app.config['RESPONSE_CACHE_TTL'])
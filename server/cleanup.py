@@ -0,0 +1,258 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import app, db
+from models import Podcast, User, Upload, Blob, Job
+from blobs import SHA256_PATTERN, blob_key, remove_orphaned_blob
+from media import HLS_DIRECTORY
+from storage import storage
+from jobs import job_handler, enqueue_job, schedule_job
+from ingest import UPLOAD_PREFIX, upload_prefix, upload_part_key
+import datetime
+import itertools
+import os
+import shutil
+import time
+
+
+'''
+Files and rows are normally removed together, but a request that fails between saving a
+file and committing, a job that gives up or a file that is removed by hand leaves the media
+storage and the database out of step. The garbage collector finds:
+
+    files in storage that belong to a blob without a row in the Blob table
+    temporary files and chunks of chunked uploads that were left behind
+    podcasts, profile pictures and uploads whose files are missing
+    chunked uploads that were not finished within 'UPLOAD_EXPIRY' seconds
+
+It goes through the checks below ('PHASES') one batch of 'GC_BATCH_SIZE' files or rows at
+a time. Each batch reads one page of files from storage or one page of rows from the
+database and looks up the other side with a single query, so memory use does not grow with
+the number of files. The position in a phase is kept as a cursor (the last key prefix or row
+id), so the background job can stop after any batch and carry on from there.
+
+Orphaned files are removed when 'delete' is set and are reported otherwise. Rows with missing
+files are only reported, except for chunked uploads that can never be finished, since
+deleting a podcast or profile picture takes away something that a user made. Expired uploads
+are always deleted, since they are not a guess about what is left over but have simply run
+out of time.
+'''
+PHASES = ['blobs', 'temp', 'podcasts', 'users', 'uploads']
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+
+def grace_cutoff():
+    '''Files that were changed after this time (in seconds since the epoch) are left alone.'''
+    return time.time() - app.config['GC_GRACE_PERIOD']
+
+
+def check_blob_files(cursor, delete, report):
+    '''
+    The code below will look up the next batch of blobs in storage in the Blob table. A blob
+    without a row is removed with 'remove_orphaned_blob()', which checks again that it has no
+    row while it removes it. Prefixes that are not a SHA-256 hash are never removed, and the
+    chunks of chunked uploads are checked by 'check_temp_files()' instead.
+    '''
+    batch_size = app.config['GC_BATCH_SIZE']
+    prefixes = list(itertools.islice(storage.list_prefixes(cursor), batch_size))
+    names = [prefix for prefix, _ in prefixes]
+    known = {sha256 for (sha256,) in db.session.query(Blob.sha256).filter(
+        Blob.sha256.in_(names))} if names else set()
+    db.session.rollback()
+    cutoff = grace_cutoff()
+    for prefix, modified in prefixes:
+        if prefix in known or prefix == UPLOAD_PREFIX or modified > cutoff:
+            continue
+        if not SHA256_PATTERN.match(prefix):
+            report(f"'{prefix}' in storage is not a blob.")
+        elif not delete:
+            report(f"The files of blob {prefix} have no row.")
+        elif remove_orphaned_blob(prefix):
+            report(f"The files of blob {prefix} had no row and have been removed.")
+    return names[-1] if len(names) == batch_size else None
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def check_temp_files(cursor, delete, report):
+    '''
+    The code below will look for files in 'MEDIA_TEMP_DIRECTORY' that are older than the
+    grace period (uploads, transcodes and resized pictures that were never moved into storage)
+    and for chunks of chunked uploads in storage without an Upload row. The directory and the
+    chunks are only read one entry at a time, and the Upload rows are looked up one batch
+    of uploads at a time.
+    '''
+    cutoff = grace_cutoff()
+    temp_directory = app.config['MEDIA_TEMP_DIRECTORY']
+    if os.path.isdir(temp_directory):
+        with os.scandir(temp_directory) as entries:
+            for entry in entries:
+                if entry.stat().st_mtime > cutoff:
+                    continue
+                if delete:
+                    remove_path(entry.path)
+                    report(f"The temporary file '{entry.name}' has been removed.")
+                else:
+                    report(f"The temporary file '{entry.name}' was left behind.")
+
+    # The chunks are listed in order, so the chunks of each upload come one after another.
+    chunks = storage.list_keys(UPLOAD_PREFIX)
+    uploads = ((public_id, max(modified for _, modified in upload_chunks)) for public_id, upload_chunks in
+               itertools.groupby(chunks, key=lambda chunk: chunk[0].split('/')[1]))
+    for batch in batched(uploads, app.config['GC_BATCH_SIZE']):
+        public_ids = [public_id for public_id, _ in batch]
+        known = {public_id for (public_id,) in db.session.query(Upload.public_id).filter(
+            Upload.public_id.in_(public_ids))}
+        db.session.rollback()
+        for public_id, modified in batch:
+            if public_id in known or modified > cutoff:
+                continue
+            if delete:
+                storage.delete_tree(upload_prefix(public_id))
+                report(f"The chunks of upload {public_id} had no row and have been removed.")
+            else:
+                report(f"The chunks of upload {public_id} have no row.")
+    return None
+
+
+def check_podcasts(cursor, delete, report):
+    '''The code below will check that the next batch of podcasts have all of their files.'''
+    batch_size = app.config['GC_BATCH_SIZE']
+    rows = db.session.query(Podcast.id, Podcast.public_id, Blob.sha256, Podcast.compressed_file, Podcast.hls_ready).outerjoin(
+        Blob, Podcast.blob_id == Blob.id).filter(Podcast.id > (cursor or 0)).order_by(Podcast.id).limit(batch_size).all()
+    db.session.rollback()
+    for podcast_id, public_id, sha256, compressed_file, hls_ready in rows:
+        if sha256 == None:
+            report(f"Podcast {public_id} has no file.")
+            continue
+        keys = [blob_key(sha256, 'original')]
+        if compressed_file:
+            keys.append(blob_key(sha256, compressed_file))
+        if hls_ready:
+            keys.append(blob_key(sha256, f'{HLS_DIRECTORY}/master.m3u8'))
+        for key in keys:
+            if not storage.exists(key):
+                report(f"Podcast {public_id} is missing '{key}'.")
+    return rows[-1][0] if len(rows) == batch_size else None
+
+
+def check_users(cursor, delete, report):
+    '''The code below will check that the next batch of profile pictures have their main file.'''
+    batch_size = app.config['GC_BATCH_SIZE']
+    rows = db.session.query(User.id, User.username, User.profile_image).filter(
+        User.id > (cursor or 0)).order_by(User.id).limit(batch_size).all()
+    db.session.rollback()
+    for user_id, username, profile_image in rows:
+        if profile_image == 'default.png':
+            continue
+        sha256, extension = os.path.splitext(profile_image)
+        key = blob_key(sha256, 'picture' + extension)
+        if not storage.exists(key):
+            report(f"The profile picture of {username} is missing '{key}'.")
+    return rows[-1][0] if len(rows) == batch_size else None
+
+
+def check_uploads(cursor, delete, report):
+    '''
+    The code below will check the next batch of chunked uploads. An upload that was started
+    more than 'UPLOAD_EXPIRY' seconds ago has been abandoned, so it is deleted along with its
+    chunks. An upload that has received some bytes but not its first chunk can never be
+    finished, so it is deleted once it is older than the grace period. The rows are deleted
+    and committed before the chunks are removed, so chunks that are left behind by a crash
+    are removed by the 'temp' phase.
+    '''
+    batch_size = app.config['GC_BATCH_SIZE']
+    uploads = Upload.query.filter(Upload.id > (cursor or 0)).order_by(
+        Upload.id).limit(batch_size).all()
+    now = datetime.datetime.utcnow()
+    created_cutoff = now - datetime.timedelta(seconds=app.config['GC_GRACE_PERIOD'])
+    expiry_cutoff = now - datetime.timedelta(seconds=app.config['UPLOAD_EXPIRY'])
+    expired_public_ids = []
+    for upload in uploads:
+        if upload.created_at < expiry_cutoff:
+            db.session.delete(upload)
+            expired_public_ids.append(upload.public_id)
+            report(f"Upload {upload.public_id} has expired and has been deleted.")
+        elif upload.received_size == 0 or upload.created_at > created_cutoff:
+            continue
+        elif storage.exists(upload_part_key(upload.public_id, 0)):
+            continue
+        elif delete:
+            db.session.delete(upload)
+            report(f"Upload {upload.public_id} had no chunks and has been deleted.")
+        else:
+            report(f"Upload {upload.public_id} has no chunks.")
+    last_id = uploads[-1].id if len(uploads) == batch_size else None
+    db.session.commit()
+    for public_id in expired_public_ids:
+        storage.delete_tree(upload_prefix(public_id))
+    return last_id
+
+
+PHASE_CHECKS = {'blobs': check_blob_files, 'temp': check_temp_files, 'podcasts': check_podcasts,
+                'users': check_users, 'uploads': check_uploads}
+
+
+def collect_garbage_batch(phase, cursor, delete, report):
+    '''
+    Run one batch of a phase and return the phase and cursor to carry on from, or None
+    once every phase is done.
+    '''
+    cursor = PHASE_CHECKS[phase](cursor, delete, report)
+    if cursor != None:
+        return phase, cursor
+    if phase == PHASES[-1]:
+        return None
+    return PHASES[PHASES.index(phase) + 1], None
+
+
+def collect_garbage(delete, report):
+    '''Run every phase from start to finish in the current process.'''
+    position = (PHASES[0], None)
+    while position != None:
+        position = collect_garbage_batch(*position, delete, report)
+
+
+@job_handler('collect_garbage')
+def collect_garbage_job(phase, cursor):
+    '''
+    The code below will run one batch and queue the next one as a new job, so other jobs
+    that are due run in between. After the last phase the next run is scheduled
+    'GC_INTERVAL' seconds later.
+    '''
+    position = collect_garbage_batch(
+        phase, cursor, app.config['GC_DELETE_ORPHANS'], print)
+    if position != None:
+        enqueue_job('collect_garbage', phase=position[0], cursor=position[1])
+    elif app.config['GC_INTERVAL'] > 0:
+        run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=app.config['GC_INTERVAL'])
+        schedule_job('collect_garbage', run_at, phase=PHASES[0], cursor=None)
+    db.session.commit()
+
+
+def schedule_garbage_collection():
+    '''
+    Queue the garbage collection job unless it is already queued or running, since each run
+    schedules the next one. Returns whether it was queued. The caller commits.
+    '''
+    scheduled = Job.query.filter(Job.kind == 'collect_garbage',
+                                 Job.status.in_(['queued', 'running'])).first()
+    if scheduled != None:
+        return False
+    enqueue_job('collect_garbage', phase=PHASES[0], cursor=None)
+    return True
@@ -0,0 +1,108 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import app, db
+from models import Podcast, refresh_counters
+from media import transcode_podcast
+from migrations import upgrade_database
+from trending import recompute_trending_scores
+from jobs import run_job_workers, run_pending_jobs, enqueue_job
+from storage import storage
+from cleanup import collect_garbage, schedule_garbage_collection
+import click
+
+
+'''
+The commands in this file are maintenance tasks that are run with the Flask CLI,
+for example: FLASK_APP=wsgi.py flask repair-counters
+'''
+
+
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    '''
+    Create the database or apply any migrations that it is missing. This should be run
+    every time a new version of the app is deployed.
+    '''
+    upgrade_database()
+
+
+@app.cli.command("repair-counters")
+def repair_counters():
+    '''
+    Recompute the like, comment, follower and following counters and the trending scores
+    for every podcast and user from the Like, Comment and Follow tables.
+    '''
+    refresh_counters()
+    recompute_trending_scores()
+    db.session.commit()
+    print("Counters have been recomputed.")
+
+
+@app.cli.command("transcode-podcasts")
+def transcode_podcasts():
+    '''
+    Transcode every podcast that has not been transcoded yet, for example podcasts that
+    were uploaded before transcoding was added or podcasts whose transcode failed.
+    '''
+    podcast_ids = [podcast_id for (podcast_id,) in db.session.query(Podcast.id).filter(
+        Podcast.processing_status != 'ready')]
+    for podcast_id in podcast_ids:
+        transcode_podcast(podcast_id)
+    print(f"{len(podcast_ids)} podcasts have been processed.")
+
+
+@app.cli.command("shard-media")
+@click.option("--batch-size", default=1000, help="Number of directories to move in each job.")
+def shard_media(batch_size):
+    '''
+    Queue a background job that moves media files that were stored before the local
+    storage was sharded into the sharded layout, one batch at a time. The app keeps
+    serving the files while they are moved.
+    '''
+    if not storage.local:
+        print("Only the local storage backend is sharded.")
+        return
+    enqueue_job('shard_media', batch_size=batch_size)
+    db.session.commit()
+    print("The media files will be moved by the background jobs.")
+
+
+@app.cli.command("collect-garbage")
+@click.option("--delete", is_flag=True, help="Remove orphaned files instead of only reporting them.")
+@click.option("--schedule", is_flag=True, help="Run it every 'GC_INTERVAL' seconds as a background job instead.")
+def collect_garbage_command(delete, schedule):
+    '''
+    Report media files that nothing in the database refers to and rows whose files are
+    missing (see cleanup.py). With '--delete', the orphaned files are removed.
+    '''
+    if schedule:
+        if schedule_garbage_collection():
+            db.session.commit()
+            print("Garbage collection has been scheduled.")
+        else:
+            print("Garbage collection is already scheduled.")
+        return
+    problem_count = 0
+
+    def report(message):
+        nonlocal problem_count
+        problem_count += 1
+        print(message)
+
+    collect_garbage(delete, report)
+    print(f"{problem_count} problems were found.")
+
+
+@app.cli.command("run-jobs")
+@click.option("--processes", default=1, help="Number of worker processes.")
+@click.option("--once", is_flag=True, help="Run the jobs that are due and exit.")
+def run_jobs(processes, once):
+    '''
+    Run background jobs (emails, file removal and transcoding) in separate worker
+    processes. In production these are the only workers (see app.yaml).
+    '''
+    if once:
+        print(f"{run_pending_jobs()} jobs have been run.")
+        return
+    run_job_workers(processes)
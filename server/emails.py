@@ -0,0 +1,27 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import app
+from flask_mail import Mail, Message
+from jobs import job_handler, enqueue_job
+
+mail = Mail(app)
+
+
+'''
+Emails are sent by a background job so that a slow SMTP server never holds up a request.
+If the SMTP server cannot be reached, the job is tried again later.
+'''
+
+
+@job_handler('send_email')
+def send_email(subject, recipients, body):
+    email = Message(subject, recipients=recipients)
+    email.body = body
+    mail.send(email)
+
+
+def queue_email(subject, recipients, body):
+    '''Queue an email to be sent from 'MAIL_DEFAULT_SENDER'. The caller commits.'''
+    enqueue_job('send_email', subject=subject,
+                recipients=recipients, body=body)
@@ -0,0 +1,186 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from flask import Request, request, abort
+from configs import app
+from storage import storage
+import contextlib
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+'''
+By default, Werkzeug spools every uploaded file into a temporary file while the form is
+parsed and the route then copies that temporary file to its final location, so every
+upload is written to disk twice. The code in this file lets uploaded files be written
+into the directory that they will end up in while the request body is being parsed, so
+that saving the file afterwards is just a rename. The SHA-256 hash of the file is also
+computed while it is being written so that it never has to be read again.
+
+Each route can also have its own size limit. The limit is checked against the
+Content-Length of the request before any of the body is read.
+'''
+
+
+class HashingFile:
+    '''
+    A temporary file in the destination directory that hashes everything that is
+    written to it. If the file is closed without being saved with 'persist()', for
+    example because the request failed, the temporary file is removed.
+    '''
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.part')
+        self.file = os.fdopen(fd, 'w+b')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.persisted = False
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def persist(self, path):
+        '''Move the file to its final path without copying it.'''
+        self.file.close()
+        os.replace(self.path, path)
+        self.persisted = True
+
+    def close(self):
+        self.file.close()
+        if not self.persisted and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class IngestRequest(Request):
+    @property
+    def max_content_length(self):
+        '''
+        The size limit of a request is the limit in 'UPLOAD_LIMITS' for the route that is
+        being requested, or 'MAX_CONTENT_LENGTH' if the route does not have its own limit.
+        '''
+        endpoint = self.url_rule.endpoint if self.url_rule else None
+        return app.config['UPLOAD_LIMITS'].get(endpoint, app.config['MAX_CONTENT_LENGTH'])
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        '''
+        Files that are uploaded to a route in 'UPLOAD_DIRECTORIES' are written straight into
+        that route's directory. Every other route keeps Werkzeug's default behaviour.
+        '''
+        endpoint = self.url_rule.endpoint if self.url_rule else None
+        directory = app.config['UPLOAD_DIRECTORIES'].get(endpoint)
+        if directory:
+            return HashingFile(os.path.join(app.root_path, directory))
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
+def hash_file(path):
+    '''Returns the SHA-256 hash and the size of a file that is already on disk.'''
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(block)
+            size += len(block)
+    return sha256.hexdigest(), size
+
+
+def save_uploaded_file(file, directory):
+    '''
+    The code below will save an uploaded file into a temporary file in the given directory
+    and return the path of that file along with its SHA-256 hash and size. If the file was
+    written into the directory while the request was parsed, it was also hashed then, so it
+    is only closed. Otherwise it is copied there and hashed afterwards. The caller moves the
+    file to where it belongs or removes it.
+    '''
+    if isinstance(file.stream, HashingFile):
+        file.stream.persist(file.stream.path)
+        return file.stream.path, file.stream.hexdigest(), file.stream.size
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, suffix='.part')
+    os.close(fd)
+    file.save(path)
+    return (path, *hash_file(path))
+
+
+def save_request_body(directory):
+    '''
+    The code below will stream the raw body of the request into a temporary file in the given
+    directory and return the path and size of that file. If the client disconnects before the
+    whole body has been read, the file is removed and the error is raised.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            shutil.copyfileobj(request.stream, file, 64 * 1024)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, os.path.getsize(path)
+
+
+'''
+The chunks of a chunked upload (see the upload routes in routes.py) are kept in the media
+storage rather than on the disk of the instance that received them, so that the next chunk
+can be sent to any instance. Each chunk is its own file under 'uploads/<public id>', named
+after the offset that it starts at. The offset is zero padded so that the chunks are listed
+in order. Once every chunk has been received, 'join_upload_parts()' joins them back together.
+'''
+UPLOAD_PREFIX = 'uploads'
+
+
+def upload_prefix(public_id):
+    return f'{UPLOAD_PREFIX}/{public_id}'
+
+
+def upload_part_key(public_id, offset):
+    return f'{upload_prefix(public_id)}/{offset:012d}'
+
+
+def join_upload_parts(public_id, total_size):
+    '''
+    The code below will join the chunks of an upload into a temporary file in
+    'MEDIA_TEMP_DIRECTORY', hashing them as they are written, and return the path of the file
+    along with its SHA-256 hash and size. Each chunk starts where the one before it ended,
+    so the chunks are read one after another without listing them. The caller moves the file
+    to where it belongs or removes it.
+    '''
+    part_file = HashingFile(app.config['MEDIA_TEMP_DIRECTORY'])
+    try:
+        while part_file.size < total_size:
+            offset = part_file.size
+            with contextlib.closing(storage.open(upload_part_key(public_id, offset))) as chunk:
+                for block in iter(lambda: chunk.read(1024 * 1024), b''):
+                    part_file.write(block)
+            if part_file.size == offset:
+                raise ValueError(f"The chunk at offset {offset} of upload {public_id} is empty.")
+        part_file.persist(part_file.path)
+    finally:
+        part_file.close()
+    return part_file.path, part_file.hexdigest(), part_file.size
+
+
+app.request_class = IngestRequest
+
+
+@app.before_request
+def check_content_length():
+    '''
+    Werkzeug only checks the size limit when it parses form data, so requests with any
+    other kind of body (JSON or the raw chunks of a chunked upload) are checked here before
+    the route reads them.
+    '''
+    if request.content_length is not None and request.max_content_length is not None:
+        if request.content_length > request.max_content_length:
+            abort(413)
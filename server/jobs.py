@@ -0,0 +1,233 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import app, db
+from models import Job
+from sqlalchemy import or_, and_
+import datetime
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+
+'''
+Work that does not have to finish before a response is sent (sending emails, removing
+files and transcoding podcasts) or that runs on a schedule (cleaning up media files) is queued as a background job instead of being done on
+the request thread. Jobs are stored in the Job table, so they survive restarts and can be
+run by any process that uses the same database.
+
+A route queues a job with 'enqueue_job()' and then commits. The job is added to the same
+transaction as the change that it belongs to, so it only runs if that change is saved. Each
+kind of job is run by a function that is registered with the 'job_handler()' decorator and
+is called with the job's payload as keyword arguments. Handlers can be run more than once
+for the same job (for example if a worker stops halfway through), so they have to be safe
+to run again. A handler raises an error to have the job tried again later. A function that
+is registered with 'job_failure_handler()' is called with the same payload once a job of
+that kind has failed for the last time, so that it can record the failure.
+
+Handlers commit their own changes to the database. When a handler returns, 'run_job()'
+rolls back whatever it left uncommitted before deleting the job, so changes that a handler
+does not commit are lost even though the job is treated as done.
+
+Queuing a job only adds it to the Job table. Jobs are run by the worker processes that are
+started with 'flask run-jobs' (see app.yaml) and, if 'JOB_THREADS' is set, by that many
+threads in every web process. A worker claims a job by changing its status with an UPDATE
+that only succeeds if no other worker has changed it first, so each attempt of a job is
+only run by one worker.
+'''
+job_handlers = {}
+job_failure_handlers = {}
+
+
+def job_handler(kind):
+    '''
+    Register the decorated function as the function that runs jobs of the given kind. The
+    function has to commit its changes itself, since anything it leaves uncommitted is
+    rolled back once it returns.
+    '''
+    def register(function):
+        job_handlers[kind] = function
+        return function
+    return register
+
+
+def job_failure_handler(kind):
+    '''Register the decorated function as the function that is called when a job of the given kind fails.'''
+    def register(function):
+        job_failure_handlers[kind] = function
+        return function
+    return register
+
+
+def enqueue_job(kind, **payload):
+    '''
+    The code below will add a job to the session. The caller commits it along with the rest
+    of its changes. The payload has to be JSON serializable.
+    '''
+    db.session.add(Job(kind=kind, payload=json.dumps(payload)))
+
+
+def schedule_job(kind, run_at, **payload):
+    '''Like 'enqueue_job()', but the job is not run before 'run_at'. The caller commits.'''
+    db.session.add(Job(kind=kind, payload=json.dumps(payload), run_at=run_at))
+
+
+def claim_job():
+    '''
+    The code below will find a job that is due and mark it as running, then return it. A
+    job that has been running for longer than 'JOB_TIMEOUT' belongs to a worker that has
+    stopped, so it is claimed again. None is returned if there is nothing to do.
+
+    The candidates are read first without changing anything, so an idle worker only reads
+    from the database. Each candidate is then claimed with an UPDATE that checks that its
+    status and number of attempts are still the same as when it was read.
+    '''
+    now = datetime.datetime.utcnow()
+    stale_time = now - datetime.timedelta(seconds=app.config['JOB_TIMEOUT'])
+    candidates = db.session.query(Job.id, Job.status, Job.attempts).filter(or_(
+        and_(Job.status == 'queued', Job.run_at <= now),
+        and_(Job.status == 'running', Job.started_at < stale_time))).order_by(Job.run_at, Job.id).limit(10).all()
+    for job_id, status, attempts in candidates:
+        claimed = Job.query.filter_by(id=job_id, status=status, attempts=attempts).update(
+            {Job.status: 'running', Job.started_at: now, Job.attempts: attempts + 1}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return Job.query.filter_by(id=job_id).first()
+    db.session.rollback()
+    return None
+
+
+def retry_delay(attempts):
+    '''The delay before the next attempt doubles after every failed attempt.'''
+    delay = app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1)
+    return min(delay, app.config['JOB_MAX_RETRY_DELAY'])
+
+
+def run_job(job):
+    '''
+    The code below will run a claimed job. If it succeeds, anything the handler did not
+    commit is rolled back and the job is deleted. If it raises an error, it is queued again
+    after 'retry_delay()' seconds, or marked as failed once it has been tried
+    'JOB_MAX_ATTEMPTS' times, and then its failure handler is called. Returns whether the
+    job succeeded.
+    '''
+    job_id, kind, attempts, payload = job.id, job.kind, job.attempts, job.payload
+    try:
+        handler = job_handlers.get(kind)
+        if handler == None:
+            raise LookupError(f"There is no handler for jobs of kind '{kind}'.")
+        if attempts > app.config['JOB_MAX_ATTEMPTS']:
+            raise TimeoutError("The job did not finish in time.")
+        handler(**json.loads(payload))
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+        print(f"Job {job_id} ({kind}) failed on attempt {attempts}: {error}")
+        failed = attempts >= app.config['JOB_MAX_ATTEMPTS']
+        if failed:
+            changes = {Job.status: 'failed', Job.last_error: error}
+        else:
+            run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=retry_delay(attempts))
+            changes = {Job.status: 'queued',
+                       Job.run_at: run_at, Job.last_error: error}
+        Job.query.filter_by(id=job_id).update(
+            changes, synchronize_session=False)
+        db.session.commit()
+        if failed and kind in job_failure_handlers:
+            try:
+                job_failure_handlers[kind](**json.loads(payload))
+            except Exception:
+                db.session.rollback()
+                print(f"The failure handler of job {job_id} ({kind}) failed: {traceback.format_exc()}")
+        return False
+    db.session.rollback()
+    Job.query.filter_by(id=job_id).delete(synchronize_session=False)
+    db.session.commit()
+    return True
+
+
+def run_pending_jobs():
+    '''Run every job that is due, one after another, and return how many were run.'''
+    count = 0
+    job = claim_job()
+    while job != None:
+        run_job(job)
+        count += 1
+        job = claim_job()
+    return count
+
+
+def work_forever():
+    '''
+    The code below will keep running jobs as they become due, checking for new jobs every
+    'JOB_POLL_INTERVAL' seconds when there is nothing to do. An error while talking to the
+    database (for example if it is locked for too long) is printed and the loop carries on.
+    '''
+    with app.app_context():
+        while True:
+            try:
+                run_pending_jobs()
+            except Exception:
+                print(f"The job worker ran into an error: {traceback.format_exc()}")
+            db.session.remove()
+            time.sleep(app.config['JOB_POLL_INTERVAL'])
+
+
+'''
+The job threads of a web process are started by its first request, so importing the app
+(for example to run a Flask command that queues jobs) does not start them. The id of
+the process that started them is kept so that a process that is forked from it, like a
+Gunicorn worker, starts its own threads.
+'''
+job_threads_pid = None
+job_threads_lock = threading.Lock()
+
+
+def start_job_threads():
+    global job_threads_pid
+    if app.config['JOB_THREADS'] <= 0 or job_threads_pid == os.getpid():
+        return
+    with job_threads_lock:
+        if job_threads_pid == os.getpid():
+            return
+        for _ in range(app.config['JOB_THREADS']):
+            threading.Thread(target=work_forever, daemon=True).start()
+        job_threads_pid = os.getpid()
+
+
+@app.before_request
+def start_job_threads_before_request():
+    start_job_threads()
+
+
+def worker_process():
+    '''
+    Each worker process opens its own database connections, since connections that were
+    opened before the process was forked cannot be shared with it. The modules that
+    register job handlers are imported here because a process that is started with the
+    'spawn' method only imports this module.
+    '''
+    import media
+    import emails
+    import cleanup
+    db.engine.dispose()
+    work_forever()
+
+
+def run_job_workers(processes):
+    '''
+    The code below will run jobs in the given number of worker processes until they are
+    stopped. A single worker runs in the current process.
+    '''
+    if processes <= 1:
+        worker_process()
+        return
+    workers = [multiprocessing.Process(target=worker_process)
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
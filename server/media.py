@@ -0,0 +1,346 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import app, db
+from models import Podcast, Blob
+from cache import LRUCache, response_cache
+from jobs import job_handler, job_failure_handler, enqueue_job
+from blobs import blob_key, acquire_blob_with_files
+from storage import storage
+from PIL import Image, ImageOps
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+'''
+Uploaded podcast files are transcoded into a smaller rendition by a local ffmpeg
+binary. The transcoding runs as a background job so that the upload request can return
+as soon as the original file has been saved.
+'''
+
+
+'''
+The compressed rendition and the HLS segments are made from the podcast's original file,
+so they are stored in the same blob as the original and are shared by every podcast that
+uses it. Podcasts that use the same file are only transcoded once.
+'''
+COMPRESSED_FILENAME = 'compressed.m4a'
+HLS_DIRECTORY = 'hls'
+
+
+def make_temp_directory():
+    '''A new directory in 'MEDIA_TEMP_DIRECTORY' for files that are being created.'''
+    os.makedirs(app.config['MEDIA_TEMP_DIRECTORY'], exist_ok=True)
+    return tempfile.mkdtemp(dir=app.config['MEDIA_TEMP_DIRECTORY'], suffix='.part')
+
+
+def run_ffmpeg(command):
+    '''Run ffmpeg and raise an error if it fails or takes longer than 'TRANSCODE_TIMEOUT'.'''
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.PIPE, timeout=app.config['TRANSCODE_TIMEOUT'])
+
+
+def package_podcast_hls(ffmpeg, source_path):
+    '''
+    The code below will split a podcast into short AAC segments at every bitrate in
+    'HLS_BITRATES' and write a playlist for each bitrate along with a master playlist
+    that lists all of them. Players can then start after downloading a single segment
+    and switch to a lower bitrate on a slow connection.
+
+    Everything is written into a temporary directory, which is returned so that the caller
+    can move it into storage once ffmpeg has finished. A partially packaged podcast is
+    never served.
+    '''
+    bitrates = app.config['HLS_BITRATES']
+    temp_directory = make_temp_directory()
+
+    command = [ffmpeg, '-nostdin', '-y', '-loglevel', 'error', '-i', source_path, '-vn']
+    for _ in bitrates:
+        command += ['-map', '0:a']
+    command += ['-c:a', 'aac', '-ar', '44100']
+    for index, bitrate in enumerate(bitrates):
+        command += [f'-b:a:{index}', bitrate]
+    command += ['-f', 'hls', '-hls_time', str(app.config['HLS_SEGMENT_SECONDS']),
+                '-hls_playlist_type', 'vod',
+                '-hls_segment_filename', os.path.join(
+                    temp_directory, '%v', 'segment%05d.ts'),
+                '-master_pl_name', 'master.m3u8',
+                '-var_stream_map', ' '.join(f'a:{index},name:{bitrate}' for index, bitrate in enumerate(bitrates)),
+                os.path.join(temp_directory, '%v', 'index.m3u8')]
+    try:
+        run_ffmpeg(command)
+    except (subprocess.SubprocessError, OSError):
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        raise
+    return temp_directory
+
+
+@job_handler('transcode_podcast')
+def transcode_podcast(podcast_id):
+    '''
+    The code below will transcode the original podcast file into a loudness normalized
+    AAC file that is capped at 'TRANSCODE_BITRATE'. The output is first written to a
+    temporary file and then moved into storage so that a half-written file is never served.
+    If the storage is not local, the original file is downloaded for ffmpeg first.
+    If HLS is enabled, the podcast is then also packaged into segments by
+    'package_podcast_hls()'. If the podcast's blob already has a rendition (and segments),
+    because another podcast with the same file was transcoded before, they are used as is.
+
+    The podcast's 'processing_status' goes from 'pending' to 'processing' and then to
+    either 'ready' or 'failed'. Until the status is 'ready', the original file is served.
+
+    If ffmpeg exits with an error, the file cannot be transcoded, so the podcast is marked as
+    failed straight away. Any other error (ffmpeg timing out or the storage not being
+    reachable) is raised so that the job is tried again later, and the podcast stays
+    'processing' until it succeeds or 'transcode_podcast_failed()' marks it as failed.
+    '''
+    podcast = Podcast.query.filter_by(id=podcast_id).first()
+    if podcast == None or podcast.blob == None:
+        return
+    sha256 = podcast.blob.sha256
+    output_key = blob_key(sha256, COMPRESSED_FILENAME)
+    hls_key = blob_key(sha256, HLS_DIRECTORY)
+    has_output = storage.exists(output_key)
+    has_hls = storage.exists(f'{hls_key}/master.m3u8')
+    transcoded = has_output and (has_hls or not app.config['HLS_ENABLED'])
+    ffmpeg = shutil.which(app.config['FFMPEG_BINARY'])
+    if ffmpeg == None and not transcoded:
+        print("ffmpeg was not found, the podcast will not be transcoded.")
+        podcast.processing_status = 'failed'
+        db.session.commit()
+        return
+
+    podcast.processing_status = 'processing'
+    db.session.commit()
+
+    temp_directory = make_temp_directory()
+    temp_path = os.path.join(temp_directory, COMPRESSED_FILENAME)
+    try:
+        if not transcoded:
+            with storage.local_path(blob_key(sha256, 'original')) as source_path:
+                if not has_output:
+                    run_ffmpeg([ffmpeg, '-nostdin', '-y', '-loglevel', 'error', '-i', source_path, '-vn',
+                                '-af', 'loudnorm=I=-16:TP=-1.5:LRA=11', '-c:a', 'aac',
+                                '-b:a', app.config['TRANSCODE_BITRATE'], '-ar', '44100',
+                                '-movflags', '+faststart', '-f', 'mp4', temp_path])
+                    storage.put(output_key, temp_path)
+                if app.config['HLS_ENABLED'] and not has_hls:
+                    storage.put_directory(
+                        hls_key, package_podcast_hls(ffmpeg, source_path))
+    except subprocess.CalledProcessError as error:
+        print(f"Podcast {podcast_id} could not be transcoded: {error}")
+        transcode_podcast_failed(podcast_id)
+        return
+    finally:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+
+    '''
+    The podcast may have been deleted while it was being transcoded. If its blob was
+    removed along with it, the rendition and segments are removed too, otherwise the
+    podcast will start serving them.
+    '''
+    db.session.rollback()
+    podcast = Podcast.query.filter_by(id=podcast_id).first()
+    if podcast == None:
+        if Blob.query.filter_by(sha256=sha256).first() == None:
+            storage.delete_tree(sha256)
+        return
+    podcast.compressed_file = COMPRESSED_FILENAME
+    podcast.hls_ready = app.config['HLS_ENABLED']
+    podcast.processing_status = 'ready'
+    db.session.commit()
+    # The HLS playlist is listed with the podcast once it is ready.
+    response_cache.invalidate(f'podcast:{podcast_id}')
+
+
+@job_failure_handler('transcode_podcast')
+def transcode_podcast_failed(podcast_id):
+    '''Mark a podcast as failed once it cannot be transcoded. The original file is still served.'''
+    db.session.rollback()
+    Podcast.query.filter_by(id=podcast_id).update(
+        {Podcast.processing_status: 'failed'}, synchronize_session=False)
+    db.session.commit()
+
+
+def queue_podcast_transcode(podcast_id):
+    '''Queue a podcast to be transcoded in the background. The caller commits.'''
+    if app.config['TRANSCODE_ENABLED']:
+        enqueue_job('transcode_podcast', podcast_id=podcast_id)
+
+
+@job_handler('remove_files')
+def remove_files(paths):
+    '''
+    The code below will remove files and directories that are no longer needed. The paths
+    are relative to the server directory. Paths that have already been removed are
+    skipped, so the job can safely be run again if it fails halfway through.
+    '''
+    for path in paths:
+        full_path = os.path.normpath(os.path.join(app.root_path, path))
+        if os.path.commonpath([full_path, app.root_path]) != app.root_path:
+            raise ValueError(f"'{path}' is outside of the server directory.")
+        try:
+            if os.path.isdir(full_path):
+                shutil.rmtree(full_path)
+            else:
+                os.remove(full_path)
+        except FileNotFoundError:
+            pass
+
+
+def queue_file_removal(paths):
+    '''
+    Queue files to be removed in the background. The paths can be absolute or relative to
+    the server directory. The caller commits.
+    '''
+    paths = [os.path.relpath(path, app.root_path) for path in paths]
+    if paths:
+        enqueue_job('remove_files', paths=paths)
+
+
+@job_handler('remove_stored_files')
+def remove_stored_files(prefixes):
+    '''The code below will remove every file under each of the given prefixes in the media storage.'''
+    for prefix in prefixes:
+        storage.delete_tree(prefix)
+
+
+def queue_stored_file_removal(prefixes):
+    '''Queue the files under some prefixes in the media storage to be removed in the background. The caller commits.'''
+    if prefixes:
+        enqueue_job('remove_stored_files', prefixes=prefixes)
+
+
+'''
+Profile pictures are saved at every size in 'PROFILE_PICTURE_SIZES' and in both the
+WebP and JPEG formats so that each page can ask for the smallest image that it needs.
+The files are stored in the blob of the uploaded image, so users that upload the same
+image share them. The largest JPEG is the profile picture's main file, 'picture.jpg', and
+the other files are named after their size, for example '128.jpg' and '128.webp'. The
+User table stores the hash of the blob followed by the extension of the main file.
+'''
+PROFILE_PICTURE_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+
+
+def save_profile_picture(source_path, directory):
+    '''
+    The code below will decode the uploaded image once and save every size and format of
+    it into the given directory.
+
+    For JPEG images, draft() lets the decoder scale the image down while it decodes it, so
+    a large photo is never fully decoded just to be shrunk to 250 pixels. The sizes are
+    then made from largest to smallest, each one from the one before it.
+    '''
+    sizes = sorted(app.config['PROFILE_PICTURE_SIZES'], reverse=True)
+    image = Image.open(source_path)
+    if image.format == 'JPEG':
+        image.draft('RGB', (sizes[0], sizes[0]))
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    else:
+        image = image.convert('RGB')
+
+    for size in sizes:
+        image.thumbnail((size, size), Image.LANCZOS)
+        for extension, image_format in PROFILE_PICTURE_FORMATS.items():
+            if size == sizes[0] and extension == 'jpg':
+                filename = 'picture.jpg'
+            else:
+                filename = f'{size}.{extension}'
+            image.save(os.path.join(directory, filename),
+                       image_format, quality=app.config['PROFILE_PICTURE_QUALITY'])
+
+
+def saved_profile_picture_sizes(sha256):
+    '''
+    The files of the profile picture with the given hash that were saved at each size, in
+    the format of the 'profile_image_sizes' column.
+    '''
+    prefix = blob_key(sha256, '')
+    filenames = [key[len(prefix):] for key, _ in storage.list_keys(sha256)]
+    return ' '.join(sorted(filename for filename in filenames if not filename.startswith('picture.')))
+
+
+def store_profile_picture(source_path, sha256, size):
+    '''
+    The code below will add a reference to the blob of an uploaded profile picture and
+    return the values of 'profile_image' and 'profile_image_sizes' for it. If the same image
+    has been uploaded before, its saved sizes are used as they are. Otherwise the sizes are
+    saved into a temporary directory first, so an invalid image raises an error before
+    anything is changed, and are then put into the blob by 'acquire_blob_with_files()'.
+    Either way, the sizes that the blob has are listed once here. The caller commits.
+    '''
+    temp_directory = None
+
+    def put_sizes():
+        nonlocal temp_directory
+        if temp_directory == None:
+            temp_directory = make_temp_directory()
+            save_profile_picture(source_path, temp_directory)
+        storage.put_directory(sha256, temp_directory, keep_source=True)
+
+    try:
+        acquire_blob_with_files(sha256, size, 'picture.jpg', put_sizes)
+    finally:
+        if temp_directory:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+    return f'{sha256}.jpg', saved_profile_picture_sizes(sha256)
+
+
+def profile_picture_key(profile_image, profile_image_sizes, size, extension):
+    '''
+    The code below will return the storage key of the smallest saved size that is at least
+    as large as the requested size, in the requested format. Whether that size was saved
+    is looked up in 'profile_image_sizes' instead of in the storage. If it was not (for
+    pictures that were uploaded before the sizes were added), the main file is returned.
+    The default profile picture is not in storage, so None is returned for it.
+    '''
+    if profile_image == 'default.png':
+        return None
+    sizes = sorted(app.config['PROFILE_PICTURE_SIZES'])
+    sha256, main_extension = os.path.splitext(profile_image)
+    main_key = blob_key(sha256, 'picture' + main_extension)
+    size = next((saved_size for saved_size in sizes if saved_size >= size), sizes[-1])
+    if size == sizes[-1] and extension == 'jpg':
+        return main_key
+    filename = f'{size}.{extension}'
+    if filename in (profile_image_sizes or '').split():
+        return blob_key(sha256, filename)
+    return main_key
+
+
+def profile_picture_blob(profile_image):
+    '''The blob of a profile picture. The default profile picture does not have one.'''
+    if profile_image == 'default.png':
+        return None
+    return Blob.query.filter_by(sha256=os.path.splitext(profile_image)[0]).first()
+
+
+'''
+The ETag of the default profile picture is the SHA-256 hash of its contents. Hashing a file
+on every request would defeat the point, so the hash is cached for each version of each
+file (its name, modification time and size). Pictures in storage use their key instead,
+which already has the hash of the uploaded image in it.
+'''
+profile_picture_etags = LRUCache(maxsize=10000)
+
+
+def profile_picture_etag(file_path):
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size)
+    etag = profile_picture_etags.get(key)
+    if etag == None:
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(64 * 1024), b''):
+                sha256.update(block)
+        etag = sha256.hexdigest()
+        profile_picture_etags.set(key, etag)
+    return etag
@@ -0,0 +1,404 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import app, db
+from models import User, Podcast, Upload, TimelineEntry, Job, Blob, refresh_counters, create_podcast_search
+from trending import recompute_trending_scores
+from blobs import blob_key, acquire_blob
+from storage import storage
+from ingest import hash_file, upload_part_key
+from media import saved_profile_picture_sizes
+from jobs import enqueue_job
+from sqlalchemy import inspect, text, String
+from sqlalchemy.orm import load_only
+import os
+
+
+'''
+db.create_all() only creates tables that do not exist yet, so it never adds new columns
+or indexes to a database that was created by an older version of the app. The code in
+this file upgrades an existing database instead.
+
+Every change to the schema is a numbered migration in the 'MIGRATIONS' list below and the
+number of the last migration that has been applied is stored in the 'schema_version'
+table. 'upgrade_database()' applies every migration with a higher number in order. A
+brand new database is created by db.create_all() and starts at the latest version.
+
+SQLite runs most schema changes outside of a transaction, so every step of a migration
+first checks whether it has already been done. If a migration fails halfway through, it
+can simply be run again.
+
+To change the schema, change the models and add a migration to the end of the list that
+makes the same change to an existing database. The 'database.db' file in the repository
+is left at the schema it was first committed with and is brought up to date by
+'flask upgrade-db' like any other existing database, so it is not committed again after a
+schema change.
+'''
+
+
+def column_exists(table, column):
+    columns = inspect(db.session.connection()).get_columns(table)
+    return column in [existing_column['name'] for existing_column in columns]
+
+
+def add_column(table, column, definition):
+    '''Add a column to a table unless the table already has it.'''
+    if not column_exists(table, column):
+        db.session.execute(
+            text(f'ALTER TABLE "{table}" ADD COLUMN {column} {definition}'))
+
+
+def create_index(name, table, columns, unique=False):
+    '''Create an index unless an index with the same name already exists.'''
+    unique = 'UNIQUE ' if unique else ''
+    db.session.execute(text(
+        f'CREATE {unique}INDEX IF NOT EXISTS {name} ON "{table}" ({", ".join(columns)})'))
+
+
+def add_counter_and_media_columns():
+    '''
+    The podcast and user counters, the podcast creation time that listings are paginated
+    by, the transcoding columns and the Upload table. Podcasts that were uploaded before
+    'created_at' existed are all given the same creation time, so they are listed after
+    every newer podcast. Their 'processing_status' starts as 'pending' so that the
+    'transcode-podcasts' command will transcode them.
+    '''
+    add_column('user', 'followers_count', "INTEGER DEFAULT '0' NOT NULL")
+    add_column('user', 'following_count', "INTEGER DEFAULT '0' NOT NULL")
+    add_column('podcast', 'created_at',
+               "DATETIME DEFAULT '1970-01-01 00:00:00.000000' NOT NULL")
+    add_column('podcast', 'like_count', "INTEGER DEFAULT '0' NOT NULL")
+    add_column('podcast', 'comment_count', "INTEGER DEFAULT '0' NOT NULL")
+    add_column('podcast', 'processing_status',
+               "VARCHAR(10) DEFAULT 'pending' NOT NULL")
+    add_column('podcast', 'compressed_file', "VARCHAR(45)")
+    add_column('podcast', 'hls_ready', "BOOLEAN DEFAULT '0' NOT NULL")
+    create_index('ix_podcast_created_at_id', 'podcast', ['created_at', 'id'])
+    Upload.__table__.create(db.session.connection(), checkfirst=True)
+    refresh_counters()
+
+
+def add_indexes_and_unique_constraints():
+    '''
+    Indexes on the foreign keys that are used for lookups and a unique index on each of
+    (liker_id, podcast_id) and (follower_id, followee_id). Any duplicate likes or follows
+    that were created before the unique indexes existed are removed first (the one with
+    the lowest id is kept) and the counters are recomputed afterwards.
+    '''
+    db.session.execute(text(
+        'DELETE FROM "like" WHERE id NOT IN (SELECT MIN(id) FROM "like" GROUP BY liker_id, podcast_id)'))
+    db.session.execute(text(
+        'DELETE FROM follow WHERE id NOT IN (SELECT MIN(id) FROM follow GROUP BY follower_id, followee_id)'))
+    create_index('uq_like_liker_id_podcast_id', 'like',
+                 ['liker_id', 'podcast_id'], unique=True)
+    create_index('ix_like_podcast_id', 'like', ['podcast_id'])
+    create_index('uq_follow_follower_id_followee_id', 'follow',
+                 ['follower_id', 'followee_id'], unique=True)
+    create_index('ix_follow_followee_id', 'follow', ['followee_id'])
+    create_index('ix_comment_commenter_id', 'comment', ['commenter_id'])
+    create_index('ix_comment_podcast_id', 'comment', ['podcast_id'])
+    create_index('ix_podcast_owner_id', 'podcast', ['owner_id'])
+    create_index('ix_upload_owner_id', 'upload', ['owner_id'])
+    refresh_counters()
+
+
+'''
+The statements that copy each table into its rebuilt version for
+'use_integer_primary_keys()', in the order that they have to run in. The old string id
+of each user, podcast, comment and upload becomes its public id, so existing URLs and
+login tokens keep working, and the foreign keys are translated into the new integer ids
+by joining on the public ids.
+'''
+INTEGER_KEY_COPIES = [
+    ('user', '''INSERT INTO "user" (public_id, first_name, last_name, username, email, password, deactivated,
+                profile_image, followers_count, following_count)
+                SELECT id, first_name, last_name, username, email, password, deactivated,
+                profile_image, followers_count, following_count FROM user_old ORDER BY rowid'''),
+    ('podcast', '''INSERT INTO podcast (public_id, owner_id, podcast_title, podcast_description, podcast_file, created_at,
+                   like_count, comment_count, processing_status, compressed_file, hls_ready)
+                   SELECT p.id, u.id, p.podcast_title, p.podcast_description, p.podcast_file, p.created_at,
+                   p.like_count, p.comment_count, p.processing_status, p.compressed_file, p.hls_ready
+                   FROM podcast_old p JOIN "user" u ON u.public_id = p.owner_id ORDER BY p.created_at, p.id'''),
+    ('like', '''INSERT INTO "like" (podcast_id, liker_id)
+                SELECT p.id, u.id FROM like_old l JOIN podcast p ON p.public_id = l.podcast_id
+                JOIN "user" u ON u.public_id = l.liker_id ORDER BY l.rowid'''),
+    ('comment', '''INSERT INTO comment (public_id, comment, commenter_id, podcast_id)
+                   SELECT c.id, c.comment, u.id, p.id FROM comment_old c JOIN "user" u ON u.public_id = c.commenter_id
+                   JOIN podcast p ON p.public_id = c.podcast_id ORDER BY c.rowid'''),
+    ('follow', '''INSERT INTO follow (follower_id, followee_id)
+                  SELECT follower.id, followee.id FROM follow_old f JOIN "user" follower ON follower.public_id = f.follower_id
+                  JOIN "user" followee ON followee.public_id = f.followee_id ORDER BY f.rowid'''),
+    ('upload', '''INSERT INTO upload (public_id, owner_id, podcast_title, podcast_description, file_ext, total_size,
+                  received_size, created_at)
+                  SELECT up.id, u.id, up.podcast_title, up.podcast_description, up.file_ext, up.total_size,
+                  up.received_size, up.created_at FROM upload_old up JOIN "user" u ON u.public_id = up.owner_id'''),
+]
+
+
+def use_integer_primary_keys():
+    '''
+    Every table is rebuilt with an integer primary key and integer foreign keys. SQLite
+    cannot change the type of a column, so each table that still has a string id is renamed
+    to '<table>_old' (after its indexes are dropped, since index names have to be unique),
+    the new tables are created from the models, and the rows are copied across with the
+    statements above. Each old table is dropped right after it has been copied.
+
+    If this migration is interrupted, running it again picks up where it stopped. A table
+    is only renamed if it still has a string id and is only copied into if the new table
+    is still empty.
+    '''
+    connection = db.session.connection()
+    tables = inspect(connection).get_table_names()
+    '''
+    Renaming a table normally also changes the foreign keys of other tables to point at the
+    renamed table. The foreign keys should keep pointing at the table name, which will be
+    the new table, so the legacy behaviour is turned on while the tables are renamed.
+    '''
+    db.session.execute(text('PRAGMA legacy_alter_table = ON'))
+    for table, _ in INTEGER_KEY_COPIES:
+        if f'{table}_old' in tables or table not in tables:
+            continue
+        id_column = next(column for column in inspect(
+            connection).get_columns(table) if column['name'] == 'id')
+        if not isinstance(id_column['type'], String):
+            continue
+        for index in inspect(connection).get_indexes(table):
+            db.session.execute(text(f'DROP INDEX "{index["name"]}"'))
+        db.session.execute(
+            text(f'ALTER TABLE "{table}" RENAME TO "{table}_old"'))
+    db.session.execute(text('PRAGMA legacy_alter_table = OFF'))
+
+    db.metadata.create_all(connection)
+    tables = inspect(connection).get_table_names()
+    for table, copy_statement in INTEGER_KEY_COPIES:
+        if f'{table}_old' not in tables:
+            continue
+        if db.session.execute(text(f'SELECT COUNT(*) FROM "{table}"')).scalar() == 0:
+            db.session.execute(text(copy_statement))
+        db.session.execute(text(f'DROP TABLE "{table}_old"'))
+
+
+def add_podcast_search():
+    '''
+    The full-text search index of podcasts and the triggers that keep it up to date. The
+    index is filled with every existing podcast once, after which the triggers take over.
+    '''
+    create_podcast_search(db.session.connection())
+    db.session.execute(text('DELETE FROM podcast_search'))
+    db.session.execute(text('''INSERT INTO podcast_search (rowid, podcast_title, podcast_description, owner_username)
+                               SELECT p.id, p.podcast_title, p.podcast_description, u.username
+                               FROM podcast p JOIN "user" u ON u.id = p.owner_id'''))
+
+
+def add_timelines():
+    '''
+    The TimelineEntry table, which every existing podcast is copied into for each follower
+    of its owner, and the 'fan_out_on_read' flag, which is set for users that already have
+    more followers than 'FEED_FANOUT_LIMIT'. The index on the owner of each podcast is
+    replaced by one that also covers the creation time.
+    '''
+    add_column('user', 'fan_out_on_read', "BOOLEAN DEFAULT '0' NOT NULL")
+    db.session.execute(text('UPDATE "user" SET fan_out_on_read = 1 WHERE followers_count > :limit'),
+                       {'limit': app.config['FEED_FANOUT_LIMIT']})
+    db.session.execute(text('DROP INDEX IF EXISTS ix_podcast_owner_id'))
+    create_index('ix_podcast_owner_id_created_at_id', 'podcast',
+                 ['owner_id', 'created_at', 'id'])
+    TimelineEntry.__table__.create(db.session.connection(), checkfirst=True)
+    db.session.execute(text('DELETE FROM timeline_entry'))
+    db.session.execute(text('''INSERT INTO timeline_entry (user_id, podcast_id, created_at)
+                               SELECT f.follower_id, p.id, p.created_at FROM follow f
+                               JOIN podcast p ON p.owner_id = f.followee_id
+                               JOIN "user" u ON u.id = f.followee_id WHERE u.fan_out_on_read = 0'''))
+
+
+def add_trending_scores():
+    '''
+    The creation times of likes and comments and the trending score of each podcast, which
+    is computed once for every existing podcast and then kept up to date as likes and
+    comments are added and removed. Existing likes and comments are counted as if they had
+    been added when their podcast was uploaded.
+    '''
+    add_column('like', 'created_at',
+               "DATETIME DEFAULT '1970-01-01 00:00:00.000000' NOT NULL")
+    add_column('comment', 'created_at',
+               "DATETIME DEFAULT '1970-01-01 00:00:00.000000' NOT NULL")
+    add_column('podcast', 'trending_score', "FLOAT DEFAULT '0' NOT NULL")
+    create_index('ix_podcast_trending_score_id', 'podcast',
+                 ['trending_score', 'id'])
+    recompute_trending_scores()
+
+
+def add_comment_order_index():
+    '''
+    The index that the comments of a podcast are paginated by, newest first. It replaces
+    the index on just the podcast of each comment.
+    '''
+    db.session.execute(text('DROP INDEX IF EXISTS ix_comment_podcast_id'))
+    create_index('ix_comment_podcast_id_created_at_id', 'comment',
+                 ['podcast_id', 'created_at', 'id'])
+
+
+def add_jobs():
+    '''The Job table that background jobs are queued in.'''
+    Job.__table__.create(db.session.connection(), checkfirst=True)
+
+
+def add_blobs():
+    '''
+    The Blob table and the blob of every existing podcast and profile picture. Each file is
+    hashed and copied into storage under its blob (see blobs.py), along with the
+    compressed rendition and segments of a podcast and the sizes of a profile picture.
+    Identical files end up in the same blob. Files that are missing are skipped.
+
+    The old files are left where they are until this migration has been committed and are
+    then removed by a background job, so if the migration is interrupted, it can run again
+    from the start.
+    '''
+    Blob.__table__.create(db.session.connection(), checkfirst=True)
+    add_column('podcast', 'blob_id', 'INTEGER REFERENCES blob (id)')
+    old_paths = []
+
+    def link_into_blob(blob, filename, path):
+        # The local backend hard links the files instead of copying them.
+        if os.path.isdir(path):
+            storage.put_directory(blob_key(blob.sha256, filename), path, keep_source=True)
+        else:
+            storage.put(blob_key(blob.sha256, filename), path, keep_source=True)
+        old_paths.append(path)
+
+    for podcast in Podcast.query.filter(Podcast.blob_id == None).all():
+        path = os.path.join(app.root_path, 'podcast_files', podcast.podcast_file)
+        if not os.path.isfile(path):
+            continue
+        blob = acquire_blob(*hash_file(path))
+        link_into_blob(blob, 'original', path)
+        podcast.blob_id = blob.id
+        if podcast.compressed_file:
+            path = os.path.join(app.root_path, 'podcast_files', podcast.compressed_file)
+            if os.path.isfile(path):
+                link_into_blob(blob, 'compressed.m4a', path)
+                podcast.compressed_file = 'compressed.m4a'
+            else:
+                podcast.compressed_file = None
+                podcast.processing_status = 'pending'
+        path = os.path.join(app.root_path, 'podcast_hls', podcast.public_id)
+        if podcast.hls_ready and os.path.isdir(path):
+            link_into_blob(blob, 'hls', path)
+        else:
+            podcast.hls_ready = False
+
+    sizes = app.config['PROFILE_PICTURE_SIZES']
+    # Only the columns that exist at this version are loaded.
+    for user in User.query.options(load_only(User.profile_image)).filter(User.profile_image != 'default.png').all():
+        hex_string, extension = os.path.splitext(user.profile_image)
+        if len(hex_string) == 64:
+            continue
+        path = os.path.join(app.root_path, 'profile_pics', user.profile_image)
+        if not os.path.isfile(path):
+            user.profile_image = 'default.png'
+            continue
+        blob = acquire_blob(*hash_file(path))
+        link_into_blob(blob, 'picture' + extension, path)
+        for size in sizes:
+            for variant_extension in ('webp', 'jpg'):
+                path = os.path.join(app.root_path, 'profile_pics',
+                                    f'{hex_string}_{size}.{variant_extension}')
+                if os.path.isfile(path):
+                    link_into_blob(
+                        blob, f'{size}.{variant_extension}', path)
+        user.profile_image = blob.sha256 + extension
+
+    if old_paths:
+        paths = [os.path.relpath(path, app.root_path) for path in old_paths]
+        enqueue_job('remove_files', paths=paths)
+
+
+def move_upload_chunks():
+    '''
+    The chunks of an unfinished upload used to be written into a single file in the
+    'podcast_uploads' directory and are now kept in the media storage (see ingest.py). The
+    bytes that each upload has received so far are put into storage as its first chunk, so
+    it carries on where it left off. Anything past 'received_size' belongs to a chunk that
+    never finished, so it is cut off first. An upload with a file that is shorter than that
+    cannot be finished and is left for the garbage collector.
+
+    Like in 'add_blobs()', the old files are kept until this migration has been committed
+    and are then removed by a background job.
+    '''
+    directory = os.path.join(app.root_path, 'podcast_uploads')
+    if not os.path.isdir(directory):
+        return
+    for upload in Upload.query.filter(Upload.received_size > 0).all():
+        path = os.path.join(directory, f'{upload.public_id}.part')
+        if not os.path.isfile(path) or os.path.getsize(path) < upload.received_size:
+            continue
+        with open(path, 'r+b') as part_file:
+            part_file.truncate(upload.received_size)
+        storage.put(upload_part_key(upload.public_id, 0), path, keep_source=True)
+    enqueue_job('remove_files', paths=[
+                os.path.relpath(directory, app.root_path)])
+
+
+def add_profile_picture_sizes():
+    '''
+    The 'profile_image_sizes' column, which is filled in for every existing profile picture
+    from the files that its blob has in storage. The files of each blob are only listed
+    once, even if several users have the same picture.
+    '''
+    add_column('user', 'profile_image_sizes', 'VARCHAR(200)')
+    sizes = {}
+    for user in User.query.filter(User.profile_image != 'default.png').all():
+        sha256 = os.path.splitext(user.profile_image)[0]
+        if sha256 not in sizes:
+            sizes[sha256] = saved_profile_picture_sizes(sha256)
+        user.profile_image_sizes = sizes[sha256]
+
+
+MIGRATIONS = [
+    (1, "Add counter, pagination and media columns", add_counter_and_media_columns),
+    (2, "Add foreign key indexes and unique likes and follows",
+     add_indexes_and_unique_constraints),
+    (3, "Use integer primary keys with public ids", use_integer_primary_keys),
+    (4, "Add full-text podcast search", add_podcast_search),
+    (5, "Add home feed timelines", add_timelines),
+    (6, "Add trending scores", add_trending_scores),
+    (7, "Add comment pagination index", add_comment_order_index),
+    (8, "Add background jobs", add_jobs),
+    (9, "Add content-addressed media blobs", add_blobs),
+    (10, "Move chunked upload parts into the media storage", move_upload_chunks),
+    (11, "Record the saved sizes of profile pictures", add_profile_picture_sizes),
+]
+
+
+def schema_version():
+    return db.session.execute(text('SELECT version FROM schema_version')).scalar()
+
+
+def upgrade_database():
+    '''
+    The code below will bring the database up to the latest version. A database without
+    a 'schema_version' table either has no tables at all, in which case every table is
+    created, or was created before migrations existed, in which case every migration
+    is applied to it.
+    '''
+    tables = inspect(db.engine).get_table_names()
+    if 'schema_version' not in tables:
+        if 'user' in tables:
+            version = 0
+        else:
+            db.create_all()
+            version = MIGRATIONS[-1][0]
+        db.session.execute(
+            text('CREATE TABLE schema_version (version INTEGER NOT NULL)'))
+        db.session.execute(
+            text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': version})
+        db.session.commit()
+
+    for version, description, migration in MIGRATIONS:
+        if version > schema_version():
+            print(f"Applying migration {version}: {description}.")
+            migration()
+            db.session.execute(
+                text('UPDATE schema_version SET version = :version'), {'version': version})
+            db.session.commit()
+    print(f"The database is at version {schema_version()}.")
@@ -2,17 +2,36 @@
 # Copyright (c) Arpan Neupane 2022. All rights reserved.
 
 from configs import db
+from sqlalchemy import func, event, text
 import uuid
+import datetime
 
 
 def uuid_gen():
     return str(uuid.uuid4())
 
 
+# The largest number of values that are put into a single IN (...) clause.
+IN_BATCH_SIZE = 500
+
+
+'''
+Every table uses a small integer primary key, so the foreign keys on the largest tables
+(Like, Follow and Comment) and the indexes on them are a few bytes per row instead of a
+36 character string, and joins compare integers. These ids are only used inside the
+database and are never sent to the frontend.
+
+Rows that the frontend needs to refer to (users, podcasts, comments and uploads) also have
+a 'public_id', which is a random UUID. It is what appears in URLs, in API responses and in
+login tokens, so a public id cannot be guessed or used to count the rows in a table.
+'''
+
+
 # User table schema
 class User(db.Model):
-    id = db.Column(db.String, primary_key=True,
-                   default=uuid_gen, unique=True)
+    id = db.Column(db.Integer, primary_key=True)
+    public_id = db.Column(db.String(36), unique=True,
+                          nullable=False, default=uuid_gen)
     first_name = db.Column(db.String(), nullable=False)
     last_name = db.Column(db.String(), nullable=False)
     username = db.Column(db.String(15), unique=True, nullable=False)
@@ -21,8 +40,9 @@ class User(db.Model):
     deactivated = db.Column(db.Boolean, default=False, nullable=False)
     '''
     The 'profile_image' is the profile picture of the user. This column will contain
-    the profile picture's filename and the file will be located in the 'profile_pics'
-    directory in the server.
+    the SHA-256 hash of the picture followed by the extension of its main file, and the
+    picture's files are located in the directory of that blob (see blobs.py). Users without
+    a profile picture have 'default.png', which is located in the 'profile_pics' directory.
     The 'podcasts' variable will create a relationship with the Podcast table.
     A user can create many podcasts and all those podcasts will belong to one user
     and that user is labeled as the owner which is also the back-reference.
@@ -33,7 +53,33 @@ class User(db.Model):
     Each follow object will have a follower and a followee.
     '''
     profile_image = db.Column(
-        db.String(30), nullable=False, default='default.png')
+        db.String(80), nullable=False, default='default.png')
+    '''
+    'profile_image_sizes' lists the files of the profile picture that were saved at each
+    size (for example '128.jpg 128.webp 40.jpg 40.webp'), separated by spaces. It is recorded
+    when the picture is stored so that a request for one of the sizes does not have to check
+    the storage for it first. A picture without it is always sent at its main file.
+    '''
+    profile_image_sizes = db.Column(db.String(200))
+    '''
+    The 'followers_count' and 'following_count' columns are stored copies of the number of
+    users that follow this user and the number of users that this user follows. They are
+    updated in the same transaction as the follow or unfollow so that profile pages can read
+    them without counting the Follow table. If they ever drift, 'refresh_counters()' can
+    recompute them.
+    '''
+    followers_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    '''
+    'fan_out_on_read' is set once a user has more followers than 'FEED_FANOUT_LIMIT' when
+    they upload a podcast. From then on, their podcasts are no longer copied into the
+    TimelineEntry table and are read from the Podcast table by their followers instead.
+    It is never unset, so none of their podcasts can fall between the two.
+    '''
+    fan_out_on_read = db.Column(
+        db.Boolean, nullable=False, default=False, server_default='0')
     podcasts = db.relationship(
         'Podcast', backref="owner", foreign_keys="Podcast.owner_id", lazy='dynamic', cascade="all,delete")
     comments = db.relationship(
@@ -44,6 +90,8 @@ class User(db.Model):
         "Follow", backref='follower', foreign_keys="Follow.follower_id", lazy='dynamic', cascade="all,delete")
     followee = db.relationship(
         "Follow", backref='followee', foreign_keys="Follow.followee_id", lazy='dynamic', cascade="all,delete")
+    uploads = db.relationship(
+        "Upload", backref='owner', foreign_keys="Upload.owner_id", lazy='dynamic', cascade="all,delete")
 
     def is_following_user(self, user):
         '''
@@ -52,8 +100,8 @@ class User(db.Model):
         in as an argument. If they are following them, then True will be returned, otherwise False will
         be returned.
         '''
-        is_following = Follow.query.filter_by(
-            follower=self, followee=user).count() > 0
+        is_following = db.session.query(Follow.query.filter_by(
+            follower_id=self.id, followee_id=user.id).exists()).scalar()
         return is_following
 
     def has_liked_podcast(self, podcast):
@@ -63,22 +111,51 @@ class User(db.Model):
         in as an argument. If they are following them, then True will be returned, otherwise False will
         be returned.
         '''
-        has_liked = Like.query.filter_by(
-            liker=self, podcast=podcast).count() > 0
+        has_liked = db.session.query(Like.query.filter_by(
+            liker_id=self.id, podcast_id=podcast.id).exists()).scalar()
         return has_liked
 
+    def liked_podcast_ids(self, podcast_ids):
+        '''
+        This method does the same as 'has_liked_podcast()' for a whole list of podcasts at
+        once. It takes the public ids of the podcasts and returns the set of the ones that
+        this user has liked. The podcasts are looked up in batches of 'IN_BATCH_SIZE' with
+        one IN (...) query per batch, so a long list stays under the database's limit on
+        query parameters.
+        '''
+        podcast_ids = list(podcast_ids)
+        liked_podcast_ids = set()
+        for start in range(0, len(podcast_ids), IN_BATCH_SIZE):
+            liked_podcast_ids.update(podcast_id for (podcast_id,) in db.session.query(Podcast.public_id).join(
+                Like, Like.podcast_id == Podcast.id).filter(Like.liker_id == self.id, Podcast.public_id.in_(podcast_ids[start:start + IN_BATCH_SIZE])))
+        return liked_podcast_ids
+
+    def followed_usernames(self, usernames):
+        '''
+        This method does the same as 'is_following_user()' for a whole list of usernames
+        at once and returns the set of the ones that this user is following.
+        '''
+        usernames = list(usernames)
+        followed_usernames = set()
+        for start in range(0, len(usernames), IN_BATCH_SIZE):
+            followed_usernames.update(username for (username,) in db.session.query(User.username).join(
+                Follow, Follow.followee_id == User.id).filter(Follow.follower_id == self.id, User.username.in_(usernames[start:start + IN_BATCH_SIZE])))
+        return followed_usernames
+
 
 # Podcast table schema
 class Podcast(db.Model):
-    id = db.Column(db.String, primary_key=True, default=uuid_gen)
+    id = db.Column(db.Integer, primary_key=True)
+    public_id = db.Column(db.String(36), unique=True,
+                          nullable=False, default=uuid_gen)
     '''
     The 'owner_id' variable will be equal to the owner's id in the database.
     The 'podcast_title' is the title of the podcast and the 'podcast_description'
     is just a small description on things that are discussed in the podcast.
     The 'podcast_title' and 'podcast_description' columns are self-explanatory.
-    The 'podcast_file' is the audio file for the podcast. This column will contain
-    that file's name and the file will be located in the 'podcast_files' directory in
-    the server.
+    The 'podcast_file' is the name of the audio file for the podcast, whose extension is
+    the type of the file. The file itself is stored in the blob that 'blob_id' points to
+    (see blobs.py), so podcasts with identical files share a single copy of it.
     The 'likes' variable will create a relationship with the Like table.
     Each podcast will have a certain number of likes and each like object
     has a user that liked a podcast and the podcast that was liked.
@@ -86,28 +163,86 @@ class Podcast(db.Model):
     Each comment will have a podcast that the comment was posted on and a user
     which is the user that created the comment on that specific podcast.
     '''
-    owner_id = db.Column(db.String, db.ForeignKey("user.id"), nullable=False)
+    owner_id = db.Column(db.Integer, db.ForeignKey(
+        "user.id"), nullable=False)
     podcast_title = db.Column(db.String(50), nullable=False)
     podcast_description = db.Column(db.String(500), nullable=False)
-    podcast_file = db.Column(db.String(30), unique=True, nullable=False)
+    podcast_file = db.Column(db.String(50), unique=True, nullable=False)
+    blob_id = db.Column(db.Integer, db.ForeignKey("blob.id"), nullable=True)
+    blob = db.relationship("Blob")
+    '''
+    The 'created_at' column is the time the podcast was uploaded. Listings are ordered
+    by this column (newest first) and the podcast id is used as a tie-breaker, which is
+    what the composite indexes below are for. Together they form the cursor that is used
+    for paginating podcast listings. The second index does the same for the podcasts of
+    a single owner, which is how profiles and home feeds read them.
+    '''
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+    '''
+    The 'like_count' and 'comment_count' columns work the same way as the counters on the
+    User table. They are kept up to date whenever a like or comment is added or removed.
+    '''
+    like_count = db.Column(db.Integer, nullable=False,
+                           default=0, server_default='0')
+    comment_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    '''
+    The 'processing_status' column tracks the transcoding of the podcast file and is one of
+    'pending', 'processing', 'ready' or 'failed'. Once it is 'ready', the 'compressed_file'
+    column contains the filename of the compressed rendition in the directory of the
+    podcast's blob, and 'hls_ready' is True if the podcast has also been packaged into
+    segments in the 'hls' directory of the blob.
+    '''
+    processing_status = db.Column(
+        db.String(10), nullable=False, default='pending', server_default='pending')
+    compressed_file = db.Column(db.String(45), nullable=True)
+    hls_ready = db.Column(db.Boolean, nullable=False,
+                          default=False, server_default='0')
+    '''
+    'trending_score' orders the podcasts on the trending Listen page. It is updated along
+    with 'like_count' and 'comment_count', see trending.py for how it is computed.
+    '''
+    trending_score = db.Column(
+        db.Float, nullable=False, default=0, server_default='0')
     likes = db.relationship("Like", backref="podcast",
                             foreign_keys="Like.podcast_id", lazy='dynamic', cascade="all,delete")
     comments = db.relationship(
         "Comment", backref="podcast", foreign_keys="Comment.podcast_id", lazy='dynamic', cascade="all,delete")
 
+    __table_args__ = (db.Index('ix_podcast_created_at_id', 'created_at', 'id'),
+                      db.Index('ix_podcast_owner_id_created_at_id',
+                               'owner_id', 'created_at', 'id'),
+                      db.Index('ix_podcast_trending_score_id', 'trending_score', 'id'))
+
 
 # Like table schema
 class Like(db.Model):
-    id = db.Column(db.String, primary_key=True, default=uuid_gen)
+    id = db.Column(db.Integer, primary_key=True)
     '''The 'podcast_id' variable will be equal to the podcast's id which was liked.'''
-    podcast_id = db.Column(db.String, db.ForeignKey(
-        "podcast.id"), nullable=False)
-    liker_id = db.Column(db.String, db.ForeignKey("user.id"), nullable=False)
+    podcast_id = db.Column(db.Integer, db.ForeignKey(
+        "podcast.id"), nullable=False, index=True)
+    liker_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    '''
+    'created_at' is when the like was added. Likes that were added before this column
+    existed have the time 1970-01-01.
+    '''
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+                           server_default='1970-01-01 00:00:00.000000')
+
+    '''
+    A user can only like a podcast once. The unique index also covers looking up the likes
+    of a user since 'liker_id' is its first column.
+    '''
+    __table_args__ = (db.Index('uq_like_liker_id_podcast_id',
+                      'liker_id', 'podcast_id', unique=True),)
 
 
 # Comment table schema
 class Comment(db.Model):
-    id = db.Column(db.String, primary_key=True, default=uuid_gen)
+    id = db.Column(db.Integer, primary_key=True)
+    public_id = db.Column(db.String(36), unique=True,
+                          nullable=False, default=uuid_gen)
     '''
     The 'commenter_id' will be equal to the commenter's id in the database.
     It can be also known as the user that created the comment on the podcast.
@@ -116,14 +251,25 @@ class Comment(db.Model):
     '''
     comment = db.Column(db.String(150), nullable=False)
     commenter_id = db.Column(
-        db.String, db.ForeignKey("user.id"), nullable=False)
-    podcast_id = db.Column(db.String, db.ForeignKey(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    podcast_id = db.Column(db.Integer, db.ForeignKey(
         "podcast.id"), nullable=False)
+    '''
+    'created_at' is when the comment was posted. Like on the Like table, comments that were
+    posted before this column existed have the time 1970-01-01. The comments of a podcast
+    are read newest first from the index below, which also covers looking them up by
+    'podcast_id'.
+    '''
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+                           server_default='1970-01-01 00:00:00.000000')
+
+    __table_args__ = (db.Index('ix_comment_podcast_id_created_at_id',
+                      'podcast_id', 'created_at', 'id'),)
 
 
 # Follower table schema
 class Follow(db.Model):
-    id = db.Column(db.String, primary_key=True, default=uuid_gen)
+    id = db.Column(db.Integer, primary_key=True)
     '''
     The 'follower_id' is the user id of the person who is the follower
     of another user.
@@ -132,5 +278,173 @@ class Follow(db.Model):
     For example, if user_1 follows user_2, user_1 is the follower, and user_2
     is the followee.
     '''
-    follower_id = db.Column(db.String, db.ForeignKey("user.id"))
-    followee_id = db.Column(db.String, db.ForeignKey("user.id"))
+    follower_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    followee_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
+
+    '''
+    A user can only follow another user once. Like the unique index on the Like table, it
+    also covers looking up who a user follows.
+    '''
+    __table_args__ = (db.Index('uq_follow_follower_id_followee_id',
+                      'follower_id', 'followee_id', unique=True),)
+
+
+# Upload table schema
+class Upload(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    public_id = db.Column(db.String(36), unique=True,
+                          nullable=False, default=uuid_gen)
+    '''
+    An Upload is a podcast file that is being uploaded in chunks. The chunks are kept in the
+    media storage under their offset (see ingest.py) and 'received_size' is the number of bytes
+    that have been stored so far, which is where the next chunk has to start. Once every byte
+    has been received and the checksum matches, the file is put into the blob with that
+    checksum, the podcast is created and the Upload is deleted.
+    The 'podcast_title' and 'podcast_description' are given when the upload is started and
+    are used to create the podcast at the end.
+    '''
+    owner_id = db.Column(db.Integer, db.ForeignKey(
+        "user.id"), nullable=False, index=True)
+    podcast_title = db.Column(db.String(50), nullable=False)
+    podcast_description = db.Column(db.String(500), nullable=False)
+    file_ext = db.Column(db.String(10), nullable=False)
+    total_size = db.Column(db.Integer, nullable=False)
+    received_size = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+
+
+# Timeline entry table schema
+class TimelineEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    '''
+    A TimelineEntry puts a podcast into the home feed of a user ('user_id'), who follows the
+    owner of the podcast. 'created_at' is a copy of the podcast's creation time so that a
+    user's feed can be read newest first from the index below alone, without joining the
+    Podcast or Follow tables.
+    '''
+    user_id = db.Column(db.Integer, db.ForeignKey(
+        "user.id"), nullable=False)
+    podcast_id = db.Column(db.Integer, db.ForeignKey(
+        "podcast.id"), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index('uq_timeline_entry_user_id_created_at_podcast_id',
+                      'user_id', 'created_at', 'podcast_id', unique=True),)
+
+
+# Job table schema
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    '''
+    A Job is a piece of work that is run in the background by jobs.py. 'kind' is the name
+    of the function that runs it and 'payload' is a JSON object with its arguments.
+    The 'status' of a job is 'queued' until a worker picks it up, then 'running'. Jobs that
+    succeed are deleted and jobs that have failed 'JOB_MAX_ATTEMPTS' times are kept with a
+    status of 'failed' and the error in 'last_error'.
+    'run_at' is the earliest time that the job can be run, which is pushed back after
+    every failed attempt, and 'started_at' is when the current attempt started.
+    '''
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False,
+                      default=datetime.datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+
+
+# Blob table schema
+class Blob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    '''
+    A Blob is a media file that is stored once no matter how many podcasts or users use it.
+    'sha256' is the SHA-256 hash of the file's contents and is also the name of the directory
+    that it is stored in, 'size' is its size in bytes and 'refcount' is the number of podcasts
+    and profile pictures that use it. See blobs.py.
+    '''
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+
+
+def refresh_counters(podcast_ids=None, user_ids=None):
+    '''
+    The code below will recompute the stored like, comment, follower and following counts
+    straight from the Like, Comment and Follow tables. Each counter is recomputed with a
+    single UPDATE statement, so this works in bulk no matter how many rows there are.
+
+    If a list of podcast ids or user ids is passed in, only those rows are recomputed,
+    otherwise every row is. The caller is responsible for committing the changes.
+    '''
+    like_count = db.session.query(func.count(Like.id)).filter(
+        Like.podcast_id == Podcast.id).scalar_subquery()
+    comment_count = db.session.query(func.count(Comment.id)).filter(
+        Comment.podcast_id == Podcast.id).scalar_subquery()
+    podcasts = Podcast.query
+    if podcast_ids is not None:
+        podcasts = podcasts.filter(Podcast.id.in_(podcast_ids))
+    podcasts.update({Podcast.like_count: like_count,
+                    Podcast.comment_count: comment_count}, synchronize_session=False)
+
+    followers_count = db.session.query(func.count(Follow.id)).filter(
+        Follow.followee_id == User.id).scalar_subquery()
+    following_count = db.session.query(func.count(Follow.id)).filter(
+        Follow.follower_id == User.id).scalar_subquery()
+    users = User.query
+    if user_ids is not None:
+        users = users.filter(User.id.in_(user_ids))
+    users.update({User.followers_count: followers_count,
+                 User.following_count: following_count}, synchronize_session=False)
+
+
+'''
+On SQLite, podcasts are searched through 'podcast_search', an FTS5 full-text index of the title
+and description of every podcast along with the username of its owner. The rowid of each
+row in the index is the id of its podcast.
+
+The index is kept up to date by triggers, so every insert, update and delete of a podcast
+(and every change of a username) updates the matching rows of the index in the same
+transaction and the podcasts never have to be scanned again. The index and its triggers
+are created right after the Podcast table is created. Other databases do not have FTS5, so
+there the search route ranks the podcasts itself (see 'search()' in routes.py).
+'''
+PODCAST_SEARCH_DDL = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS podcast_search
+       USING fts5(podcast_title, podcast_description, owner_username)''',
+    '''CREATE TRIGGER IF NOT EXISTS podcast_search_insert AFTER INSERT ON podcast BEGIN
+       INSERT INTO podcast_search (rowid, podcast_title, podcast_description, owner_username)
+       VALUES (new.id, new.podcast_title, new.podcast_description,
+               (SELECT username FROM "user" WHERE id = new.owner_id));
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS podcast_search_update
+       AFTER UPDATE OF podcast_title, podcast_description ON podcast BEGIN
+       UPDATE podcast_search SET podcast_title = new.podcast_title,
+       podcast_description = new.podcast_description WHERE rowid = new.id;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS podcast_search_delete AFTER DELETE ON podcast BEGIN
+       DELETE FROM podcast_search WHERE rowid = old.id;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS podcast_search_username AFTER UPDATE OF username ON "user" BEGIN
+       UPDATE podcast_search SET owner_username = new.username
+       WHERE rowid IN (SELECT id FROM podcast WHERE owner_id = new.id);
+       END''',
+]
+
+
+def create_podcast_search(connection):
+    for statement in PODCAST_SEARCH_DDL:
+        connection.execute(text(statement))
+
+
+@event.listens_for(Podcast.__table__, 'after_create')
+def create_podcast_search_after_podcast(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        create_podcast_search(connection)
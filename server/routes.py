@@ -1,18 +1,32 @@
 # Code written by Arpan Neupane.
 # Copyright (c) Arpan Neupane 2022. All rights reserved.
 
-from flask import request, jsonify, send_file
+from flask import request, jsonify, send_file, abort, redirect, g
 from configs import app, db, bcrypt
-from flask_mail import Mail, Message
-from models import User, Podcast, Like, Comment, Follow
+from models import User, Podcast, Like, Comment, Follow, Upload, TimelineEntry, Blob, refresh_counters
+from media import queue_podcast_transcode, store_profile_picture, profile_picture_key, profile_picture_blob, profile_picture_etag, queue_stored_file_removal
+from blobs import SHA256_PATTERN, blob_key, acquire_blob_with_file, release_blob
+from storage import storage
+from emails import queue_email
+from cache import LRUCache, response_cache
+from auth import token_required
+from ingest import save_uploaded_file, save_request_body, upload_prefix, upload_part_key, join_upload_parts
+from timeline import fan_out_podcast, add_followee_to_timeline, remove_followee_from_timeline, remove_podcasts_from_timelines, read_timeline
+from trending import initial_trending_score, add_trending_event, remove_trending_event, recompute_trending_scores
 import jwt
 from PIL import Image
 import os
 import secrets
+import mimetypes
 import datetime
+import base64
+import re
 from werkzeug.utils import secure_filename
-
-mail = Mail(app)
+from werkzeug.security import safe_join
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from sqlalchemy import or_, and_, func, table, column, literal_column, cast, Float
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 
 @app.route('/')
@@ -41,6 +55,11 @@ def page_not_found(e):
     return app.send_static_file('index.html'), 500
 
 
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    return jsonify({"message": "File is too large."}), 413
+
+
 # API route for creating new users.
 @app.route("/api/register", methods=['POST'])
 def register():
@@ -128,6 +147,8 @@ def login():
         if user.deactivated == True:
             user.deactivated = False
             db.session.commit()
+            # The user's podcasts can be on any page of the Listen page again.
+            response_cache.invalidate('listen')
         if not bcrypt.check_password_hash(user.password, password):
             print("Invalid password.")
             return jsonify({
@@ -136,12 +157,12 @@ def login():
         if bcrypt.check_password_hash(user.password, password):
 
             '''
-            'jwt_key' will encrypt the user's id by using the JWT_SECRET_KEY
+            'jwt_key' will encrypt the user's public id by using the JWT_SECRET_KEY
             which is an environment variable that contains a hash used for encryption.
 
             This key will expire in 172800 seconds (equivalent to 2 days) after being created.
             '''
-            jwt_key = jwt.encode({"id": user.id, "exp": datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=172800)},
+            jwt_key = jwt.encode({"id": user.public_id, "exp": datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=172800)},
                                  os.environ.get("JWT_SECRET_KEY"), algorithm='HS256')
             print("Verification successful.")
             return jsonify({
@@ -150,718 +171,1436 @@ def login():
             })
 
 
+'''
+Profile pictures are requested many times on every page, so the filename of each user's
+profile picture is cached by username. The cache is cleared for a user whenever their
+profile picture or username changes or their account is deleted. Other worker processes
+will pick up the change once their entry expires after 'PROFILE_PICTURE_CACHE_TTL' seconds.
+'''
+profile_image_cache = LRUCache(
+    maxsize=10000, ttl=app.config['PROFILE_PICTURE_CACHE_TTL'])
+
+
+def profile_picture_url(user):
+    '''
+    The URL of a user's profile picture includes a version which changes whenever the
+    profile picture changes. Since the image at a versioned URL never changes, browsers
+    are allowed to cache it forever.
+    '''
+    return f'/api/profile-picture/{user.username}?v={os.path.splitext(user.profile_image)[0]}'
+
+
+def get_profile_image(username):
+    '''Returns the 'profile_image' and 'profile_image_sizes' of a user, or None if there is no such user.'''
+    profile_image = profile_image_cache.get(username)
+    if profile_image == None:
+        profile_image = db.session.query(User.profile_image, User.profile_image_sizes).filter_by(
+            username=username).first()
+        if profile_image == None:
+            return None
+        profile_image = tuple(profile_image)
+        profile_image_cache.set(username, profile_image)
+    return profile_image
+
+
 @app.route("/api/profile-picture/<username>", methods=['GET'])
 def return_profile_picture(username):
-    user = User.query.filter_by(username=username).first()
-    if user:
-        return send_file(f'profile_pics/{user.profile_image}')
+    '''
+    The frontend can ask for a size (in pixels) and a format ('webp' or 'jpg') in the
+    query string, for example '?size=40&format=webp'. If no format is given, WebP is sent
+    to browsers that accept it and JPEG to everyone else. If no size is given, the largest
+    size is sent.
+
+    Every response has an ETag that has the hash of the image in it, so a browser that already has
+    the image gets a 304 Not Modified instead of the image. If the URL has the version of the
+    user's current profile picture (see 'profile_picture_url()'), the image is cached for a
+    year, otherwise the browser has to check with the ETag before using its cached copy.
+    '''
+    profile_image = get_profile_image(username)
+    if profile_image:
+        profile_image, profile_image_sizes = profile_image
+        size = request.args.get('size', type=int) or max(
+            app.config['PROFILE_PICTURE_SIZES'])
+        extension = request.args.get('format')
+        negotiated = extension not in ('webp', 'jpg')
+        if negotiated:
+            extension = 'webp' if request.accept_mimetypes['image/webp'] else 'jpg'
+        versioned = request.args.get('v') == os.path.splitext(profile_image)[0]
+        key = profile_picture_key(profile_image, profile_image_sizes, size, extension)
+        if key:
+            response = send_media_file(
+                key, immutable=versioned, max_age=None if versioned else 0, etag=key)
+        else:
+            file_path = os.path.join(app.root_path, 'profile_pics', profile_image)
+            if not os.path.isfile(file_path):
+                profile_image_cache.delete(username)
+                abort(404)
+            response = send_file(file_path, conditional=True,
+                                 etag=profile_picture_etag(file_path))
+            if versioned:
+                response.cache_control.no_cache = None
+                response.cache_control.max_age = 31536000
+                response.cache_control.immutable = True
+            else:
+                response.cache_control.max_age = 0
+                response.cache_control.no_cache = True
+            response.cache_control.public = True
+        if negotiated:
+            response.vary.add('Accept')
+        return response
     else:
         return jsonify({"message": "User does not exist."})
 
 
-# Auth verification
-def verify_authentication():
+'''
+In the following routes where logins are required, each
+route is wrapped with the token_required decorator in order to make sure
+that a user is logged in, in order to view the information in those routes.
+The decorator loads the current user once and stores them in 'g.current_user'.
+'''
+
+
+# Function for building the podcast listings that are sent to the frontend.
+def podcast_feed_query():
+    '''
+    The code below will build a single query that returns each podcast along with
+    the owner's username, the number of likes and the number of comments.
+
+    Previously every podcast in a listing would lazy-load its owner and run its own
+    COUNT queries, which meant four or more queries per podcast. The owner is now joined in
+    and the counts are read from the counter columns on the Podcast table, so the database
+    does all of the work in one round trip no matter how many podcasts there are. The routes
+    that use this function can add their own filters (for example the owner of the podcasts)
+    before the rows are passed to 'podcasts_to_json()'.
+
+    Nothing in this query depends on the current user, so the same page can be cached
+    and sent to everyone. Whether the current user has liked each podcast is added
+    afterwards by 'add_viewer_flags()'.
+    '''
+    return db.session.query(Podcast, User.username, Podcast.like_count, Podcast.comment_count, Blob.sha256).join(
+        User, Podcast.owner_id == User.id).outerjoin(Blob, Podcast.blob_id == Blob.id)
+
+
+def podcasts_to_json(rows):
+    '''
+    The code below will turn the rows returned by 'podcast_feed_query()' into the list of
+    dictionaries that the frontend expects, apart from the 'currentUserLikedPodcast' flag.
+    The audio and HLS URLs point straight at the podcast's blob, so they never change for
+    as long as the podcast's files do not, and browsers can cache them forever.
+    '''
+    podcasts_json = []
+    for podcast, owner_username, likes, comments, sha256 in rows:
+        podcast_dict = {"podcast_owner_username": owner_username, "podcast_title": podcast.podcast_title, "podcast_description": podcast.podcast_description,
+                        "podcast_id": podcast.public_id, "likes": likes, "comments": comments,
+                        "audioUrl": podcast_audio_url(podcast, sha256),
+                        "hlsPlaylist": f'/api/media/{sha256}/hls/master.m3u8' if podcast.hls_ready and sha256 else None}
+        podcasts_json.append(podcast_dict)
+    return podcasts_json
+
+
+def podcast_audio_url(podcast, sha256):
+    '''
+    The URL of the compressed rendition once the podcast has been transcoded, or of the
+    original file until then. The original is requested with the extension of the podcast
+    file, which is what its type is guessed from.
+    '''
+    if sha256 == None:
+        return f'/api/return-podcast/{podcast.public_id}'
+    if podcast.processing_status == 'ready' and podcast.compressed_file:
+        return f'/api/media/{sha256}/{podcast.compressed_file}'
+    return f'/api/media/{sha256}/original{os.path.splitext(podcast.podcast_file)[1]}'
+
+
+def podcast_listing_tags(rows):
+    '''
+    The cache tags of a page of podcasts are the podcasts on it and their owners, so the page
+    is removed from 'response_cache' whenever one of them changes.
+    '''
+    tags = set()
+    for podcast, *_ in rows:
+        tags.add(f'podcast:{podcast.id}')
+        tags.add(f'owner:{podcast.owner_id}')
+    return tags
+
+
+def add_viewer_flags(podcasts_json, current_user):
+    '''
+    The code below will return a copy of a list of podcasts with the 'currentUserLikedPodcast'
+    flag set for the current user. The likes of the current user are looked up for the whole
+    list at once. The list itself is not changed since it may be shared through the cache.
     '''
-    The code below will first try to get the token that was
-    sent in the header from the frontend in order to retrieve user
-    details.
+    liked_podcast_ids = current_user.liked_podcast_ids(
+        podcast['podcast_id'] for podcast in podcasts_json)
+    return [dict(podcast, currentUserLikedPodcast=podcast['podcast_id'] in liked_podcast_ids) for podcast in podcasts_json]
+
+
+# Maximum number of podcasts that can be requested in one page.
+MAX_PAGE_SIZE = 100
+# Number of podcasts in a page of a listing that is always paginated, when no limit is given.
+DEFAULT_PAGE_SIZE = 20
 
-    If something goes wrong, it will send an error message stating that.
 
-    If the token has been expired, then it will send an error message stating
-    that the token has expired.
+def encode_cursor(created_at, podcast_id):
+    '''
+    The cursor is the creation time and id of the last podcast on a page. It is
+    base64 encoded so that the frontend can treat it as an opaque string.
+    '''
+    raw = f'{created_at.isoformat()}|{podcast_id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
 
-    If there is a decoding error, then it will state that there was a decoding error.
 
-    If everything is fine, then it will return 'Verification successful', along with the
-    current user's id in case any data needs to be retrieved. This information is sent through
-    a tuple making it easily accessible.
+def decode_cursor(cursor):
+    '''
+    This function does the opposite of 'encode_cursor()'. If the cursor cannot be
+    decoded, a 400 error is returned to the frontend.
     '''
     try:
-        token = request.headers['x-access-token']
-        try:
-            decoded_id = jwt.decode(token, os.environ.get(
-                'JWT_SECRET_KEY'), algorithms=['HS256'])
-            print("Verification successful.")
-            return ("Verification successful.", decoded_id['id'])
-        except jwt.exceptions.ExpiredSignatureError:
-            print("This token has expired.")
-            return "This token has expired."
-        except jwt.exceptions.DecodeError:
-            print("Decoding error.")
-            return "Decoding error."
-    except:
-        print("Something went wrong.")
-        return "Something went wrong."
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created_at, podcast_id = raw.split('|', 1)
+        return datetime.datetime.fromisoformat(created_at), int(podcast_id)
+    except (ValueError, UnicodeError):
+        abort(400)
 
 
-'''
-In the following routes where logins are required, each
-route will call the verify_authentication() function in order to make sure
-that a user is logged in, in order to view the information in those routes.
-'''
+def encode_score_cursor(score, podcast_id):
+    '''
+    Listings that are ordered by a score (search results and trending podcasts) use the
+    score and id of the last podcast on a page as their cursor instead. repr() is used for
+    the score so that it can be turned back into exactly the same number.
+    '''
+    raw = f'{score!r}|{podcast_id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_score_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        score, podcast_id = raw.split('|', 1)
+        return float(score), int(podcast_id)
+    except (ValueError, UnicodeError):
+        abort(400)
+
+
+def paginate_podcasts(query):
+    '''
+    The code below will order a podcast listing from newest to oldest and, if the
+    frontend has asked for it, only return a single page of that listing.
+
+    Pagination is opt-in. If no 'limit' is given in the query string, every podcast is
+    returned just like before. If a 'limit' is given, at most that many podcasts are
+    returned along with a cursor for the next page. The next page is found by seeking
+    past the (created_at, id) of the last podcast that was sent instead of using an
+    OFFSET, so fetching a page deep into the listing costs the same as fetching the
+    first one. The cursor will be None once there are no more podcasts.
+    '''
+    query = query.order_by(Podcast.created_at.desc(), Podcast.id.desc())
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        return query.all(), None
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor')
+    if cursor:
+        created_at, podcast_id = decode_cursor(cursor)
+        query = query.filter(or_(Podcast.created_at < created_at, and_(
+            Podcast.created_at == created_at, Podcast.id < podcast_id)))
+
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_podcast = rows[-1][0]
+        next_cursor = encode_cursor(last_podcast.created_at, last_podcast.id)
+    return rows, next_cursor
+
+
+def paginate_trending_podcasts(query):
+    '''
+    The code below works like 'paginate_podcasts()', but orders the podcasts from the
+    highest trending score to the lowest. The podcasts are read in that order straight from
+    the index on (trending_score, id), so a page of K podcasts only reads K rows.
+    '''
+    query = query.order_by(Podcast.trending_score.desc(), Podcast.id.desc())
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        return query.all(), None
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor')
+    if cursor:
+        score, podcast_id = decode_score_cursor(cursor)
+        query = query.filter(or_(Podcast.trending_score < score, and_(
+            Podcast.trending_score == score, Podcast.id < podcast_id)))
+
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_podcast = rows[-1][0]
+        next_cursor = encode_score_cursor(
+            last_podcast.trending_score, last_podcast.id)
+    return rows, next_cursor
 
 
 # Dashboard API route.
 @app.route("/api/dashboard", methods=['GET'])
+@token_required
 def dashboard():
     if request.method == 'GET':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            podcasts = Podcast.query.filter_by(owner=current_user).all()
-            podcasts_json = []
-            for podcast in podcasts:
-                podcast_dict = {"podcast_owner_username": podcast.owner.username, "podcast_title": podcast.podcast_title, "podcast_description": podcast.podcast_description,
-                                "podcast_id": podcast.id, "likes": podcast.likes.count(), "comments": podcast.comments.count(), "currentUserLikedPodcast": current_user.has_liked_podcast(podcast)}
-                podcasts_json.append(podcast_dict)
-            return jsonify({"message": "Verification successful.", "currentUserUsername": current_user.username, "podcasts": podcasts_json})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        current_user = g.current_user
+        podcasts, next_cursor = paginate_podcasts(podcast_feed_query().filter(
+            Podcast.owner_id == current_user.id))
+        podcasts_json = add_viewer_flags(podcasts_to_json(podcasts), current_user)
+        return jsonify({"message": "Verification successful.", "currentUserUsername": current_user.username, "podcasts": podcasts_json, "nextCursor": next_cursor})
+
+
+# Function for sending audio and other media files.
+def send_media_file(key, mimetype=None, immutable=False, download_name=None, max_age=None, etag=None):
+    '''
+    The code below will send a file from the media storage in a way that lets audio players
+    seek without downloading the whole file again.
+
+    With the 'local' storage backend, if the app is running behind nginx and
+    'MEDIA_ACCEL_REDIRECT_PREFIX' is set, an X-Accel-Redirect header is returned and nginx
+    sends the file (and handles any ranges) itself. Otherwise the file is sent with
+    send_file(), which will add the Accept-Ranges, ETag and Last-Modified headers, answer
+    If-None-Match/If-Modified-Since with a 304 Not Modified and answer a single byte range
+    (including one sent with If-Range) with a 206 Partial Content. Requests for more than
+    one range are rejected with a 416 since audio players never need them. When
+    'USE_X_SENDFILE' is set, send_file() will hand the file to the server with an X-Sendfile
+    header instead, and under a WSGI server with sendfile support the file is otherwise sent
+    without being copied through Python.
+
+    With any other backend, the request is redirected to a presigned URL of the file if
+    'MEDIA_REDIRECT_TO_STORAGE' is set, and otherwise the file is streamed from storage by
+    'stream_media_file()'.
+
+    If no mimetype is given, it is guessed from the filename, and 'download_name' is the
+    filename that the browser is told to use instead of the name in storage. Files that are
+    marked as immutable never change, so they are cached for 'BLOB_MAX_AGE' seconds instead
+    of 'MEDIA_MAX_AGE' seconds and browsers do not revalidate them. A 'max_age' of 0 makes
+    browsers revalidate the file every time.
+    '''
+    if mimetype == None:
+        mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+    if max_age == None:
+        max_age = app.config['BLOB_MAX_AGE'] if immutable else app.config['MEDIA_MAX_AGE']
+    cache_control = f'public, max-age={max_age}' + \
+        (', immutable' if immutable else '') + (', no-cache' if max_age == 0 else '')
+
+    if not storage.local:
+        '''
+        HLS playlists refer to their segments with relative URLs, which would be resolved
+        against the presigned URL after a redirect, so playlists are always streamed.
+        '''
+        if app.config['MEDIA_REDIRECT_TO_STORAGE'] and not key.endswith('.m3u8'):
+            expires_in = app.config['PRESIGNED_URL_EXPIRY']
+            response = redirect(storage.presigned_url(key, expires_in, mimetype=mimetype,
+                                                      download_name=download_name, cache_control=cache_control))
+            # The redirect is only cached for as long as the presigned URL stays valid.
+            response.cache_control.public = True
+            response.cache_control.max_age = min(max_age, expires_in // 2)
+            return response
+        return stream_media_file(key, mimetype, cache_control, download_name, etag or key)
+
+    file_path = storage.path(key)
+    if not os.path.isfile(file_path):
+        abort(404)
+
+    accel_redirect_prefix = app.config['MEDIA_ACCEL_REDIRECT_PREFIX']
+    if accel_redirect_prefix:
+        response = app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = f'{accel_redirect_prefix.rstrip("/")}/{storage.relative_path(key)}'
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    if request.range and len(request.range.ranges) > 1:
+        raise RequestedRangeNotSatisfiable(
+            length=os.path.getsize(file_path))
+
+    response = send_file(file_path, mimetype=mimetype, conditional=True,
+                         etag=etag or True, max_age=max_age, download_name=download_name)
+    response.cache_control.public = True
+    response.cache_control.immutable = immutable
+    response.cache_control.no_cache = max_age == 0 or None
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def stream_media_file(key, mimetype, cache_control, download_name, etag):
+    '''
+    The code below will stream a file from a storage backend that is not on this server. It
+    answers conditional and range requests the same way as send_file(), but a range is read
+    from storage on its own instead of reading the whole file and skipping to the range.
+    '''
+    try:
+        size = storage.size(key)
+    except FileNotFoundError:
+        abort(404)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    content_range = None
+    if request.range and (request.if_range.etag == None or request.if_range.etag == etag):
+        if len(request.range.ranges) > 1:
+            raise RequestedRangeNotSatisfiable(length=size)
+        content_range = request.range.range_for_length(size)
+        if content_range == None:
+            raise RequestedRangeNotSatisfiable(length=size)
+
+    if content_range:
+        start, stop = content_range
+        stream = storage.open_range(key, start, stop - start)
+    else:
+        start, stop = 0, size
+        stream = storage.open(key)
+
+    def generate():
+        try:
+            for block in iter(lambda: stream.read(64 * 1024), b''):
+                yield block
+        finally:
+            stream.close()
+
+    response = app.response_class(generate(), mimetype=mimetype, direct_passthrough=True)
+    response.content_length = stop - start
+    if content_range:
+        response.status_code = 206
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Accept-Ranges'] = 'bytes'
+    if download_name:
+        response.headers.set('Content-Disposition', 'inline', filename=download_name)
+    return response
 
 
 @app.route("/api/return-podcast/<podcast_id>", methods=['GET'])
 def return_podcast(podcast_id):
     '''The code below will return a podcast to the frontend.'''
-    podcast = Podcast.query.filter_by(id=podcast_id).first()
-    if podcast:
-        return send_file(f'podcast_files/{podcast.podcast_file}')
+    podcast = Podcast.query.filter_by(public_id=podcast_id).first()
+    if podcast and podcast.blob:
+        '''
+        Once the podcast has been transcoded, the compressed rendition is sent instead of
+        the original file that was uploaded.
+        '''
+        sha256 = podcast.blob.sha256
+        if podcast.processing_status == 'ready' and podcast.compressed_file:
+            return send_media_file(blob_key(sha256, podcast.compressed_file))
+        return send_media_file(blob_key(sha256, 'original'), mimetype=mimetypes.guess_type(podcast.podcast_file)[0],
+                               download_name=podcast.podcast_file)
     else:
         return jsonify({"message": "Podcast not found."})
 
 
+@app.route("/api/podcast/<podcast_id>/hls/<path:filename>", methods=['GET'])
+def return_podcast_hls_file(podcast_id, filename):
+    '''
+    The HLS files of a podcast are served from its blob. The URLs that were used before
+    podcasts had blobs are redirected there, and since the playlists refer to the
+    other playlists and segments with relative URLs, only the master playlist is ever
+    requested through this route.
+    '''
+    podcast = Podcast.query.filter_by(public_id=podcast_id).first()
+    if podcast == None or not podcast.hls_ready or podcast.blob == None:
+        return jsonify({"message": "Podcast not found."})
+    return redirect(f'/api/media/{podcast.blob.sha256}/hls/{filename}')
+
+
+'''
+Only files that a browser can play or show are served from blobs with their own type.
+Anything else is sent as a download, so a file that was uploaded as a podcast cannot be
+served as a web page from this site.
+'''
+MEDIA_TYPES = {'.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t'}
+
+
+def media_type(filename):
+    extension = os.path.splitext(filename)[1]
+    if extension in MEDIA_TYPES:
+        return MEDIA_TYPES[extension]
+    mimetype = mimetypes.guess_type(filename)[0]
+    if mimetype == None or mimetype == 'image/svg+xml' or mimetype.split('/')[0] not in ('audio', 'video', 'image'):
+        return 'application/octet-stream'
+    return mimetype
+
+
+@app.route("/api/media/<sha256>/<path:filename>", methods=['GET'])
+def return_media_file(sha256, filename):
+    '''
+    The code below will return a file from a blob. The files of a blob are made from its
+    contents and never change, so they are cached for a year without being revalidated.
+    The original file of a blob is stored without an extension and is requested as
+    'original' followed by the extension of the podcast file, which gives it its type.
+    '''
+    if not SHA256_PATTERN.match(sha256):
+        abort(404)
+    mimetype = media_type(filename)
+    download_name = os.path.basename(filename)
+    if os.path.splitext(filename)[0] == 'original':
+        filename = 'original'
+    key = safe_join(sha256, filename)
+    if key == None:
+        abort(404)
+    response = send_media_file(
+        key, mimetype=mimetype, immutable=True, download_name=download_name)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+# Longest file extension that is kept, which is the length of the 'file_ext' column of an
+# Upload. A podcast filename is a 32 character token followed by the extension, so it also
+# fits into the 50 characters of the 'podcast_file' column.
+MAX_FILE_EXT_LENGTH = 10
+
+
+def podcast_file_extension(filename):
+    '''
+    The code below will return the extension of an uploaded podcast file. An extension
+    that is longer than 'MAX_FILE_EXT_LENGTH' is not a real audio extension, so it is
+    dropped instead of being stored, because it would not fit into the database columns.
+    '''
+    file_ext = os.path.splitext(secure_filename(filename))[1]
+    if len(file_ext) > MAX_FILE_EXT_LENGTH:
+        return ''
+    return file_ext
+
+
 # Function for compressing and saving podcast file
 def save_and_compress_podcast_file(podcast_file):
     '''
     The code below will save the podcast file that is uploaded.
 
     First a random hex token is generated for the new filename. Then
-    Then, using os.path.splitext(), you can get the file extension of the file.
+    Then, using 'podcast_file_extension()', you can get the file extension of the file.
     The variable 'new_filename' will combine the random hex token which is the new filename
-    with the file extension. Next, the podcast file's path is declared and then the file is saved into
-    that path.
+    with the file extension. The file was already written into 'MEDIA_TEMP_DIRECTORY' and
+    hashed while the request was being read, so it is then put into the blob with that
+    hash by 'acquire_blob_with_file()', or removed if the same file has been uploaded before.
 
-    Once that is complete, the file is then compressed and the filename is
-    returned by this function.
+    Once that is complete, the filename and the blob are returned by this function. The
+    file is compressed afterwards by 'queue_podcast_transcode()' so that the request does
+    not have to wait for it.
     '''
 
     hex_string = secrets.token_hex(16)
-    file_ext = os.path.splitext(secure_filename(podcast_file.filename))[1]
+    file_ext = podcast_file_extension(podcast_file.filename)
     new_filename = hex_string + file_ext
-    podcast_file_path = os.path.join(
-        app.root_path, 'podcast_files', new_filename)
-    podcast_file.save(podcast_file_path)
+    temp_path, sha256, size = save_uploaded_file(
+        podcast_file, app.config['MEDIA_TEMP_DIRECTORY'])
+    blob = acquire_blob_with_file(sha256, size, 'original', temp_path)
 
-    return new_filename
+    return new_filename, blob
+
+
+# Function for creating a podcast once its file has been saved.
+def create_podcast(owner, podcast_title, podcast_description, podcast_filename, blob):
+    '''
+    The code below will create the podcast once its file has been saved into its blob,
+    add it to the home feeds of the owner's followers and queue the file to be compressed
+    in the background. Both the regular upload route and the chunked upload routes use
+    this function.
+    '''
+    created_at = datetime.datetime.utcnow()
+    new_podcast = Podcast(owner=owner, podcast_title=podcast_title, podcast_description=podcast_description,
+                          podcast_file=podcast_filename, blob=blob, created_at=created_at,
+                          trending_score=initial_trending_score(created_at))
+    db.session.add(new_podcast)
+    db.session.flush()
+    fan_out_podcast(new_podcast)
+    queue_podcast_transcode(new_podcast.id)
+    db.session.commit()
+    response_cache.invalidate('listen:first', 'listen:trending', f'user:{owner.id}')
+    return new_podcast
 
 
 # Upload Podcast API route.
 @app.route("/api/upload-podcast", methods=['GET', 'POST'])
+@token_required
 def upload_podcast():
     if request.method == 'GET':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            return jsonify({"message": "Verification successful."})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        return jsonify({"message": "Verification successful."})
 
     elif request.method == 'POST':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            '''
-            The code below will first retrieve the current user by using their user ID that
-            is returned in the response variable. Once the current user has been found,
-            the podcast title is stored in the 'podcast_title' variable and the same thing
-            goes for the description and the podcast file.
-
-            The podcast file is first passed as an argument to another function called
-            'save_and_compress_podcast_file()'. That function will not only save the file but
-            also compress it in order to save space. When it saves the file, the filename will
-            be a hex token. That filename will be returned by the function and then
-            the podcast will be created.
-            '''
-            current_user = User.query.filter_by(id=response[1]).first()
-            podcast_title = request.form['podcastTitle']
-            podcast_description = request.form['podcastDescription']
-            podcast_file = request.files['podcastFile']
-            podcast_filename = save_and_compress_podcast_file(podcast_file)
-            new_podcast = Podcast(owner=current_user, podcast_title=podcast_title,
-                                  podcast_description=podcast_description, podcast_file=podcast_filename)
-            db.session.add(new_podcast)
-            db.session.commit()
-            print("Podcast has been uploaded.")
-            return jsonify({"message": "Verification successful.", "podcastUploaded": True})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        '''
+        The code below will first get the current user that was loaded by the token_required
+        decorator. Once the current user has been found, the podcast title is stored in the 'podcast_title' variable and the same thing
+        goes for the description and the podcast file.
+
+        The podcast file is first passed as an argument to another function called
+        'save_and_compress_podcast_file()'. That function will save the file into its blob.
+        The filename will be a hex token. That filename and the blob will be returned by the
+        function and then the podcast will be created. Once the podcast has been created,
+        it is queued to be compressed in the background in order to save space and bandwidth.
+        '''
+        current_user = g.current_user
+        podcast_title = request.form['podcastTitle']
+        podcast_description = request.form['podcastDescription']
+        podcast_file = request.files['podcastFile']
+        podcast_filename, blob = save_and_compress_podcast_file(podcast_file)
+        create_podcast(current_user, podcast_title,
+                       podcast_description, podcast_filename, blob)
+        print("Podcast has been uploaded.")
+        return jsonify({"message": "Verification successful.", "podcastUploaded": True})
+
+
+'''
+The routes below let the frontend upload a podcast file in chunks instead of in a single
+request. An upload is started with the podcast details and the size of the file, then each
+chunk is sent with the offset that it starts at, and finally the upload is finalized with a
+SHA-256 checksum of the whole file. If the connection drops, the frontend can ask for the
+current offset of the upload and continue from there instead of starting over. The chunks
+are kept in the media storage (see ingest.py), so every request of an upload can be sent
+to a different instance of the app.
+'''
+
+
+# Start Chunked Upload API route.
+@app.route("/api/upload-podcast/init", methods=['POST'])
+@token_required
+def init_podcast_upload():
+    '''
+    The code below will check that the file is not too large and then create an Upload.
+    '''
+    current_user = g.current_user
+    data = request.json['data']
+    file_size = int(data['fileSize'])
+    if file_size <= 0 or file_size > app.config['MAX_PODCAST_FILE_SIZE']:
+        return jsonify({"message": "Verification successful.", "uploadStarted": False, "error": "Invalid file size."})
+    file_ext = podcast_file_extension(data['filename'])
+    upload = Upload(owner=current_user, podcast_title=data['podcastTitle'], podcast_description=data['podcastDescription'],
+                    file_ext=file_ext, total_size=file_size)
+    db.session.add(upload)
+    db.session.commit()
+    return jsonify({"message": "Verification successful.", "uploadStarted": True, "uploadId": upload.public_id, "offset": 0, "chunkSize": app.config['UPLOAD_CHUNK_SIZE']})
+
+
+# Chunked Upload API route.
+@app.route("/api/upload-podcast/<upload_id>", methods=['GET', 'PUT'])
+@token_required
+def podcast_upload_chunk(upload_id):
+    upload = Upload.query.filter_by(
+        public_id=upload_id, owner_id=g.current_user.id).first()
+    if upload == None:
+        return jsonify({"message": "Verification successful.", "uploadExists": False})
+
+    '''
+    A GET request returns the offset that the next chunk has to start at, which is
+    how the frontend resumes an upload after the connection has dropped.
+    '''
+    if request.method == 'GET':
+        return jsonify({"message": "Verification successful.", "uploadExists": True, "offset": upload.received_size, "fileSize": upload.total_size})
+
+    '''
+    A PUT request contains one chunk as the raw request body and the offset that it starts
+    at in the query string. Chunks have to be sent in order, so a chunk is only accepted if
+    its offset is where the previous chunk ended. The chunk is streamed into a temporary
+    file without being held in memory and is then put into the media storage as its own
+    file. If the connection drops halfway through a chunk, nothing is stored and the offset
+    is not moved forward, so the upload resumes from the start of that chunk. No transaction
+    is kept open while the chunk is received and stored.
+    '''
+    offset = request.args.get('offset', type=int)
+    chunk_size = request.content_length
+    if offset != upload.received_size:
+        return jsonify({"message": "Verification successful.", "uploadExists": True, "error": "Invalid offset.", "offset": upload.received_size})
+    if chunk_size == None or chunk_size <= 0 or chunk_size > app.config['UPLOAD_CHUNK_SIZE'] or offset + chunk_size > upload.total_size:
+        return jsonify({"message": "Verification successful.", "uploadExists": True, "error": "Invalid chunk size.", "offset": upload.received_size})
+
+    upload_row_id, public_id = upload.id, upload.public_id
+    db.session.commit()
+    temp_path, bytes_written = save_request_body(
+        app.config['MEDIA_TEMP_DIRECTORY'])
+    try:
+        storage.put(upload_part_key(public_id, offset), temp_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    '''
+    The offset is only moved forward if no other request has moved it in the meantime,
+    so two requests that send the same chunk at the same time cannot both be counted.
+    '''
+    updated = Upload.query.filter_by(id=upload_row_id, received_size=offset).update(
+        {Upload.received_size: offset + bytes_written}, synchronize_session=False)
+    db.session.commit()
+    if not updated:
+        received_size = db.session.query(Upload.received_size).filter_by(
+            id=upload_row_id).scalar()
+        if received_size == None:
+            return jsonify({"message": "Verification successful.", "uploadExists": False})
+        return jsonify({"message": "Verification successful.", "uploadExists": True, "error": "Invalid offset.", "offset": received_size})
+    return jsonify({"message": "Verification successful.", "uploadExists": True, "offset": offset + bytes_written})
+
+
+# Finalize Chunked Upload API route.
+@app.route("/api/upload-podcast/<upload_id>/finalize", methods=['POST'])
+@token_required
+def finalize_podcast_upload(upload_id):
+    current_user = g.current_user
+    upload = Upload.query.filter_by(
+        public_id=upload_id, owner_id=current_user.id).first()
+    if upload == None:
+        return jsonify({"message": "Verification successful.", "uploadExists": False})
+    '''
+    The code below will make sure that every byte has been received, join the chunks back
+    together with 'join_upload_parts()' and check that the SHA-256 checksum of the file
+    matches the checksum that the frontend sent. If it does, the file is put into the blob
+    with that checksum just like a regular upload and the podcast is created. The chunks are
+    removed from storage either way.
+
+    Before the chunks are read, the upload is claimed by deleting its row with a DELETE that
+    only succeeds if every byte has been received, and the deletion is committed. If the
+    upload is finalized twice at the same time, only one request deletes the row and uses
+    the chunks, and the other one is told that the upload does not exist anymore. A file
+    that does not match its checksum cannot be fixed by sending more chunks, so it is
+    removed along with the upload.
+    '''
+    if upload.received_size != upload.total_size:
+        return jsonify({"message": "Verification successful.", "uploadExists": True, "podcastUploaded": False, "error": "Upload is incomplete.", "offset": upload.received_size})
+
+    public_id, total_size = upload.public_id, upload.total_size
+    podcast_filename = secrets.token_hex(16) + upload.file_ext
+    podcast_title = upload.podcast_title
+    podcast_description = upload.podcast_description
+    claimed = Upload.query.filter_by(id=upload.id, received_size=upload.total_size).delete(
+        synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return jsonify({"message": "Verification successful.", "uploadExists": False, "podcastUploaded": False})
+
+    try:
+        temp_path, sha256, size = join_upload_parts(public_id, total_size)
+    finally:
+        storage.delete_tree(upload_prefix(public_id))
+    if sha256 != request.json['data']['checksum'].lower():
+        os.remove(temp_path)
+        return jsonify({"message": "Verification successful.", "uploadExists": False, "podcastUploaded": False, "error": "Checksum does not match."})
+
+    blob = acquire_blob_with_file(sha256, size, 'original', temp_path)
+    create_podcast(current_user, podcast_title,
+                   podcast_description, podcast_filename, blob)
+    print("Podcast has been uploaded.")
+    return jsonify({"message": "Verification successful.", "uploadExists": True, "podcastUploaded": True})
 
 
 # Edit Podcast API Route.
 @app.route("/api/edit-podcast/<podcast_id>", methods=['GET', 'POST'])
+@token_required
 def edit_podcast(podcast_id):
     if request.method == 'GET':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            podcast = Podcast.query.filter_by(id=podcast_id).first()
-            '''
-            The code below will first check if the podcast exists. If it does not, then it will send a podcastExists key with a value of False.
-            If the podcast does exist, it will first check to see if the current user is the owner of the podcast
-            so that they can edit it. If they are, they're able to edit it, if not a podcastOwnerValid key with a value of False is sent
-            and the user is redirected to a 403 page.
-            '''
-            if podcast == None:
-                return jsonify({"message": "Verification successful.", "podcastExists": False})
-            if podcast:
-                if podcast.owner.id == current_user.id:
-                    return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastOwnerValid": True, "podcastTitle": podcast.podcast_title, "podcastDescription": podcast.podcast_description})
-                else:
-                    return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastOwnerValid": False})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        current_user = g.current_user
+        podcast = Podcast.query.filter_by(public_id=podcast_id).first()
+        '''
+        The code below will first check if the podcast exists. If it does not, then it will send a podcastExists key with a value of False.
+        If the podcast does exist, it will first check to see if the current user is the owner of the podcast
+        so that they can edit it. If they are, they're able to edit it, if not a podcastOwnerValid key with a value of False is sent
+        and the user is redirected to a 403 page.
+        '''
+        if podcast == None:
+            return jsonify({"message": "Verification successful.", "podcastExists": False})
+        if podcast:
+            if podcast.owner_id == current_user.id:
+                return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastOwnerValid": True, "podcastTitle": podcast.podcast_title, "podcastDescription": podcast.podcast_description})
+            else:
+                return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastOwnerValid": False})
 
     elif request.method == 'POST':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            podcast = Podcast.query.filter_by(id=podcast_id).first()
-            '''
-            The code below will check to see if the podcast being updated actually exists or not.
-            If it does not, then a podcastExists key with a value of False will be sent to the frontend
-            and the user will be redirected to a 404 page.
-            If a podcast does exist, then the code will check if the podcast owner is the current user in
-            order to update the podcast. If the current user is the podcast owner, then the podcast will be
-            updated. Otherwise, a podcastOwnerValid key with a value of False will be sent to the frontend, and the
-            user will be redirected to a 403 page.
-            '''
-            if podcast == None:
-                return jsonify({"message": "Verification successful.", "podcastExists": False})
-            if podcast:
-                if podcast.owner.id == current_user.id:
-                    podcast_title = request.json['podcastTitle']
-                    podcast_description = request.json['podcastDescription']
-                    podcast.podcast_title = podcast_title
-                    podcast.podcast_description = podcast_description
-                    db.session.commit()
-                    return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastOwnerValid": True, 'podcastUpdated': True})
-                else:
-                    return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastOwnerValid": False, 'podcastUpdated': False})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        current_user = g.current_user
+        podcast = Podcast.query.filter_by(public_id=podcast_id).first()
+        '''
+        The code below will check to see if the podcast being updated actually exists or not.
+        If it does not, then a podcastExists key with a value of False will be sent to the frontend
+        and the user will be redirected to a 404 page.
+        If a podcast does exist, then the code will check if the podcast owner is the current user in
+        order to update the podcast. If the current user is the podcast owner, then the podcast will be
+        updated. Otherwise, a podcastOwnerValid key with a value of False will be sent to the frontend, and the
+        user will be redirected to a 403 page.
+        '''
+        if podcast == None:
+            return jsonify({"message": "Verification successful.", "podcastExists": False})
+        if podcast:
+            if podcast.owner_id == current_user.id:
+                podcast_title = request.json['podcastTitle']
+                podcast_description = request.json['podcastDescription']
+                podcast.podcast_title = podcast_title
+                podcast.podcast_description = podcast_description
+                db.session.commit()
+                response_cache.invalidate(f'podcast:{podcast.id}')
+                return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastOwnerValid": True, 'podcastUpdated': True})
+            else:
+                return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastOwnerValid": False, 'podcastUpdated': False})
 
 
 # Delete Podcast API Route.
 @app.route("/api/delete-podcast/<podcast_id>", methods=['POST'])
+@token_required
 def delete_podcast(podcast_id):
     '''
     The code below is used to handle deleting podcasts.
     '''
     if request.method == 'POST':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            podcast = Podcast.query.filter_by(id=podcast_id).first()
-            '''
-            The podcast will first check if the podcast exists. If it does not, then it will send a
-            podcastExists key with a value of False. If the podcast does exist, it will first check to see podcast
-            owner is the current user in order to delete the podcast. If the current user is the podcast owner, the
-            podcast will be deleted. Otherwise, a podcastOwnerValid key with a value of False will be sent to the frontend.
-            '''
-            if podcast == None:
-                return jsonify({"message": "Verification successful.", "podcastExists": False})
-            if podcast:
-                if podcast.owner.id == current_user.id:
-                    if os.path.exists(f'podcast_files/{podcast.podcast_file}'):
-                        os.remove(f'podcast_files/{podcast.podcast_file}')
-                        db.session.delete(podcast)
-                        db.session.commit()
-                        print("The podcast, likes, and comments have been deleted.")
-                        return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastOwnerValid": True, 'podcastDeleted': True})
+        current_user = g.current_user
+        podcast = Podcast.query.filter_by(public_id=podcast_id).first()
+        '''
+        The podcast will first check if the podcast exists. If it does not, then it will send a
+        podcastExists key with a value of False. If the podcast does exist, it will first check to see podcast
+        owner is the current user in order to delete the podcast. If the current user is the podcast owner, the
+        podcast will be deleted. Otherwise, a podcastOwnerValid key with a value of False will be sent to the frontend.
+        '''
+        if podcast == None:
+            return jsonify({"message": "Verification successful.", "podcastExists": False})
+        if podcast:
+            if podcast.owner_id == current_user.id:
+                release_blob(podcast.blob)
+                deleted_podcast_id = podcast.id
+                remove_podcasts_from_timelines([deleted_podcast_id])
+                db.session.delete(podcast)
+                db.session.commit()
+                response_cache.invalidate(f'podcast:{deleted_podcast_id}')
+                print("The podcast, likes, and comments have been deleted.")
+                return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastOwnerValid": True, 'podcastDeleted': True})
 
 
 # Comment on Podcast API Route.
 @app.route('/api/comment/<podcast_id>', methods=['GET', 'POST'])
+@token_required
 def comment(podcast_id):
     '''
     The code below is used to allow users to comment on specific podcasts.
     '''
     if request.method == 'GET':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            podcast = Podcast.query.filter_by(id=podcast_id).first()
-            '''
-            The code below will first check if the podcast exists. If it does not, then it will send a podcastExists key with a value of False.
-            If the podcast does exist, it will send a podcastExists key with a value of True along with some info regarding the podcast (title).
-            '''
-            if podcast == None:
-                return jsonify({"message": "Verification successful.", "podcastExists": False})
-            if podcast:
-                return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastTitle": podcast.podcast_title, "podcastOwnerUsername": podcast.owner.username})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        podcast = Podcast.query.filter_by(public_id=podcast_id).first()
+        '''
+        The code below will first check if the podcast exists. If it does not, then it will send a podcastExists key with a value of False.
+        If the podcast does exist, it will send a podcastExists key with a value of True along with some info regarding the podcast (title).
+        '''
+        if podcast == None:
+            return jsonify({"message": "Verification successful.", "podcastExists": False})
+        if podcast:
+            return jsonify({"message": "Verification successful.", "podcastExists": True, "podcastTitle": podcast.podcast_title, "podcastOwnerUsername": podcast.owner.username})
 
     elif request.method == 'POST':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            podcast = Podcast.query.filter_by(id=podcast_id).first()
-            '''
-            The code below will first check to see if the podcast exists. If it does not exist,
-            then an error message is sent. If it does exist, then the code will add the comment to the database.
-            '''
-            if podcast == None:
-                return jsonify({"message": "Verification successful.", "podcastExists": False})
-            if podcast:
-                comment = request.json['comment']
-                new_comment = Comment(
-                    comment=comment, podcast=podcast, commenter=current_user)
-                db.session.add(new_comment)
-                db.session.commit()
-                return jsonify({"message": "Verification successful.", "podcastExists": True, "commentAdded": True})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        current_user = g.current_user
+        podcast = Podcast.query.filter_by(public_id=podcast_id).first()
+        '''
+        The code below will first check to see if the podcast exists. If it does not exist,
+        then an error message is sent. If it does exist, then the code will add the comment to the database.
+        '''
+        if podcast == None:
+            return jsonify({"message": "Verification successful.", "podcastExists": False})
+        if podcast:
+            comment = request.json['comment']
+            new_comment = Comment(
+                comment=comment, podcast=podcast, commenter=current_user)
+            db.session.add(new_comment)
+            Podcast.query.filter_by(id=podcast.id).update(
+                {Podcast.comment_count: Podcast.comment_count + 1}, synchronize_session=False)
+            db.session.flush()
+            add_trending_event(
+                podcast, app.config['TRENDING_COMMENT_WEIGHT'], new_comment.created_at)
+            db.session.commit()
+            response_cache.invalidate(f'podcast:{podcast.id}', 'listen:trending')
+            return jsonify({"message": "Verification successful.", "podcastExists": True, "commentAdded": True})
 
 
 # Delete Comment API Route.
 @app.route('/api/delete-comment/<comment_id>', methods=['POST'])
+@token_required
 def delete_comment(comment_id):
     if request.method == "POST":
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            comment = Comment.query.filter_by(id=comment_id).first()
-            '''
-            The code below will first check to see if the comment exists. If it does not exist,
-            then an error message is sent. If it does exist, then the code will delete the comment.
-            '''
-            if comment == None:
-                return jsonify({"message": "Verification successful.", "commentExists": False})
-            if comment:
-                if comment.commenter.id == current_user.id:
-                    db.session.delete(comment)
-                    db.session.commit()
-                    return jsonify({"message": "Verification successful.", "commentExists": True, "commentDeleted": True, "commentOwnerValid": True})
-                if comment.commenter.id != current_user.id:
-                    return jsonify({"message": "Verification successful.", "commentExists": True, "commentDeleted": False, "commentOwnerValid": False})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        current_user = g.current_user
+        comment = Comment.query.filter_by(public_id=comment_id).first()
+        '''
+        The code below will first check to see if the comment exists. If it does not exist,
+        then an error message is sent. If it does exist, then the code will delete the comment.
+        '''
+        if comment == None:
+            return jsonify({"message": "Verification successful.", "commentExists": False})
+        if comment:
+            if comment.commenter_id == current_user.id:
+                Podcast.query.filter_by(id=comment.podcast_id).update(
+                    {Podcast.comment_count: Podcast.comment_count - 1}, synchronize_session=False)
+                remove_trending_event(
+                    comment.podcast, app.config['TRENDING_COMMENT_WEIGHT'], comment.created_at)
+                db.session.delete(comment)
+                db.session.commit()
+                response_cache.invalidate(f'podcast:{comment.podcast_id}', 'listen:trending')
+                return jsonify({"message": "Verification successful.", "commentExists": True, "commentDeleted": True, "commentOwnerValid": True})
+            if comment.commenter_id != current_user.id:
+                return jsonify({"message": "Verification successful.", "commentExists": True, "commentDeleted": False, "commentOwnerValid": False})
 
 
 # View comments of a Podcast API Route.
 @app.route('/api/comments/<podcast_id>', methods=['GET'])
+@token_required
 def comments(podcast_id):
     '''
     The code below is responsible for displaying the comments of a
-    specific podcast.
+    specific podcast, newest first.
     '''
     if request.method == 'GET':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            podcast = Podcast.query.filter_by(id=podcast_id).first()
+        current_user = g.current_user
+        podcast_row = db.session.query(Podcast, User.username).join(
+            User, Podcast.owner_id == User.id).filter(Podcast.public_id == podcast_id).first()
+        '''
+        The code below will first check to see if the podcast exists. If it does not, then it will send a podcastExists key with a value of False.
+        If the podcast does exist, it will send a podcastExists key with a value of True along with some info regarding the podcast as well as the comments.
+        '''
+        if podcast_row == None:
+            return jsonify({"message": "Verification successful.", "podcastExists": False})
+        if podcast_row:
+            podcast, owner_username = podcast_row
             '''
-            The code below will first check to see if the podcast exists. If it does not, then it will send a podcastExists key with a value of False.
-            If the podcast does exist, it will send a podcastExists key with a value of True along with some info regarding the podcast as well as the comments.
+            The username of each commenter is joined into the same query as the comments, so the
+            comments are loaded in one query instead of one more query per comment.
+
+            If a 'limit' is given in the query string, only that many comments are sent along
+            with a 'nextCursor'. Passing that cursor back as 'before' loads the comments that
+            come after them. Like the podcast listings, the cursor is the (created_at, id) of the
+            last comment that was sent, which is read from the index on
+            (podcast_id, created_at, id). Without a 'limit', every comment is sent.
             '''
-            if podcast == None:
-                return jsonify({"message": "Verification successful.", "podcastExists": False})
-            if podcast:
-                '''
-                First, get all the comments. Then, loop through the comments and get the commenter's username.
-                Then, create a dictionary with the comment and commenter's username. Next, append the dictionary to
-                the comments_json list. Finally, return that list to the frontend.
-                '''
-                comments = Comment.query.filter_by(podcast=podcast).all()
-                comments_json = []
-                for comment in comments:
-                    comment_dict = {"comment": comment.comment,
-                                    "commenter": comment.commenter.username, "commentId": comment.id}
-                    comments_json.append(comment_dict)
-                return jsonify({"message": "Verification successful.", "podcastExists": True, "comments": comments_json, "podcastTitle": podcast.podcast_title, "podcastOwnerUsername": podcast.owner.username, "currentUserUsername": current_user.username})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+            query = db.session.query(Comment, User.username).join(User, Comment.commenter_id == User.id).filter(
+                Comment.podcast_id == podcast.id).order_by(Comment.created_at.desc(), Comment.id.desc())
+            before = request.args.get('before')
+            if before:
+                created_at, comment_id = decode_cursor(before)
+                query = query.filter(or_(Comment.created_at < created_at, and_(
+                    Comment.created_at == created_at, Comment.id < comment_id)))
+            limit = request.args.get('limit', type=int)
+            next_cursor = None
+            if limit is None:
+                comments = query.all()
+            else:
+                limit = max(1, min(limit, MAX_PAGE_SIZE))
+                comments = query.limit(limit + 1).all()
+                if len(comments) > limit:
+                    comments = comments[:limit]
+                    last_comment = comments[-1][0]
+                    next_cursor = encode_cursor(
+                        last_comment.created_at, last_comment.id)
+            comments_json = []
+            for comment, commenter_username in comments:
+                comment_dict = {"comment": comment.comment,
+                                "commenter": commenter_username, "commentId": comment.public_id}
+                comments_json.append(comment_dict)
+            return jsonify({"message": "Verification successful.", "podcastExists": True, "comments": comments_json, "nextCursor": next_cursor, "podcastTitle": podcast.podcast_title, "podcastOwnerUsername": owner_username, "currentUserUsername": current_user.username})
 
 
 # Podcast Listening API Route.
 @app.route("/api/listen", methods=['GET'])
+@token_required
 def listen():
     '''
     The code below will query all the podcasts on the PodMaster platform
     and will send those podcasts to the frontend for them to be displayed on the
-    Listen page.
+    Listen page. The podcasts are ordered from newest to oldest, or by their trending
+    score if the 'sort' query string argument is 'trending'.
     '''
     if request.method == 'GET':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            podcasts = Podcast.query.all()
-            podcasts_json = []
-            for podcast in podcasts:
-                if podcast.owner.deactivated == False:
-                    podcast_dict = {"podcast_owner_username": podcast.owner.username, "podcast_title": podcast.podcast_title, "podcast_description": podcast.podcast_description,
-                                    "podcast_id": podcast.id, "likes": podcast.likes.count(), "comments": podcast.comments.count(), "currentUserLikedPodcast": current_user.has_liked_podcast(podcast)}
-                    podcasts_json.append(podcast_dict)
-                else:
-                    None
-            return jsonify({"message": "Verification successful.", "podcasts": podcasts_json})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        current_user = g.current_user
+        '''
+        Podcasts that belong to deactivated accounts are filtered out by the query itself
+        instead of being skipped one at a time.
+
+        Every user sees the same page, so the page is built once and kept in 'response_cache'
+        until one of the podcasts on it changes. A new podcast can only show up on the first
+        page because the other pages start after the podcast in their cursor.
+
+        In the trending order, a new podcast can show up on any page and a like or comment
+        can move a podcast onto a page that it is not on yet, so every trending page is
+        removed from the cache when a podcast is uploaded and when a like or comment is added
+        or removed.
+        '''
+        sort = request.args.get('sort', 'newest')
+        if sort not in ('newest', 'trending'):
+            abort(400)
+        cursor = request.args.get('cursor')
+        cache_key = ('listen', sort, request.args.get('limit'), cursor)
+        page = response_cache.get(cache_key)
+        if page == None:
+            paginate = paginate_trending_podcasts if sort == 'trending' else paginate_podcasts
+            podcasts, next_cursor = paginate(podcast_feed_query().filter(
+                User.deactivated == False))
+            page = {"podcasts": podcasts_to_json(podcasts), "nextCursor": next_cursor}
+            tags = podcast_listing_tags(podcasts) | {'listen'}
+            if sort == 'trending':
+                tags.add('listen:trending')
+            elif not cursor:
+                tags.add('listen:first')
+            response_cache.set(cache_key, page, tags=tags)
+        podcasts_json = add_viewer_flags(page['podcasts'], current_user)
+        return jsonify({"message": "Verification successful.", "podcasts": podcasts_json, "nextCursor": page['nextCursor']})
+
+
+# Home Feed API Route.
+@app.route("/api/feed", methods=['GET'])
+@token_required
+def feed():
+    '''
+    The code below will send a page of the current user's home feed, which is made up of
+    the podcasts of the users that they follow, newest first. The feed is read by
+    'read_timeline()' and the podcasts on the page are then loaded in one query. Podcasts of
+    deactivated users are left out of the page, but the cursor still moves past them.
+    '''
+    if request.method == 'GET':
+        current_user = g.current_user
+        limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        entries, has_more = read_timeline(
+            current_user, limit, decode_cursor(cursor) if cursor else None)
+        podcasts = podcast_feed_query().filter(Podcast.id.in_([podcast_id for _, podcast_id in entries]), User.deactivated == False).order_by(
+            Podcast.created_at.desc(), Podcast.id.desc()).all()
+        next_cursor = encode_cursor(*entries[-1]) if has_more else None
+        podcasts_json = add_viewer_flags(
+            podcasts_to_json(podcasts), current_user)
+        return jsonify({"message": "Verification successful.", "podcasts": podcasts_json, "nextCursor": next_cursor})
+
+
+'''
+The 'podcast_search' full-text index is not a model, so it is described here with just
+the column that the search query needs. The rowid of each row is the id of its podcast.
+'''
+podcast_search = table('podcast_search', column('rowid'))
+
+
+def podcast_search_words(search_terms):
+    '''
+    The code below will find the words in what the user typed and whether each one is
+    matched as a prefix. Only the words are kept, so characters that mean something to the
+    full-text query syntax (like quotes, brackets or 'OR') are never parsed as part of the
+    query. The last word is matched as a prefix so that results show up while the user is
+    still typing it, and any other word that ends with '*' is matched as a prefix too.
+    '''
+    words = re.findall(r'(\w+)(\*?)', search_terms)
+    return [(word, bool(star) or index == len(words) - 1) for index, (word, star) in enumerate(words)]
+
+
+def podcast_search_match(search_terms):
+    '''The FTS5 query for what the user typed. Each word is quoted and every word has to match.'''
+    return ' '.join(f'"{word}"*' if prefix else f'"{word}"' for word, prefix in podcast_search_words(search_terms))
+
+
+def podcast_search_tsquery(search_terms):
+    '''The PostgreSQL text search query for what the user typed. Every word has to match.'''
+    return ' & '.join(f'{word}:*' if prefix else word for word, prefix in podcast_search_words(search_terms))
+
+
+# Podcast Search API Route.
+@app.route("/api/search", methods=['GET'])
+@token_required
+def search():
+    '''
+    The code below will search the title, description and owner's username of every
+    podcast for the words in the 'q' query string argument and send back the podcasts
+    that match, best match first.
+
+    On SQLite, the podcasts are ranked with BM25, where a match in the title counts ten
+    times as much as a match in the description and a match in the username counts five
+    times as much. Other databases do not have the FTS5 index, so on PostgreSQL the
+    same three columns are weighted in the same order and ranked with ts_rank(). The score
+    is negated so that, like BM25, the best match has the lowest score. Results are
+    paginated with a cursor in the same way as the other listings, using the score and id
+    of the last podcast instead of its creation time and id.
+    '''
+    if request.method == 'GET':
+        current_user = g.current_user
+        search_terms = request.args.get('q', '')
+        if not podcast_search_words(search_terms):
+            return jsonify({"message": "Verification successful.", "podcasts": [], "nextCursor": None})
+
+        if db.engine.dialect.name == 'sqlite':
+            search_index = literal_column('podcast_search')
+            score = func.bm25(search_index, 10.0, 1.0, 5.0)
+            query = podcast_feed_query().add_columns(score).join(
+                podcast_search, podcast_search.c.rowid == Podcast.id).filter(
+                search_index.op('MATCH')(podcast_search_match(search_terms)), User.deactivated == False)
+        else:
+            document = func.setweight(func.to_tsvector('simple', Podcast.podcast_title), 'A').op('||')(
+                func.setweight(func.to_tsvector('simple', User.username), 'B')).op('||')(
+                func.setweight(func.to_tsvector('simple', Podcast.podcast_description), 'C'))
+            tsquery = func.to_tsquery('simple', podcast_search_tsquery(search_terms))
+            score = cast(-func.ts_rank(literal_column("'{0, 0.1, 0.5, 1}'::real[]"), document, tsquery), Float)
+            query = podcast_feed_query().add_columns(score).filter(
+                document.op('@@')(tsquery), User.deactivated == False)
+        cursor = request.args.get('cursor')
+        if cursor:
+            last_score, last_podcast_id = decode_score_cursor(cursor)
+            query = query.filter(or_(score > last_score, and_(
+                score == last_score, Podcast.id > last_podcast_id)))
+        limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        rows = query.order_by(score, Podcast.id).limit(limit + 1).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_score_cursor(rows[-1][-1], rows[-1][0].id)
+        podcasts_json = add_viewer_flags(podcasts_to_json(
+            [row[:-1] for row in rows]), current_user)
+        return jsonify({"message": "Verification successful.", "podcasts": podcasts_json, "nextCursor": next_cursor})
 
 
 # User Profile API Route.
 @app.route("/api/user/<username>", methods=['GET', 'POST'])
+@token_required
 def user(username):
     if request.method == "GET":
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            '''
-            The code below will first query to see if the requested user
-            profile exists or not. If it does not, it will send a
-            key called userValid with a value of False and the user will be redirected
-            to a 404 page.
-            If the user does exist, then it will send the podcasts that that user has created
-            and also send information around that user such as the username, full name, followers, etc.
-            '''
+        '''
+        The code below will first query to see if the requested user
+        profile exists or not. If it does not, it will send a
+        key called userValid with a value of False and the user will be redirected
+        to a 404 page.
+        If the user does exist, then it will send the podcasts that that user has created
+        and also send information around that user such as the username, full name, followers, etc.
+        '''
+        current_user = g.current_user
+        '''
+        The profile (apart from whether the current user is following the user and has liked
+        each podcast) is the same for everyone, so it is kept in 'response_cache' until the
+        user or one of the podcasts on the page changes.
+        '''
+        cache_key = ('user', username, request.args.get('limit'),
+                     request.args.get('cursor'))
+        cached_profile = response_cache.get(cache_key)
+        if cached_profile == None:
             user = User.query.filter_by(username=username).first()
             if user == None or user.deactivated == True:
                 return jsonify({"message": "Verification successful.", "userValid": False})
-            if user and user.deactivated == False:
-                current_user = User.query.filter_by(id=response[1]).first()
-                podcasts = Podcast.query.filter_by(owner=user).all()
-                podcasts_json = []
-                is_following = current_user.is_following_user(user)
-                for podcast in podcasts:
-                    podcast_dict = {"podcast_owner_username": podcast.owner.username, "podcast_title": podcast.podcast_title, "podcast_description": podcast.podcast_description,
-                                    "podcast_id": podcast.id, "likes": podcast.likes.count(), "comments": podcast.comments.count(), "currentUserLikedPodcast": current_user.has_liked_podcast(podcast)}
-                    podcasts_json.append(podcast_dict)
-                return jsonify({"message": "Verification successful.", "userValid": True, "currentUserUsername": current_user.username, "fullName": f'{user.first_name} {user.last_name}', "username": user.username, "followers": user.followee.count(), "following": user.follower.count(), "currentUserFollowingUser": is_following, "podcasts": podcasts_json})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+            podcasts, next_cursor = paginate_podcasts(podcast_feed_query().filter(
+                Podcast.owner_id == user.id))
+            profile = {"fullName": f'{user.first_name} {user.last_name}', "username": user.username, "followers": user.followers_count, "following": user.following_count,
+                       "profilePictureUrl": profile_picture_url(user), "podcasts": podcasts_to_json(podcasts), "nextCursor": next_cursor}
+            cached_profile = (user.id, profile)
+            response_cache.set(cache_key, cached_profile, tags=podcast_listing_tags(
+                podcasts) | {f'user:{user.id}'})
+        user_id, profile = cached_profile
+        is_following = db.session.query(Follow.query.filter_by(
+            follower_id=current_user.id, followee_id=user_id).exists()).scalar()
+        return jsonify(dict(profile, message="Verification successful.", userValid=True, currentUserUsername=current_user.username,
+                            currentUserFollowingUser=is_following, podcasts=add_viewer_flags(profile['podcasts'], current_user)))
 
 
 # Follow/Unfollow API Route.
 @app.route("/api/<action>/user", methods=['POST'])
+@token_required
 def follow_unfollow(action):
     if request.method == 'POST':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
+        '''
+        The code below will handle following and unfollowing users.
+        It will first query the user that was given from the request and
+        the current user. Once it has done that, it will check to see if the current
+        user is following the user. If they're following the user and the action is to unfollow,
+        the user and the action is to follow, then it will add the user to the current user's following list.
+        If it's not a valid action, it will return an error.
+        '''
+        user_username = request.json['userUsername']
+        current_user = g.current_user
+        user = User.query.filter_by(username=user_username).first()
+        if user:
+            if user.id == current_user.id:
+                return jsonify({"message": "Verification successful.", "userValid": True, "error": "You cannot follow yourself."})
+            if action != "follow" and action != "unfollow":
+                return jsonify({"message": "Verification successful.", "userValid": True, "error": "Invalid action."})
             '''
-            The code below will handle following and unfollowing users.
-            It will first query the user that was given from the request and
-            the current user. Once it has done that, it will check to see if the current
-            user is following the user. If they're following the user and the action is to unfollow,
-            the user and the action is to follow, then it will add the user to the current user's following list.
-            If it's not a valid action, it will return an error.
+            The follow (if there is one) is loaded once and is used both to check whether the
+            current user is following the user and to remove the follow.
             '''
-            user_username = request.json['userUsername']
-            current_user = User.query.filter_by(id=response[1]).first()
-            if current_user:
-                user = User.query.filter_by(username=user_username).first()
-                if user:
-                    if user.id == current_user.id:
-                        return jsonify({"message": "Verification successful.", "userValid": True, "error": "You cannot follow yourself."})
-                    if current_user.is_following_user(user) and action == "unfollow":
-                        follow_object = Follow.query.filter_by(
-                            follower=current_user, followee=user).first()
-                        db.session.delete(follow_object)
-                        db.session.commit()
-                        return jsonify({'message': 'Verification successful.', "userValid": True, 'following': False})
-                    elif not current_user.is_following_user(user) and action == "follow":
-                        new_follow = Follow(
-                            follower=current_user, followee=user)
-                        db.session.add(new_follow)
-                        db.session.commit()
-                        return jsonify({'message': 'Verification successful.', "userValid": True, 'following': True})
-                    elif (current_user.is_following_user(user) and action == "follow") or (not current_user.is_following_user(user) and action == "unfollow"):
-                        return jsonify({"message": "Verification successful.", "userValid": True, "error": "Cannot do that."})
-                    elif action != "follow" or action != "unfollow":
-                        return jsonify({"message": "Verification successful.", "userValid": True, "error": "Invalid action."})
-                else:
-                    return jsonify({"message": "Verification successful.", "userValid": False})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+            follow_object = Follow.query.filter_by(
+                follower_id=current_user.id, followee_id=user.id).first()
+            if follow_object != None and action == "unfollow":
+                db.session.delete(follow_object)
+                remove_followee_from_timeline(current_user, user)
+                User.query.filter_by(id=user.id).update(
+                    {User.followers_count: User.followers_count - 1}, synchronize_session=False)
+                User.query.filter_by(id=current_user.id).update(
+                    {User.following_count: User.following_count - 1}, synchronize_session=False)
+                db.session.commit()
+                response_cache.invalidate(
+                    f'user:{user.id}', f'user:{current_user.id}')
+                return jsonify({'message': 'Verification successful.', "userValid": True, 'following': False})
+            elif follow_object == None and action == "follow":
+                '''
+                If the same follow is sent twice at the same time, both requests can get past
+                the check above. The unique index on the Follow table will then reject the
+                second one and its counter updates are rolled back with it.
+                '''
+                try:
+                    new_follow = Follow(
+                        follower=current_user, followee=user)
+                    db.session.add(new_follow)
+                    add_followee_to_timeline(current_user, user)
+                    User.query.filter_by(id=user.id).update(
+                        {User.followers_count: User.followers_count + 1}, synchronize_session=False)
+                    User.query.filter_by(id=current_user.id).update(
+                        {User.following_count: User.following_count + 1}, synchronize_session=False)
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+                    return jsonify({"message": "Verification successful.", "userValid": True, "error": "Cannot do that."})
+                response_cache.invalidate(
+                    f'user:{user.id}', f'user:{current_user.id}')
+                return jsonify({'message': 'Verification successful.', "userValid": True, 'following': True})
+            else:
+                return jsonify({"message": "Verification successful.", "userValid": True, "error": "Cannot do that."})
+        else:
+            return jsonify({"message": "Verification successful.", "userValid": False})
 
 
 # Like/Unlike API Route
 @app.route("/api/<action>/podcast", methods=['POST'])
+@token_required
 def like_unlike(action):
     if request.method == "POST":
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            '''
-            The code below will handle liking and unliking podcasts.
-            It will first query the post that was given from the request and
-            the current user. Once it has done that, it will check to see if the current
-            user has already liked the podcast. If they have and the action is to unlike, then the
-            like is removed. If the action was to like and the user has not liked the podcast, then it wil
-            add the like to the podcast. If the action was not a valid action, it will return an error.
-            '''
-            current_user = User.query.filter_by(id=response[1]).first()
-            if current_user:
-                podcast_id = request.json['podcastId']
-                podcast = Podcast.query.filter_by(id=podcast_id).first()
-                if podcast:
-                    if current_user.has_liked_podcast(podcast) and action == "unlike":
-                        like_object = Like.query.filter_by(
-                            liker=current_user, podcast=podcast).first()
-                        db.session.delete(like_object)
-                        db.session.commit()
-                        return jsonify({'message': 'Verification successful.', "podcastValid": True, 'liked': False})
-                    elif not current_user.has_liked_podcast(podcast) and action == "like":
-                        new_like = Like(liker=current_user, podcast=podcast)
-                        db.session.add(new_like)
-                        db.session.commit()
-                        return jsonify({'message': 'Verification successful.', "podcastValid": True, 'liked': True})
-                    elif (current_user.has_liked_podcast(podcast) and action == "like") or (not current_user.has_liked_podcast(podcast) and action == "unlike"):
-                        return jsonify({"message": "Verification successful.", "podcastValid": True, "error": "Cannot do that."})
-                    elif action != "like" or action != "unlike":
-                        return jsonify({"message": "Verification successful.", "podcastValid": True, "error": "Invalid action."})
-                else:
-                    return jsonify({"message": "Verification successful.", "podcastValid": False})
+        '''
+        The code below will handle liking and unliking podcasts.
+        It will first query the post that was given from the request and
+        the current user. Once it has done that, it will check to see if the current
+        user has already liked the podcast. If they have and the action is to unlike, then the
+        like is removed. If the action was to like and the user has not liked the podcast, then it wil
+        add the like to the podcast. If the action was not a valid action, it will return an error.
+        '''
+        current_user = g.current_user
+        podcast_id = request.json['podcastId']
+        podcast = Podcast.query.filter_by(public_id=podcast_id).first()
+        if podcast:
+            if action != "like" and action != "unlike":
+                return jsonify({"message": "Verification successful.", "podcastValid": True, "error": "Invalid action."})
+            # Like follows, the like is loaded once for both the check and the removal.
+            like_object = Like.query.filter_by(
+                liker_id=current_user.id, podcast_id=podcast.id).first()
+            if like_object != None and action == "unlike":
+                db.session.delete(like_object)
+                Podcast.query.filter_by(id=podcast.id).update(
+                    {Podcast.like_count: Podcast.like_count - 1}, synchronize_session=False)
+                remove_trending_event(
+                    podcast, app.config['TRENDING_LIKE_WEIGHT'], like_object.created_at)
+                db.session.commit()
+                response_cache.invalidate(f'podcast:{podcast.id}', 'listen:trending')
+                return jsonify({'message': 'Verification successful.', "podcastValid": True, 'liked': False})
+            elif like_object == None and action == "like":
+                # Duplicate likes are rejected by the unique index, just like follows.
+                try:
+                    new_like = Like(liker=current_user, podcast=podcast)
+                    db.session.add(new_like)
+                    Podcast.query.filter_by(id=podcast.id).update(
+                        {Podcast.like_count: Podcast.like_count + 1}, synchronize_session=False)
+                    db.session.flush()
+                    add_trending_event(
+                        podcast, app.config['TRENDING_LIKE_WEIGHT'], new_like.created_at)
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+                    return jsonify({"message": "Verification successful.", "podcastValid": True, "error": "Cannot do that."})
+                response_cache.invalidate(f'podcast:{podcast.id}', 'listen:trending')
+                return jsonify({'message': 'Verification successful.', "podcastValid": True, 'liked': True})
+            else:
+                return jsonify({"message": "Verification successful.", "podcastValid": True, "error": "Cannot do that."})
+        else:
+            return jsonify({"message": "Verification successful.", "podcastValid": False})
+
+
+# Relationships API Route.
+@app.route("/api/relationships", methods=['POST'])
+@token_required
+def relationships():
+    '''
+    The code below will send back which of the podcasts in the 'podcastIds' list the
+    current user has liked and which of the users in the 'usernames' list they are
+    following. Either list can be left out. Pages that show many podcasts or users can
+    use this to get the state of every like and follow button in one request, instead of
+    asking about each podcast or user separately. A body that is missing or is not a JSON
+    object is rejected with a 400 error.
+    '''
+    if request.method == 'POST':
+        current_user = g.current_user
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        podcast_ids = body.get('podcastIds', [])
+        usernames = body.get('usernames', [])
+        for values in (podcast_ids, usernames):
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                abort(400)
+        liked_podcast_ids = current_user.liked_podcast_ids(podcast_ids)
+        followed_usernames = current_user.followed_usernames(usernames)
+        return jsonify({"message": "Verification successful.", "likedPodcastIds": [podcast_id for podcast_id in podcast_ids if podcast_id in liked_podcast_ids],
+                        "followingUsernames": [username for username in usernames if username in followed_usernames]})
 
 
 # Account API route.
 @app.route("/api/account", methods=['GET', 'POST'])
+@token_required
 def account():
     if request.method == "GET":
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            user = User.query.filter_by(id=response[1]).first()
-            return jsonify({"message": "Verification successful.", "userData": {
-                "firstName": user.first_name,
-                "lastName": user.last_name,
-                "username": user.username,
-                "email": user.email
-            }})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        user = g.current_user
+        return jsonify({"message": "Verification successful.", "userData": {
+            "firstName": user.first_name,
+            "lastName": user.last_name,
+            "username": user.username,
+            "email": user.email,
+            "profilePictureUrl": profile_picture_url(user)
+        }})
 
     elif request.method == 'POST':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            username_valid = False
-            email_valid = False
-            first_name = request.json['data']['firstName']
-            last_name = request.json['data']['lastName']
-            username = request.json['data']['username']
-            email = request.json['data']['email']
-            '''
-            The code below will check if there is any updates that are being made to the current
-            user's email or username. If there are any updates being made, the code will
-            first query to see if there is an email or username that already exists. If 
-            there is no email or username that exists, then the username_valid and email_valid
-            variables will be set to True, otherwise they will remain false.
-
-            If the user's email or user's username remains the same, then the variables will be
-            set to True.
-            '''
-            if current_user.username != username:
-                username_exists = User.query.filter_by(
-                    username=username).first()
-                if username_exists == None:
-                    username_valid = True
-                elif username_exists:
-                    username_valid = False
-            else:
+        current_user = g.current_user
+        username_valid = False
+        email_valid = False
+        first_name = request.json['data']['firstName']
+        last_name = request.json['data']['lastName']
+        username = request.json['data']['username']
+        email = request.json['data']['email']
+        '''
+        The code below will check if there is any updates that are being made to the current
+        user's email or username. If there are any updates being made, the code will
+        first query to see if there is an email or username that already exists. If 
+        there is no email or username that exists, then the username_valid and email_valid
+        variables will be set to True, otherwise they will remain false.
+
+        If the user's email or user's username remains the same, then the variables will be
+        set to True.
+        '''
+        if current_user.username != username:
+            username_exists = User.query.filter_by(
+                username=username).first()
+            if username_exists == None:
                 username_valid = True
-
-            if current_user.email != email:
-                email_exists = User.query.filter_by(email=email).first()
-                if email_exists == None:
-                    email_valid = True
-                elif email_exists:
-                    email_valid = False
-            else:
+            elif username_exists:
+                username_valid = False
+        else:
+            username_valid = True
+
+        if current_user.email != email:
+            email_exists = User.query.filter_by(email=email).first()
+            if email_exists == None:
                 email_valid = True
-            '''
-            The code below will check if the username_valid and email_valid variables are True,
-            if they are true, then it's going to update the user's account settings.
-
-            If not, then it will send an error message to the frontend stating the that
-            the username or email already exists.
-            '''
-            if username_valid and email_valid:
-                current_user.first_name = first_name
-                current_user.last_name = last_name
-                current_user.username = username
-                current_user.email = email
-                db.session.commit()
-                return jsonify({"message": "Verification successful.", "accountUpdated": True})
+            elif email_exists:
+                email_valid = False
+        else:
+            email_valid = True
+        '''
+        The code below will check if the username_valid and email_valid variables are True,
+        if they are true, then it's going to update the user's account settings.
 
-            if not username_valid or not email_valid:
-                return jsonify({"message": "Verification successful.", "accountUpdated": False, "error": "Username or email belongs to another user."})
+        If not, then it will send an error message to the frontend stating the that
+        the username or email already exists.
+        '''
+        if username_valid and email_valid:
+            profile_image_cache.delete(current_user.username)
+            current_user.first_name = first_name
+            current_user.last_name = last_name
+            current_user.username = username
+            current_user.email = email
+            db.session.commit()
+            response_cache.invalidate(
+                f'user:{current_user.id}', f'owner:{current_user.id}')
+            return jsonify({"message": "Verification successful.", "accountUpdated": True})
 
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        if not username_valid or not email_valid:
+            return jsonify({"message": "Verification successful.", "accountUpdated": False, "error": "Username or email belongs to another user."})
 
 
 # API route for advanced account settings
 @app.route("/api/advanced-account-settings", methods=['GET'])
+@token_required
 def advanced_account_settings():
     if request.method == 'GET':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            return jsonify({"message": "Verification successful."})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        return jsonify({"message": "Verification successful."})
 
 
 # API route for account deactivation
 @app.route("/api/deactivate-account", methods=['POST'])
+@token_required
 def deactivate_account():
     if request.method == "POST":
         '''
         The code below will first get the current user. Then, it will set the deactivated column to True.
         Once it's done that, a response to the frontend is sent clarifying that the account has been deactivated.
         '''
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            current_user.deactivated = True
-            db.session.commit()
-            return jsonify({'accountDeactivated': True})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        current_user = g.current_user
+        current_user.deactivated = True
+        db.session.commit()
+        response_cache.invalidate(
+            f'user:{current_user.id}', f'owner:{current_user.id}')
+        return jsonify({'accountDeactivated': True})
 
 
 # API route for account deletion
 @app.route("/api/delete-account", methods=['POST'])
+@token_required
 def delete_account():
     if request.method == 'POST':
         '''
         The code below will first get the current user. Then, it will get a list of the current user's podcasts.
-        It'll iterate through the list and remove the podcast file for each podcast that the user has since the user 
-        account is being deleted along with their profile picture (if it's not the default profile picture). 
+        It'll release the blob of each podcast that the user has since the user 
+        account is being deleted along with the blob of their profile picture (if it's not the default profile picture),
+        so blobs that nobody else uses are removed. The chunks of any unfinished uploads are removed by a background job.
         The db.session.delete(current_user) will remove the user, their podcasts, likes, comments, and follows because of cascading.
         Once that has been completed, a response to the frontend is sent clarifying that the account has been deleted.
         '''
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            current_user_podcasts = current_user.podcasts
-            for podcast in current_user_podcasts:
-                filename = podcast.podcast_file
-                if os.path.exists(f'podcast_files/{filename}'):
-                    os.remove(f'podcast_files/{filename}')
-            if current_user.profile_image != 'default.png':
-                if (os.path.exists(f'profile_pics/{current_user.profile_image}')):
-                    os.remove(f'profile_pics/{current_user.profile_image}')
-            db.session.delete(current_user)
-            db.session.commit()
-            return jsonify({'accountDeleted': True})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        current_user = g.current_user
+        for podcast in current_user.podcasts.options(joinedload(Podcast.blob)):
+            release_blob(podcast.blob)
+        release_blob(profile_picture_blob(current_user.profile_image))
+        queue_stored_file_removal([upload_prefix(upload.public_id)
+                                   for upload in current_user.uploads])
+        '''
+        The likes, comments and follows of this user are removed by cascading, so the
+        counters and trending scores of the podcasts and users that they touched are
+        recomputed afterwards.
+        '''
+        affected_podcast_ids = [podcast_id for (podcast_id,) in db.session.query(Like.podcast_id).filter_by(liker_id=current_user.id).union(
+            db.session.query(Comment.podcast_id).filter_by(commenter_id=current_user.id))]
+        affected_user_ids = [user_id for (user_id,) in db.session.query(Follow.followee_id).filter_by(follower_id=current_user.id).union(
+            db.session.query(Follow.follower_id).filter_by(followee_id=current_user.id))]
+        profile_image_cache.delete(current_user.username)
+        current_user_id = current_user.id
+        TimelineEntry.query.filter_by(user_id=current_user_id).delete()
+        remove_podcasts_from_timelines(db.session.query(
+            Podcast.id).filter_by(owner_id=current_user_id))
+        db.session.delete(current_user)
+        db.session.flush()
+        refresh_counters(podcast_ids=affected_podcast_ids,
+                         user_ids=affected_user_ids)
+        recompute_trending_scores(podcast_ids=affected_podcast_ids)
+        db.session.commit()
+        response_cache.invalidate(f'user:{current_user_id}', f'owner:{current_user_id}', 'listen:trending',
+                                  *[f'podcast:{podcast_id}' for podcast_id in affected_podcast_ids],
+                                  *[f'user:{user_id}' for user_id in affected_user_ids])
+        return jsonify({'accountDeleted': True})
 
 
 # API route for changing user passwords.
 @app.route("/api/change-password", methods=['GET', 'POST'])
+@token_required
 def change_password():
     if request.method == 'GET':
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            return jsonify({"message": "Verification successful."})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        return jsonify({"message": "Verification successful."})
 
     if request.method == "POST":
-        response = verify_authentication()
-        if response[0] == "Verification successful.":
-            current_user = User.query.filter_by(id=response[1]).first()
-            current_password = request.json['data']['currentPassword']
-            new_password = request.json['data']['newPassword']
-            '''
-            The code below will check if the current password that the user enters in 
-            is equal to the current password that is saved in the database.
-            If the passwords match, then a new password hash will be generated for the new
-            password and the user's password will be updated. Otherwise, it will not
-            be updated.
-            '''
-            if bcrypt.check_password_hash(current_user.password, current_password):
-                new_password_hash = bcrypt.generate_password_hash(
-                    new_password).decode("utf-8")
-                current_user.password = new_password_hash
-                db.session.commit()
-                return jsonify({"message": "Verification successful.", "passwordUpdated": True})
-            if not bcrypt.check_password_hash(current_user.password, current_password):
-                return jsonify({"message": "Verification successful.", "passwordUpdated": False})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        current_user = g.current_user
+        current_password = request.json['data']['currentPassword']
+        new_password = request.json['data']['newPassword']
+        '''
+        The code below will check if the current password that the user enters in 
+        is equal to the current password that is saved in the database.
+        If the passwords match, then a new password hash will be generated for the new
+        password and the user's password will be updated. Otherwise, it will not
+        be updated.
+        '''
+        if bcrypt.check_password_hash(current_user.password, current_password):
+            new_password_hash = bcrypt.generate_password_hash(
+                new_password).decode("utf-8")
+            current_user.password = new_password_hash
+            db.session.commit()
+            return jsonify({"message": "Verification successful.", "passwordUpdated": True})
+        if not bcrypt.check_password_hash(current_user.password, current_password):
+            return jsonify({"message": "Verification successful.", "passwordUpdated": False})
 
 
 # Function that will compress and save user files.
@@ -870,70 +1609,53 @@ def save_and_compress_file(file):
     The code below will save the profile picture that is submitted and will compress
     it.
 
-    First, a random hex token is generated for the new filename. Then, using os.path.splitext(), the
-    file extension is retrieved. The variable 'new_filename' will combine the new filename from
-    the hex token with the file extension. Once the new filename has been created, the file
-    is then saved into the path that is defined by the 'file_path' variable.
-
-    Once all of that is complete, the Pillow module will compress the image to a size of 
-    250x250. Then the code will return the filename to the 'update_profile_picture()' 
-    so that the new changes can be saved into the database.
+    The uploaded image was written into 'MEDIA_TEMP_DIRECTORY' and hashed while the request
+    was being read. It is then passed to 'store_profile_picture()', which adds a reference
+    to the blob with that hash. If nobody has uploaded the same image before, the image is
+    decoded once and saved at a few sizes (up to 250x250) in both WebP and JPEG so that
+    smaller images can be sent wherever the profile picture is shown small. Then the code will
+    return the filename and the saved sizes to the 'update_profile_picture()' so that the new
+    changes can be saved into the database. The uploaded image itself is not kept.
     '''
-    hex_string = secrets.token_hex(16)
-    file_ext = os.path.splitext(secure_filename(file.filename))[1]
-    new_filename = hex_string + file_ext
-    file_path = os.path.join(app.root_path, 'profile_pics', new_filename)
-    file.save(file_path)
-
-    output_size = (250, 250)
-    i = Image.open(file)
-    i.thumbnail(output_size)
-    i.save(file_path)
-
-    return new_filename
+    temp_path, sha256, size = save_uploaded_file(
+        file, app.config['MEDIA_TEMP_DIRECTORY'])
+    try:
+        return store_profile_picture(temp_path, sha256, size)
+    finally:
+        os.remove(temp_path)
 
 
 # API route for updating user profile pictures.
 @app.route("/api/update-profile-picture", methods=['GET', 'POST'])
+@token_required
 def update_profile_picture():
     if request.method == 'GET':
-        response = verify_authentication()
-        if response[0] == 'Verification successful.':
-            return jsonify({"message": "Verification successful."})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        return jsonify({"message": "Verification successful."})
 
     elif request.method == 'POST':
-        response = verify_authentication()
-        if response[0] == 'Verification successful.':
-            current_user = User.query.filter_by(id=response[1]).first()
-            '''
-            If the current user's profile photo is not the default profile picture,
-            it will delete their current photo and upload a new one.
-            The code below will then retrieve the file that was passed into the request
-            and that file is contained in the 'file' variable. Then, the filename is returned
-            by the 'save_and_compress_file()'. This function is used to save the file
-            and compress it and then return the filename to this route so that the new changes
-            can be saved in the database.
-            '''
-            if current_user.profile_image != 'default.png':
-                if (os.path.exists(f'profile_pics/{current_user.profile_image}')):
-                    os.remove(f'profile_pics/{current_user.profile_image}')
-            file = request.files['file']
-            filename = save_and_compress_file(file)
-            current_user.profile_image = filename
-            db.session.commit()
-            return jsonify({"message": "Verification successful.", "statusResponse": "Image uploaded successfully!"})
-        elif response == "This token has expired.":
-            return jsonify({"message": "This token has expired."})
-        elif response == "Decoding error.":
-            return jsonify({"message": "Decoding error."})
-        elif response == "Something went wrong":
-            return jsonify({"message": "Something went wrong."})
+        current_user = g.current_user
+        '''
+        The code below will retrieve the file that was passed into the request
+        and that file is contained in the 'file' variable. Then, the filename is returned
+        by the 'save_and_compress_file()'. This function is used to save the file
+        and compress it and then return the filename to this route so that the new changes
+        can be saved in the database. Once the new photo has been saved, the reference to
+        the current photo is released unless it is the default profile picture, which
+        removes it if no other user has the same photo.
+        '''
+        file = request.files['file']
+        try:
+            filename, sizes = save_and_compress_file(file)
+        except (Image.UnidentifiedImageError, OSError):
+            db.session.rollback()
+            return jsonify({"message": "Verification successful.", "statusResponse": "Invalid image."})
+        release_blob(profile_picture_blob(current_user.profile_image))
+        current_user.profile_image = filename
+        current_user.profile_image_sizes = sizes
+        db.session.commit()
+        profile_image_cache.delete(current_user.username)
+        response_cache.invalidate(f'user:{current_user.id}')
+        return jsonify({"message": "Verification successful.", "statusResponse": "Image uploaded successfully!"})
 
 
 # Forgot Password API route.
@@ -976,12 +1698,11 @@ def forgot_password():
             PodMaster Security Team
             '''
 
-            email = Message(
-                mail_subject, sender='noreply@demo.com', recipients=[user.email])
-            email.body = mail_body
-            mail.send(email)
+            # The email is sent by a background job, so the request does not wait for the SMTP server.
+            queue_email(mail_subject, [user.email], mail_body)
+            db.session.commit()
 
-            print("User exists and email has been sent to reset password.")
+            print("User exists and an email has been queued to reset password.")
             return jsonify({'userValid': True, 'emailSent': True})
 
 
@@ -0,0 +1,405 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import app, db
+from jobs import job_handler, enqueue_job
+from werkzeug.security import safe_join
+from werkzeug.wsgi import LimitedStream
+import contextlib
+import os
+import re
+import shutil
+import tempfile
+
+
+'''
+Media files are read and written through a storage backend instead of straight from the
+disk of the server, so that several instances of the app can share them. Every file is
+identified by a key, which is a path like '<sha256>/original' (see blobs.py).
+
+'STORAGE_BACKEND' picks the backend. 'local' keeps the files in the 'MEDIA_ROOT' directory
+of this server and 's3' keeps them in an S3 bucket, which can be on AWS or on any
+S3-compatible server like MinIO. Both backends have the same methods:
+
+    exists(key), size(key)          whether a file exists and its size in bytes
+    put(key, path)                  move a local file into storage
+    put_directory(prefix, path)     move a local directory into storage under a prefix
+    open(key)                       a stream of the whole file
+    open_range(key, start, length)  a stream of part of the file
+    local_path(key)                 a context manager that gives a local path of the file
+    delete(key), delete_tree(prefix)
+    presigned_url(key, ...)         a URL that clients can download the file from directly
+    list_prefixes(start_after)      the first part of every key, in order (see cleanup.py)
+    list_keys(prefix)               every key under a prefix, in order
+
+Files that are being created (uploads, transcodes and resized images) are written to
+'MEDIA_TEMP_DIRECTORY' on the local disk first and then moved into storage with 'put()'.
+The chunks of chunked uploads are kept in storage as well (see ingest.py), so that each
+chunk can be received by a different instance of the app.
+'''
+
+
+def link_or_copy(source_path, destination_path):
+    '''
+    Hard link a file to a new path, or copy it if the file system does not support hard
+    links. Used when files are added to storage but have to be kept where they are.
+    '''
+    if os.path.exists(destination_path):
+        return
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copy2(source_path, destination_path)
+
+
+class LocalStorage:
+    '''
+    Stores every file at its key inside the root directory. Moving a file into storage is
+    a rename, and files can be sent by the web server itself (see 'send_media_file()').
+
+    A directory with hundreds of thousands of entries makes lookups and backups slow, so
+    the files are fanned out into two levels of directories named after the first four
+    characters of their key, for example 'ab/cd/abcd.../original'. Each of those
+    directories has at most 256 entries (the keys start with a hex hash). Files that were
+    stored before this layout was added are still found at their key in the root directory
+    until 'shard_legacy_directories()' has moved them.
+    '''
+    local = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def sharded_path(self, key):
+        path = safe_join(self.root, key[:2], key[2:4], key)
+        if path == None or len(key) < 4:
+            raise ValueError(f"'{key}' is not a valid storage key.")
+        return path
+
+    def legacy_path(self, key):
+        return safe_join(self.root, key)
+
+    def path(self, key):
+        '''
+        The path of a file in storage. New files are always written to the sharded path. If
+        a file is at neither path, it may have been moved between the two checks, so the
+        sharded path is returned.
+        '''
+        path = self.sharded_path(key)
+        if not os.path.exists(path) and os.path.exists(self.legacy_path(key)):
+            return self.legacy_path(key)
+        return path
+
+    def relative_path(self, key):
+        '''The path of a file relative to the root, for example for X-Accel-Redirect.'''
+        return os.path.relpath(self.path(key), self.root).replace(os.sep, '/')
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def put(self, key, source_path, keep_source=False):
+        path = self.sharded_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if keep_source:
+            link_or_copy(source_path, path)
+        else:
+            shutil.move(source_path, path)
+
+    def put_directory(self, prefix, source_directory, keep_source=False):
+        path = self.sharded_path(prefix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if keep_source:
+            # shutil.copytree() cannot copy into an existing directory before Python 3.8.
+            for directory, _, filenames in os.walk(source_directory):
+                destination = os.path.normpath(os.path.join(
+                    path, os.path.relpath(directory, source_directory)))
+                os.makedirs(destination, exist_ok=True)
+                for filename in filenames:
+                    link_or_copy(os.path.join(directory, filename),
+                                 os.path.join(destination, filename))
+        elif self.exists(prefix):
+            shutil.rmtree(source_directory)
+        else:
+            shutil.move(source_directory, path)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def open_range(self, key, start, length):
+        file = self.open(key)
+        file.seek(start)
+        return LimitedStream(file, length)
+
+    @contextlib.contextmanager
+    def local_path(self, key):
+        yield self.path(key)
+
+    def delete(self, key):
+        for path in (self.legacy_path(key), self.sharded_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def delete_tree(self, prefix):
+        # The legacy directory goes first in case it is being moved to the sharded path.
+        shutil.rmtree(self.legacy_path(prefix), ignore_errors=True)
+        shutil.rmtree(self.sharded_path(prefix), ignore_errors=True)
+
+    def list_prefixes(self, start_after=None):
+        '''
+        The code below will yield the first part of every key (the directory at the bottom
+        of the sharded layout) in sorted order, along with the time that the directory was
+        last changed, starting after the prefix 'start_after'. The directories are listed one
+        shard at a time, so only one shard is ever held in memory. Directories that are still
+        in the legacy layout are not listed.
+        '''
+        def sorted_shards(directory):
+            return sorted(entry.name for entry in os.scandir(directory)
+                          if len(entry.name) == 2 and entry.is_dir())
+
+        for first in sorted_shards(self.root):
+            for second in sorted_shards(os.path.join(self.root, first)):
+                if start_after and first + second < start_after[:4]:
+                    continue
+                directory = os.path.join(self.root, first, second)
+                for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+                    if start_after and entry.name <= start_after:
+                        continue
+                    yield entry.name, entry.stat().st_mtime
+
+    def list_keys(self, prefix):
+        '''
+        The code below will yield every key under a prefix in sorted order, along with the
+        time that its file was last changed. Each directory is only listed when it is reached.
+        Like 'path()', a prefix that has not been moved into the sharded layout yet is listed
+        where it was stored before.
+        '''
+        def walk(directory, key_prefix):
+            for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+                key = f'{key_prefix}/{entry.name}'
+                if entry.is_dir():
+                    yield from walk(entry.path, key)
+                else:
+                    yield key, entry.stat().st_mtime
+
+        directory = self.path(prefix)
+        if os.path.isdir(directory):
+            yield from walk(directory, prefix)
+
+    def shard_legacy_directories(self, limit):
+        '''
+        The code below will move up to 'limit' directories from the root into the sharded
+        layout and return how many were moved. Each directory is moved with a single
+        rename, so the app keeps serving its files while this runs. If the sharded
+        directory already exists (because a file was added to it after the layout
+        changed), the files are moved into it one by one instead.
+
+        The root directory is read lazily and only until enough directories have been
+        found, so a batch never lists the whole directory.
+        '''
+        moved = 0
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if moved >= limit:
+                    break
+                if not LEGACY_DIRECTORY_PATTERN.match(entry.name) or not entry.is_dir():
+                    continue
+                path = self.sharded_path(entry.name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if not os.path.exists(path):
+                    os.rename(entry.path, path)
+                else:
+                    merge_directory(entry.path, path)
+                moved += 1
+        return moved
+
+    def presigned_url(self, key, expires_in, mimetype=None, download_name=None, cache_control=None):
+        '''Local files are sent by the app, so they do not have URLs of their own.'''
+        return None
+
+
+'''
+The directories that were at the root of the local storage before it was sharded are
+named after the SHA-256 hash of a blob (see blobs.py).
+'''
+LEGACY_DIRECTORY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def merge_directory(source_directory, destination_directory):
+    '''
+    Move every file in a directory into another directory, keeping the files that the other
+    directory already has, and then remove the first directory.
+    '''
+    for directory, _, filenames in os.walk(source_directory):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            destination = os.path.join(
+                destination_directory, os.path.relpath(path, source_directory))
+            if os.path.exists(destination):
+                os.remove(path)
+            else:
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                os.replace(path, destination)
+    shutil.rmtree(source_directory, ignore_errors=True)
+
+
+class S3Storage:
+    '''
+    Stores every file as an object in an S3 bucket, with the key as the object's name.
+    Objects are uploaded and downloaded in parts by boto3, so large podcast files are never
+    held in memory. Buckets do not have directories, so keys are not sharded.
+    '''
+    local = False
+
+    def __init__(self, bucket, **client_options):
+        import boto3
+        from botocore.exceptions import ClientError
+        self.client = boto3.client('s3', **client_options)
+        self.bucket = bucket
+        self.client_error = ClientError
+
+    def head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client_error as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, key):
+        return self.head(key) != None
+
+    def size(self, key):
+        head = self.head(key)
+        if head == None:
+            raise FileNotFoundError(key)
+        return head['ContentLength']
+
+    def put(self, key, source_path, keep_source=False):
+        self.client.upload_file(source_path, self.bucket, key)
+        if not keep_source:
+            os.remove(source_path)
+
+    def put_directory(self, prefix, source_directory, keep_source=False):
+        for directory, _, filenames in os.walk(source_directory):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                relative_path = os.path.relpath(path, source_directory)
+                self.put(f'{prefix}/{relative_path.replace(os.sep, "/")}',
+                         path, keep_source=True)
+        if not keep_source:
+            shutil.rmtree(source_directory)
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def open_range(self, key, start, length):
+        return self.client.get_object(Bucket=self.bucket, Key=key,
+                                      Range=f'bytes={start}-{start + length - 1}')['Body']
+
+    @contextlib.contextmanager
+    def local_path(self, key):
+        '''The object is downloaded into a temporary file, which is removed afterwards.'''
+        directory = app.config['MEDIA_TEMP_DIRECTORY']
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=directory, suffix='.part')
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, key, path)
+            yield path
+        finally:
+            os.remove(path)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def delete_tree(self, prefix):
+        '''Every object under the prefix is deleted, up to 1000 objects per request.'''
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f'{prefix}/'):
+            objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket, Delete={
+                                           'Objects': objects, 'Quiet': True})
+
+    def list_prefixes(self, start_after=None):
+        '''
+        The code below will yield the first part of every key in sorted order, along with
+        the time that the newest object under it was last changed, starting after the prefix
+        'start_after'. The bucket lists keys in order, so the objects under a prefix come one
+        after another and only one page of objects is held in memory.
+        '''
+        paginator = self.client.get_paginator('list_objects_v2')
+        options = {'Bucket': self.bucket}
+        if start_after:
+            # Every key under 'start_after' sorts before this, since '/' comes before '0'.
+            options['StartAfter'] = start_after + '0'
+        prefix, modified = None, None
+        for page in paginator.paginate(**options):
+            for item in page.get('Contents', []):
+                item_prefix = item['Key'].split('/', 1)[0]
+                item_modified = item['LastModified'].timestamp()
+                if item_prefix != prefix:
+                    if prefix != None:
+                        yield prefix, modified
+                    prefix, modified = item_prefix, item_modified
+                else:
+                    modified = max(modified, item_modified)
+        if prefix != None:
+            yield prefix, modified
+
+    def list_keys(self, prefix):
+        '''The bucket lists keys in order, one page of up to 1000 keys at a time.'''
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f'{prefix}/'):
+            for item in page.get('Contents', []):
+                yield item['Key'], item['LastModified'].timestamp()
+
+    def presigned_url(self, key, expires_in, mimetype=None, download_name=None, cache_control=None):
+        '''
+        The URL also tells S3 which headers to send with the file, so it is served with
+        the same type and caching as if the app had sent it.
+        '''
+        params = {'Bucket': self.bucket, 'Key': key}
+        if mimetype:
+            params['ResponseContentType'] = mimetype
+        if download_name:
+            params['ResponseContentDisposition'] = f'inline; filename="{download_name}"'
+        if cache_control:
+            params['ResponseCacheControl'] = cache_control
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires_in)
+
+
+def create_storage():
+    backend = app.config['STORAGE_BACKEND']
+    if backend == 'local':
+        return LocalStorage(app.config['MEDIA_ROOT'])
+    if backend == 's3':
+        client_options = {'endpoint_url': app.config['S3_ENDPOINT_URL'],
+                          'region_name': app.config['S3_REGION'],
+                          'aws_access_key_id': app.config['S3_ACCESS_KEY_ID'],
+                          'aws_secret_access_key': app.config['S3_SECRET_ACCESS_KEY']}
+        return S3Storage(app.config['S3_BUCKET'], **{option: value for option, value in client_options.items() if value})
+    raise ValueError(f"Unknown storage backend '{backend}'.")
+
+
+storage = create_storage()
+
+
+@job_handler('shard_media')
+def shard_media(batch_size):
+    '''
+    The code below will move one batch of directories in the local storage into the sharded
+    layout (see 'LocalStorage'). If the batch was full, there may be more to move, so the
+    job queues itself again for the next batch. Other jobs that are due run in between.
+    '''
+    if not storage.local:
+        return
+    moved = storage.shard_legacy_directories(batch_size)
+    print(f"{moved} media directories have been moved into the sharded layout.")
+    if moved >= batch_size:
+        enqueue_job('shard_media', batch_size=batch_size)
+        db.session.commit()
@@ -0,0 +1,96 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+
+
+'''
+The tests run against a SQLite database and a media directory inside a temporary
+directory, so they never touch 'database.db' or the media files of the app. configs.py
+reads the environment when it is imported, so the environment is set up before any module
+of the app is imported. Run the tests from the server directory with: python -m pytest
+'''
+test_directory = tempfile.mkdtemp()
+database_path = os.path.join(test_directory, 'database.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + database_path
+os.environ['MEDIA_ROOT'] = os.path.join(test_directory, 'media')
+os.environ['STORAGE_BACKEND'] = 'local'
+os.environ['TRANSCODE_ENABLED'] = 'false'
+os.environ['JOB_THREADS'] = '0'
+os.environ['JWT_SECRET_KEY'] = 'a-secret-key-that-is-only-used-by-the-tests'
+os.environ['SECRET_KEY'] = 'a-secret-key-that-is-only-used-by-the-tests'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgi  # noqa: E402 (registers the routes, models and job handlers)
+from configs import app, db  # noqa: E402
+from cache import response_cache  # noqa: E402
+from auth import token_cache  # noqa: E402
+from migrations import upgrade_database  # noqa: E402
+
+
+def remove_database():
+    '''
+    The code below will close every connection to the test database and remove its files
+    along with the media directory and the in-process caches, so the next test starts from
+    nothing.
+    '''
+    db.session.remove()
+    db.engine.dispose()
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(database_path + suffix):
+            os.remove(database_path + suffix)
+    shutil.rmtree(app.config['MEDIA_ROOT'], ignore_errors=True)
+    response_cache.clear()
+    token_cache.clear()
+
+
+@pytest.fixture
+def database():
+    '''A brand new database at the latest version.'''
+    remove_database()
+    with app.app_context():
+        upgrade_database()
+        yield db
+    remove_database()
+
+
+@pytest.fixture
+def client(database):
+    return app.test_client()
+
+
+@pytest.fixture
+def register(client):
+    '''
+    Returns a function that creates a user and logs them in. It returns the headers that
+    the routes that need a logged in user expect.
+    '''
+    def register_user(username):
+        client.post('/api/register', json={'user': {'firstName': 'First', 'lastName': 'Last', 'username': username,
+                                                    'email': f'{username}@example.com', 'password': 'password'}})
+        token = client.post('/api/login', json={'user': {'username': username, 'password': 'password'}}).get_json()['token']
+        return {'x-access-token': token}
+    return register_user
+
+
+@pytest.fixture
+def upload(client):
+    '''Returns a function that uploads a small podcast file and returns its public id.'''
+    def upload_podcast(headers, podcast_title):
+        data = {'podcastTitle': podcast_title, 'podcastDescription': 'Description',
+                'podcastFile': (io.BytesIO(b'ID3' + podcast_title.encode('utf-8')), 'podcast.mp3')}
+        client.post('/api/upload-podcast', headers=headers, data=data, content_type='multipart/form-data')
+        return client.get('/api/dashboard', headers=headers).get_json()['podcasts'][0]['podcast_id']
+    return upload_podcast
+
+
+@pytest.fixture(scope='session', autouse=True)
+def remove_test_directory():
+    yield
+    remove_database()
+    shutil.rmtree(test_directory, ignore_errors=True)
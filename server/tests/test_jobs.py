@@ -0,0 +1,164 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+import datetime
+import pytest
+import jobs
+from configs import app, db
+from models import Job
+from jobs import enqueue_job, schedule_job, claim_job, run_job, run_pending_jobs, retry_delay
+from sqlalchemy import event, text
+
+
+@pytest.fixture
+def handlers(database, monkeypatch):
+    '''
+    Returns a function that registers a handler for a kind of job that only exists in the
+    test, along with a list of the payloads that its failure handler was called with.
+    '''
+    failures = []
+
+    def register(kind, handler):
+        monkeypatch.setitem(jobs.job_handlers, kind, handler)
+        monkeypatch.setitem(jobs.job_failure_handlers, kind, lambda **payload: failures.append(payload))
+        return failures
+    return register
+
+
+def make_due(job_id):
+    Job.query.filter_by(id=job_id).update({Job.run_at: datetime.datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+
+
+def test_queuing_a_job_does_not_start_threads(database, monkeypatch):
+    def thread(*args, **kwargs):
+        raise AssertionError("A job thread was started.")
+    monkeypatch.setitem(app.config, 'JOB_THREADS', 2)
+    monkeypatch.setattr(jobs.threading, 'Thread', thread)
+    enqueue_job('test', number=1)
+    db.session.commit()
+    assert Job.query.one().status == 'queued'
+
+
+def test_a_job_is_only_claimed_once(database):
+    enqueue_job('test')
+    db.session.commit()
+    assert claim_job() != None
+    assert claim_job() == None
+    assert Job.query.one().attempts == 1
+
+
+def test_a_job_claimed_by_another_worker_in_between_is_skipped(database):
+    '''
+    Another worker claims the job after this worker has read it as a candidate but before
+    its UPDATE runs, so the UPDATE does not match and the job is not claimed twice.
+    '''
+    enqueue_job('test')
+    db.session.commit()
+
+    claimed_by_other_worker = []
+
+    def claim_in_another_worker(conn, cursor, statement, parameters, context, executemany):
+        if not claimed_by_other_worker and statement.lstrip().startswith('SELECT') and 'FROM job' in statement:
+            claimed_by_other_worker.append(True)
+            with db.engine.connect() as other_connection:
+                other_connection.execute(text(
+                    "UPDATE job SET status = 'running', attempts = attempts + 1, started_at = :now"),
+                    {'now': datetime.datetime.utcnow()})
+    event.listen(db.engine, 'after_cursor_execute', claim_in_another_worker)
+    try:
+        assert claim_job() == None
+    finally:
+        event.remove(db.engine, 'after_cursor_execute', claim_in_another_worker)
+    assert claimed_by_other_worker == [True]
+    assert Job.query.one().attempts == 1
+
+
+def test_a_failing_job_is_retried_and_then_fails(handlers, monkeypatch):
+    def handler(number):
+        raise ValueError(f"Failure number {number}.")
+    failures = handlers('failing', handler)
+    monkeypatch.setitem(app.config, 'JOB_MAX_ATTEMPTS', 3)
+    enqueue_job('failing', number=7)
+    db.session.commit()
+
+    for attempt in (1, 2):
+        before = datetime.datetime.utcnow()
+        assert run_job(claim_job()) == False
+        job = Job.query.one()
+        assert (job.status, job.attempts) == ('queued', attempt)
+        assert 'Failure number 7.' in job.last_error
+        assert job.run_at >= before + datetime.timedelta(seconds=retry_delay(attempt))
+        assert claim_job() == None
+        assert failures == []
+        make_due(job.id)
+
+    assert run_job(claim_job()) == False
+    job = Job.query.one()
+    assert (job.status, job.attempts) == ('failed', 3)
+    assert failures == [{'number': 7}]
+    assert claim_job() == None
+
+
+def test_the_retry_delay_doubles_up_to_the_maximum(database, monkeypatch):
+    monkeypatch.setitem(app.config, 'JOB_RETRY_DELAY', 30)
+    monkeypatch.setitem(app.config, 'JOB_MAX_RETRY_DELAY', 100)
+    assert [retry_delay(attempts) for attempts in (1, 2, 3, 4)] == [30, 60, 100, 100]
+
+
+def test_a_job_left_running_by_a_stopped_worker_is_claimed_again(handlers):
+    runs = []
+    handlers('stale', lambda: runs.append(True))
+    enqueue_job('stale')
+    db.session.commit()
+    job_id = claim_job().id
+    assert claim_job() == None
+
+    stale_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['JOB_TIMEOUT'] + 1)
+    Job.query.filter_by(id=job_id).update({Job.started_at: stale_time}, synchronize_session=False)
+    db.session.commit()
+    job = claim_job()
+    assert (job.id, job.status, job.attempts) == (job_id, 'running', 2)
+    assert run_job(job) == True
+    assert runs == [True]
+    assert Job.query.count() == 0
+
+
+def test_a_job_that_keeps_timing_out_fails(handlers, monkeypatch):
+    '''A job whose worker keeps stopping is not run again once it is out of attempts.'''
+    runs = []
+    failures = handlers('stale', lambda: runs.append(True))
+    monkeypatch.setitem(app.config, 'JOB_MAX_ATTEMPTS', 1)
+    enqueue_job('stale')
+    db.session.commit()
+    job_id = claim_job().id
+    stale_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['JOB_TIMEOUT'] + 1)
+    Job.query.filter_by(id=job_id).update({Job.started_at: stale_time}, synchronize_session=False)
+    db.session.commit()
+    assert run_job(claim_job()) == False
+    assert runs == []
+    assert Job.query.one().status == 'failed'
+    assert failures == [{}]
+
+
+def test_changes_that_a_handler_does_not_commit_are_rolled_back(handlers):
+    '''
+    'run_job()' rolls back before it deletes a job that succeeded, so a handler has to
+    commit its own changes.
+    '''
+    later = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+
+    def forgetful():
+        schedule_job('forgotten', later)
+
+    def careful():
+        schedule_job('remembered', later)
+        db.session.commit()
+    handlers('forgetful', forgetful)
+    handlers('careful', careful)
+    enqueue_job('forgetful')
+    enqueue_job('careful')
+    db.session.commit()
+
+    assert run_pending_jobs() == 2
+    assert [job.kind for job in Job.query.all()] == ['remembered']
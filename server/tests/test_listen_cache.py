@@ -0,0 +1,36 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+import pytest
+
+
+def first_trending_title(client, headers):
+    body = client.get('/api/listen', headers=headers, query_string={'sort': 'trending', 'limit': 1}).get_json()
+    return body['podcasts'][0]['podcast_title']
+
+
+@pytest.fixture
+def podcasts(register, upload):
+    headers = register('alice')
+    older = upload(headers, 'Older')
+    upload(headers, 'Newer')
+    return headers, older
+
+
+def test_like_reorders_cached_trending_page(client, podcasts):
+    headers, older = podcasts
+    assert first_trending_title(client, headers) == 'Newer'
+    client.post('/api/like/podcast', headers=headers, json={'podcastId': older})
+    assert first_trending_title(client, headers) == 'Older'
+    client.post('/api/unlike/podcast', headers=headers, json={'podcastId': older})
+    assert first_trending_title(client, headers) == 'Newer'
+
+
+def test_comment_reorders_cached_trending_page(client, podcasts):
+    headers, older = podcasts
+    assert first_trending_title(client, headers) == 'Newer'
+    client.post(f'/api/comment/{older}', headers=headers, json={'comment': 'Great episode'})
+    assert first_trending_title(client, headers) == 'Older'
+    comment_id = client.get(f'/api/comments/{older}', headers=headers).get_json()['comments'][0]['commentId']
+    client.post(f'/api/delete-comment/{comment_id}', headers=headers)
+    assert first_trending_title(client, headers) == 'Newer'
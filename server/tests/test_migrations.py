@@ -0,0 +1,192 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import pytest
+from conftest import database_path, remove_database
+from configs import app, db
+from models import User, Podcast, Like, Comment, Follow, Upload, Blob, Job
+from migrations import upgrade_database, MIGRATIONS
+from blobs import blob_key
+from ingest import upload_part_key
+from storage import storage
+from sqlalchemy import text
+
+
+'''
+The 'database.db' file in the repository is kept at the schema it was first committed with,
+so it is copied and filled with rows to test the migrations of a database that is older
+than the migrations themselves.
+'''
+checked_in_database = os.path.join(app.root_path, 'database.db')
+first_audio = b'ID3 the first episode'
+second_audio = b'ID3 the second episode'
+picture = b'JPEG the picture of alice and bob'
+
+LEGACY_ROWS = [
+    ('user', [('user-alice', 'Alice', 'A', 'alice', 'alice@example.com', 'password', 0, 'a1.jpg'),
+              ('user-bob', 'Bob', 'B', 'bob', 'bob@example.com', 'password', 0, 'b2.jpg'),
+              ('user-carl', 'Carl', 'C', 'carl', 'carl@example.com', 'password', 0, 'default.png'),
+              ('user-dave', 'Dave', 'D', 'dave', 'dave@example.com', 'password', 0, 'gone.jpg')]),
+    ('podcast', [('podcast-1', 'user-alice', 'First', 'Description', 'one.mp3'),
+                 ('podcast-2', 'user-alice', 'Copy of first', 'Description', 'two.mp3'),
+                 ('podcast-3', 'user-bob', 'Second', 'Description', 'three.wav'),
+                 ('podcast-4', 'user-bob', 'Missing', 'Description', 'missing.mp3')]),
+    # Bob likes the first podcast and follows Alice twice, from before the unique indexes.
+    ('"like"', [('like-1', 'podcast-1', 'user-bob'), ('like-2', 'podcast-1', 'user-bob'),
+                ('like-3', 'podcast-1', 'user-carl'), ('like-4', 'podcast-3', 'user-alice')]),
+    ('follow', [('follow-1', 'user-bob', 'user-alice'), ('follow-2', 'user-bob', 'user-alice'),
+                ('follow-3', 'user-carl', 'user-alice'), ('follow-4', 'user-alice', 'user-bob')]),
+    ('comment', [('comment-1', 'Great', 'user-bob', 'podcast-1'), ('comment-2', 'Again', 'user-bob', 'podcast-1'),
+                 ('comment-3', 'Nice', 'user-carl', 'podcast-3')]),
+]
+
+OLD_FILES = {
+    'podcast_files/one.mp3': first_audio,
+    'podcast_files/two.mp3': first_audio,
+    'podcast_files/three.wav': second_audio,
+    'profile_pics/a1.jpg': picture,
+    'profile_pics/a1_40.webp': b'WEBP 40',
+    'profile_pics/b2.jpg': picture,
+}
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def database_schema():
+    return sorted(db.session.execute(text('SELECT type, name, tbl_name, sql FROM sqlite_master')).fetchall())
+
+
+@pytest.fixture
+def server_directory(tmp_path, monkeypatch):
+    '''The directory that the old media files are read from, instead of the real server directory.'''
+    monkeypatch.setattr(app, 'root_path', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def legacy_database(server_directory):
+    remove_database()
+    shutil.copy(checked_in_database, database_path)
+    connection = sqlite3.connect(database_path)
+    for table, rows in LEGACY_ROWS:
+        placeholders = ', '.join('?' * len(rows[0]))
+        connection.executemany(f'INSERT INTO {table} VALUES ({placeholders})', rows)
+    connection.commit()
+    connection.close()
+    for name, data in OLD_FILES.items():
+        path = server_directory / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(data)
+    with app.app_context():
+        yield
+    remove_database()
+
+
+def test_string_ids_become_public_ids(legacy_database):
+    upgrade_database()
+    users = {user.username: user for user in User.query.all()}
+    assert {username: user.public_id for username, user in users.items()} == {
+        'alice': 'user-alice', 'bob': 'user-bob', 'carl': 'user-carl', 'dave': 'user-dave'}
+    assert all(isinstance(user.id, int) for user in users.values())
+    podcasts = {podcast.public_id: podcast for podcast in Podcast.query.all()}
+    assert {public_id: podcast.owner_id for public_id, podcast in podcasts.items()} == {
+        'podcast-1': users['alice'].id, 'podcast-2': users['alice'].id,
+        'podcast-3': users['bob'].id, 'podcast-4': users['bob'].id}
+    assert sorted((comment.public_id, comment.commenter_id, comment.podcast_id) for comment in Comment.query.all()) == [
+        ('comment-1', users['bob'].id, podcasts['podcast-1'].id),
+        ('comment-2', users['bob'].id, podcasts['podcast-1'].id),
+        ('comment-3', users['carl'].id, podcasts['podcast-3'].id)]
+
+
+def test_duplicate_likes_and_follows_are_removed_and_counted_once(legacy_database):
+    upgrade_database()
+    users = {user.username: user for user in User.query.all()}
+    podcasts = {podcast.public_id: podcast for podcast in Podcast.query.all()}
+    assert sorted((like.liker_id, like.podcast_id) for like in Like.query.all()) == sorted([
+        (users['bob'].id, podcasts['podcast-1'].id), (users['carl'].id, podcasts['podcast-1'].id),
+        (users['alice'].id, podcasts['podcast-3'].id)])
+    assert sorted((follow.follower_id, follow.followee_id) for follow in Follow.query.all()) == sorted([
+        (users['bob'].id, users['alice'].id), (users['carl'].id, users['alice'].id),
+        (users['alice'].id, users['bob'].id)])
+    assert {public_id: (podcast.like_count, podcast.comment_count) for public_id, podcast in podcasts.items()} == {
+        'podcast-1': (2, 2), 'podcast-2': (0, 0), 'podcast-3': (1, 1), 'podcast-4': (0, 0)}
+    assert {username: (user.followers_count, user.following_count) for username, user in users.items()} == {
+        'alice': (2, 1), 'bob': (1, 1), 'carl': (0, 1), 'dave': (0, 0)}
+
+
+def test_identical_files_share_a_blob(legacy_database):
+    upgrade_database()
+    podcasts = {podcast.public_id: podcast for podcast in Podcast.query.all()}
+    blobs = {blob.sha256: blob for blob in Blob.query.all()}
+    assert {sha: blob.refcount for sha, blob in blobs.items()} == {
+        sha256(first_audio): 2, sha256(second_audio): 1, sha256(picture): 2}
+    assert podcasts['podcast-1'].blob_id == podcasts['podcast-2'].blob_id == blobs[sha256(first_audio)].id
+    assert podcasts['podcast-3'].blob_id == blobs[sha256(second_audio)].id
+    assert podcasts['podcast-4'].blob_id == None
+    with storage.open(blob_key(sha256(first_audio), 'original')) as file:
+        assert file.read() == first_audio
+
+    users = {user.username: user for user in User.query.all()}
+    assert {username: (user.profile_image, user.profile_image_sizes) for username, user in users.items()} == {
+        'alice': (sha256(picture) + '.jpg', '40.webp'), 'bob': (sha256(picture) + '.jpg', '40.webp'),
+        'carl': ('default.png', None), 'dave': ('default.png', None)}
+    assert storage.exists(blob_key(sha256(picture), 'picture.jpg'))
+
+
+def test_old_files_are_removed_by_a_job(legacy_database, server_directory):
+    upgrade_database()
+    job = Job.query.one()
+    assert job.kind == 'remove_files'
+    assert sorted(json.loads(job.payload)['paths']) == sorted(OLD_FILES)
+    for name in OLD_FILES:
+        assert (server_directory / name).exists()
+
+
+def test_the_migrated_schema_matches_a_new_database(legacy_database):
+    upgrade_database()
+    upgrade_database()
+    assert db.session.execute(text('SELECT version FROM schema_version')).scalar() == MIGRATIONS[-1][0]
+    migrated = database_schema()
+    remove_database()
+    upgrade_database()
+    assert database_schema() == migrated
+
+
+@pytest.fixture
+def version_9_database(server_directory):
+    '''A database from right before the chunks of uploads were moved into the media storage.'''
+    remove_database()
+    with app.app_context():
+        upgrade_database()
+        db.session.execute(text('UPDATE schema_version SET version = 9'))
+        owner = User(first_name='Alice', last_name='A', username='alice',
+                     email='alice@example.com', password='password')
+        for public_id, received_size in (('upload-a', 6), ('upload-b', 100), ('upload-c', 0)):
+            db.session.add(Upload(public_id=public_id, owner=owner, podcast_title='Title', podcast_description='Description',
+                                  file_ext='mp3', total_size=200, received_size=received_size))
+        db.session.commit()
+        (server_directory / 'podcast_uploads').mkdir()
+        # The first upload has the start of a chunk that never finished after its 6 bytes.
+        (server_directory / 'podcast_uploads' / 'upload-a.part').write_bytes(b'abcdefghij')
+        (server_directory / 'podcast_uploads' / 'upload-b.part').write_bytes(b'too short')
+        (server_directory / 'podcast_uploads' / 'upload-c.part').write_bytes(b'')
+        yield
+    remove_database()
+
+
+def test_upload_parts_are_moved_into_storage(version_9_database, server_directory):
+    upgrade_database()
+    with storage.open(upload_part_key('upload-a', 0)) as file:
+        assert file.read() == b'abcdef'
+    assert not storage.exists(upload_part_key('upload-b', 0))
+    assert not storage.exists(upload_part_key('upload-c', 0))
+    job = Job.query.one()
+    assert (job.kind, json.loads(job.payload)) == ('remove_files', {'paths': ['podcast_uploads']})
+    assert (server_directory / 'podcast_uploads' / 'upload-b.part').exists()
@@ -0,0 +1,90 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+import base64
+import datetime
+import pytest
+from models import Podcast
+
+
+def read_all_pages(client, url, headers, limit, **arguments):
+    '''Follow the cursors of a listing until the last page and return every page.'''
+    pages = []
+    cursor = None
+    while True:
+        query_string = dict(arguments, limit=limit)
+        if cursor:
+            query_string['cursor'] = cursor
+        response = client.get(url, headers=headers, query_string=query_string)
+        assert response.status_code == 200
+        body = response.get_json()
+        pages.append([podcast['podcast_title'] for podcast in body['podcasts']])
+        cursor = body['nextCursor']
+        if cursor == None:
+            return pages
+
+
+@pytest.fixture
+def podcasts(database, register, upload):
+    '''
+    Seven podcasts where the middle five were all created at the same moment, so the pages
+    have to be split between podcasts that only differ by their id.
+    '''
+    headers = register('alice')
+    for number in range(7):
+        upload(headers, f'Podcast {number}')
+    same_time = datetime.datetime(2023, 1, 1, 12, 0, 0)
+    Podcast.query.filter(Podcast.podcast_title.in_([f'Podcast {number}' for number in range(1, 6)])).update(
+        {Podcast.created_at: same_time}, synchronize_session=False)
+    Podcast.query.filter_by(podcast_title='Podcast 0').update(
+        {Podcast.created_at: same_time - datetime.timedelta(days=1)}, synchronize_session=False)
+    database.session.commit()
+    return headers
+
+
+@pytest.mark.parametrize('url', ['/api/listen', '/api/dashboard'])
+@pytest.mark.parametrize('limit', [1, 2, 3, 7, 8])
+def test_pages_have_no_duplicates_or_gaps(client, podcasts, url, limit):
+    expected = ['Podcast 6', 'Podcast 5', 'Podcast 4', 'Podcast 3', 'Podcast 2', 'Podcast 1', 'Podcast 0']
+    pages = read_all_pages(client, url, podcasts, limit)
+    assert [title for page in pages for title in page] == expected
+    assert all(len(page) == limit for page in pages[:-1])
+    assert 1 <= len(pages[-1]) <= limit
+
+
+def test_last_page_has_no_cursor(client, podcasts):
+    '''A page that ends exactly at the last podcast does not point at an empty page.'''
+    first_page = client.get('/api/listen', headers=podcasts, query_string={'limit': 6}).get_json()
+    last_page = client.get('/api/listen', headers=podcasts,
+                           query_string={'limit': 6, 'cursor': first_page['nextCursor']}).get_json()
+    assert [podcast['podcast_title'] for podcast in last_page['podcasts']] == ['Podcast 0']
+    assert last_page['nextCursor'] == None
+
+
+def test_without_a_limit_every_podcast_is_returned(client, podcasts):
+    body = client.get('/api/listen', headers=podcasts).get_json()
+    assert len(body['podcasts']) == 7
+    assert body['nextCursor'] == None
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!',
+    base64.urlsafe_b64encode(b'no separator').decode('ascii'),
+    base64.urlsafe_b64encode(b'not a date|1').decode('ascii'),
+    base64.urlsafe_b64encode(b'2023-01-01T12:00:00|not a number').decode('ascii'),
+    base64.urlsafe_b64encode(b'\xff\xfe|1').decode('ascii'),
+])
+@pytest.mark.parametrize('url', ['/api/listen', '/api/dashboard'])
+def test_bad_cursor_is_rejected(client, podcasts, url, cursor):
+    response = client.get(url, headers=podcasts, query_string={'limit': 2, 'cursor': cursor})
+    assert response.status_code == 400
+
+
+def test_trending_pages_have_no_duplicates_or_gaps(client, podcasts):
+    Podcast.query.update({Podcast.trending_score: 1.0}, synchronize_session=False)
+    Podcast.query.filter_by(podcast_title='Podcast 3').update(
+        {Podcast.trending_score: 2.0}, synchronize_session=False)
+    Podcast.query.session.commit()
+    pages = read_all_pages(client, '/api/listen', podcasts, 2, sort='trending')
+    assert [title for page in pages for title in page] == [
+        'Podcast 3', 'Podcast 6', 'Podcast 5', 'Podcast 4', 'Podcast 2', 'Podcast 1', 'Podcast 0']
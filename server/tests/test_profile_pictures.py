@@ -0,0 +1,54 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+import io
+import pytest
+from PIL import Image
+from models import User
+from storage import storage
+
+
+def png_image(width, height):
+    image_file = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(image_file, 'PNG')
+    image_file.seek(0)
+    return image_file
+
+
+@pytest.fixture
+def alice(client, register):
+    headers = register('alice')
+    response = client.post('/api/update-profile-picture', headers=headers, content_type='multipart/form-data',
+                           data={'file': (png_image(400, 300), 'picture.png')})
+    assert response.get_json()['statusResponse'] == 'Image uploaded successfully!'
+    return headers
+
+
+def test_saved_sizes_are_recorded(alice):
+    user = User.query.filter_by(username='alice').first()
+    assert user.profile_image_sizes.split() == ['128.jpg', '128.webp', '250.webp', '40.jpg', '40.webp']
+
+
+@pytest.mark.parametrize('query_string, mimetype, width', [
+    ({'size': 40, 'format': 'webp'}, 'image/webp', 40),
+    ({'size': 100, 'format': 'jpg'}, 'image/jpeg', 128),
+    ({'size': 250, 'format': 'jpg'}, 'image/jpeg', 250),
+    ({'format': 'webp'}, 'image/webp', 250),
+])
+def test_sizes_are_sent_without_checking_storage(client, alice, monkeypatch, query_string, mimetype, width):
+    def exists(key):
+        raise AssertionError(f"The storage was checked for '{key}'.")
+    monkeypatch.setattr(storage, 'exists', exists)
+    response = client.get('/api/profile-picture/alice', query_string=query_string)
+    assert response.status_code == 200
+    assert response.mimetype == mimetype
+    assert Image.open(io.BytesIO(response.data)).size[0] == width
+
+
+def test_picture_without_recorded_sizes_sends_its_main_file(client, alice, database):
+    User.query.filter_by(username='alice').update({User.profile_image_sizes: None})
+    database.session.commit()
+    response = client.get('/api/profile-picture/alice', query_string={'size': 40, 'format': 'webp'})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert Image.open(io.BytesIO(response.data)).size == (250, 188)
@@ -0,0 +1,62 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+import math
+import pytest
+from models import Podcast
+from trending import log_add_exp, log_sub_exp, recompute_trending_scores
+
+
+@pytest.mark.parametrize('score, value', [
+    (0.0, 0.0), (1.0, -3.0), (-3.0, 1.0), (500.0, 499.5), (10000.0, 9990.0), (10.0, -800.0),
+])
+def test_removing_an_event_undoes_adding_it(score, value):
+    total = log_add_exp(score, value)
+    assert log_sub_exp(total, value, -math.inf) == pytest.approx(score, abs=1e-9)
+
+
+def test_adding_does_not_overflow():
+    '''The sums themselves would overflow a float after a few months of half lives.'''
+    assert log_add_exp(5000.0, 5000.0) == pytest.approx(5000.0 + math.log(2))
+    assert log_add_exp(5000.0, -5000.0) == 5000.0
+
+
+@pytest.mark.parametrize('score, value, floor', [
+    (1000.0, 1000.0, 990.0),
+    (1000.0, 1000.0 + 1e-9, 990.0),
+    (1000.0, 999.9999999, 990.0),
+    (0.0, -1e-17, -10.0),
+])
+def test_removing_a_dominating_event_leaves_only_the_upload(score, value, floor):
+    '''
+    When the event being removed is (up to rounding) the whole score, what is left is too
+    small to be represented, so only the upload itself is left. In the last case exp()
+    rounds to exactly 1, which used to raise a math domain error.
+    '''
+    assert log_sub_exp(score, value, floor) == floor
+
+
+def test_removal_never_goes_below_the_upload():
+    assert log_sub_exp(10.0, 9.0, 12.0) == 12.0
+
+
+def test_recomputed_scores_match_the_incremental_scores(client, database, register, upload):
+    alice = register('alice')
+    bob = register('bob')
+    first = upload(alice, 'First')
+    second = upload(alice, 'Second')
+    for headers in (alice, bob):
+        client.post('/api/like/podcast', headers=headers, json={'podcastId': first})
+        client.post(f'/api/comment/{first}', headers=headers, json={'comment': 'Great episode'})
+        client.post(f'/api/comment/{second}', headers=headers, json={'comment': 'Nice'})
+    client.post('/api/unlike/podcast', headers=bob, json={'podcastId': first})
+    comment_id = client.get(f'/api/comments/{second}', headers=bob).get_json()['comments'][0]['commentId']
+    client.post(f'/api/delete-comment/{comment_id}', headers=alice)
+    client.post(f'/api/delete-comment/{comment_id}', headers=bob)
+
+    incremental = dict(database.session.query(Podcast.public_id, Podcast.trending_score))
+    recompute_trending_scores()
+    database.session.commit()
+    recomputed = dict(database.session.query(Podcast.public_id, Podcast.trending_score))
+    assert recomputed == pytest.approx(incremental, abs=1e-9)
+    assert incremental[first] > incremental[second]
@@ -0,0 +1,98 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import app, db
+from models import User, Podcast, Follow, TimelineEntry
+from sqlalchemy import or_, and_, text
+
+
+'''
+The home feed of a user shows the podcasts of everyone that they follow, newest first.
+
+Most podcasts are copied into the feeds of the owner's followers when they are uploaded
+(fan-out-on-write), so reading a feed is a single range scan of the user's rows in the
+TimelineEntry table. For users with a very large number of followers, copying every
+podcast into every follower's feed would make each upload very slow, so once a user has
+more than 'FEED_FANOUT_LIMIT' followers, their podcasts are read straight from the
+Podcast table when a feed is loaded instead (fan-out-on-read). A follower only follows a
+handful of these users, so this is one extra range scan per such user.
+
+The functions in this file only add their changes to the session. The caller commits.
+'''
+
+
+def fan_out_podcast(podcast):
+    '''
+    The code below will copy a new podcast into the feed of every follower of its owner
+    with a single INSERT ... SELECT statement. If the owner has just gone over
+    'FEED_FANOUT_LIMIT' followers, they are switched to fan-out-on-read first.
+    '''
+    owner = podcast.owner
+    if not owner.fan_out_on_read and owner.followers_count > app.config['FEED_FANOUT_LIMIT']:
+        owner.fan_out_on_read = True
+    if owner.fan_out_on_read:
+        return
+    db.session.execute(text('''INSERT INTO timeline_entry (user_id, podcast_id, created_at)
+                               SELECT f.follower_id, p.id, p.created_at FROM follow f
+                               JOIN podcast p ON p.id = :podcast_id WHERE f.followee_id = :owner_id'''),
+                       {'podcast_id': podcast.id, 'owner_id': owner.id})
+
+
+def add_followee_to_timeline(follower, followee):
+    '''
+    When a user follows someone, the podcasts that they have already uploaded are copied
+    into the new follower's feed, unless they are read on demand anyway.
+    '''
+    if followee.fan_out_on_read:
+        return
+    db.session.execute(text('''INSERT INTO timeline_entry (user_id, podcast_id, created_at)
+                               SELECT :follower_id, id, created_at FROM podcast
+                               WHERE owner_id = :followee_id'''),
+                       {'follower_id': follower.id, 'followee_id': followee.id})
+
+
+def remove_followee_from_timeline(follower, followee):
+    '''When a user unfollows someone, that user's podcasts are removed from their feed.'''
+    TimelineEntry.query.filter(TimelineEntry.user_id == follower.id, TimelineEntry.podcast_id.in_(
+        db.session.query(Podcast.id).filter(Podcast.owner_id == followee.id))).delete(synchronize_session=False)
+
+
+def remove_podcasts_from_timelines(podcast_ids):
+    '''
+    The entries of deleted podcasts are removed with one bulk DELETE instead of being
+    loaded and deleted one at a time through a relationship.
+    '''
+    TimelineEntry.query.filter(TimelineEntry.podcast_id.in_(
+        podcast_ids)).delete(synchronize_session=False)
+
+
+def read_timeline(user, limit, cursor=None):
+    '''
+    The code below will return the (created_at, podcast id) pairs of one page of a user's
+    feed, newest first, and whether there are more pages after it. 'cursor' is the
+    (created_at, podcast id) of the last podcast of the previous page.
+
+    The user's own TimelineEntry rows and the podcasts of each followed user that is
+    fanned out on read are each read in order from an index, up to one more than a page.
+    The two lists are then merged, so every part of the feed is a bounded range scan.
+    '''
+    def after_cursor(created_at_column, id_column):
+        if cursor == None:
+            return True
+        created_at, podcast_id = cursor
+        return or_(created_at_column < created_at, and_(created_at_column == created_at, id_column < podcast_id))
+
+    fanned_out = db.session.query(TimelineEntry.created_at, TimelineEntry.podcast_id).filter(
+        TimelineEntry.user_id == user.id, after_cursor(TimelineEntry.created_at, TimelineEntry.podcast_id)).order_by(
+        TimelineEntry.created_at.desc(), TimelineEntry.podcast_id.desc()).limit(limit + 1).all()
+
+    entries = set(fanned_out)
+    fan_out_on_read_ids = [user_id for (user_id,) in db.session.query(Follow.followee_id).join(
+        User, User.id == Follow.followee_id).filter(Follow.follower_id == user.id, User.fan_out_on_read == True)]
+    for owner_id in fan_out_on_read_ids:
+        entries.update(db.session.query(Podcast.created_at, Podcast.id).filter(
+            Podcast.owner_id == owner_id, after_cursor(Podcast.created_at, Podcast.id)).order_by(
+            Podcast.created_at.desc(), Podcast.id.desc()).limit(limit + 1).all())
+
+    entries = sorted(entries, reverse=True)
+    return entries[:limit], len(entries) > limit
@@ -0,0 +1,162 @@
+# Code written by Arpan Neupane.
+# Copyright (c) Arpan Neupane 2022-23. All rights reserved.
+
+from configs import app, db
+from models import Podcast, Like, Comment
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+import datetime
+import math
+import sqlite3
+
+
+'''
+The trending score of a podcast is the sum of the weights of its likes and comments, where
+each like or comment loses half of its weight every 'TRENDING_HALF_LIFE' hours. Uploading the
+podcast counts as one event with a weight of 1, so new podcasts without any likes are still
+ordered from newest to oldest.
+
+Since every weight decays at the same rate, the scores of all podcasts shrink by the same
+factor over time and their order only changes when a new like or comment is added. So
+instead of the decayed score, 'trending_score' stores
+
+    log(sum of weight * 2 ** (hours between TRENDING_EPOCH and the event / TRENDING_HALF_LIFE))
+
+which never has to be recomputed as time passes. Adding a like or comment adds one term to
+the sum (see 'log_add_exp()'), so the score is updated in place by the same transaction that
+adds the like or comment, and the podcasts can be read in order straight from the index on
+'trending_score'. The scores are stored as logarithms since the sum itself would grow too
+large for a float within a few months.
+'''
+TRENDING_EPOCH = datetime.datetime(2022, 1, 1)
+
+
+def trending_time(when):
+    '''The exponent of the weight of an event that happened at 'when'.'''
+    half_lives = (when - TRENDING_EPOCH).total_seconds() / \
+        (app.config['TRENDING_HALF_LIFE'] * 3600)
+    return half_lives * math.log(2)
+
+
+def initial_trending_score(created_at):
+    return trending_time(created_at)
+
+
+def log_add_exp(score, value):
+    '''Returns log(exp(score) + exp(value)) without overflowing.'''
+    high, low = max(score, value), min(score, value)
+    return high + math.log1p(math.exp(low - high))
+
+
+def log_sub_exp(score, value, floor):
+    '''
+    Returns log(exp(score) - exp(value)), but never less than 'floor', which is the score
+    of the upload itself. Rounding errors can make 'value' a little larger than what is
+    left of the score, or so close to it that exp() rounds to 1, in which case only the
+    upload is left.
+    '''
+    if value >= score:
+        return floor
+    remaining = -math.exp(value - score)
+    if remaining <= -1:
+        return floor
+    return max(score + math.log1p(remaining), floor)
+
+
+@event.listens_for(Engine, 'connect')
+def register_trending_functions(dbapi_connection, connection_record):
+    '''
+    The two functions above are added to every SQLite connection so that a score can be
+    updated with a single UPDATE statement. Two likes that happen at the same time then
+    cannot overwrite each other's changes to the score.
+    '''
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('log_add_exp', 2, log_add_exp)
+        dbapi_connection.create_function('log_sub_exp', 3, log_sub_exp)
+
+
+'''
+PostgreSQL cannot call Python functions, so the same two functions are created in the
+database as SQL functions right after the Podcast table is created. PostgreSQL raises an
+error instead of returning 0 when EXP() underflows, so a term that is too small to change
+the score is skipped.
+'''
+POSTGRES_TRENDING_FUNCTIONS = [
+    '''CREATE OR REPLACE FUNCTION log_add_exp(score double precision, value double precision)
+       RETURNS double precision AS $$
+       SELECT CASE WHEN LEAST($1, $2) - GREATEST($1, $2) < -700 THEN GREATEST($1, $2)
+              ELSE GREATEST($1, $2) + LN(1 + EXP(LEAST($1, $2) - GREATEST($1, $2))) END
+       $$ LANGUAGE SQL IMMUTABLE''',
+    '''CREATE OR REPLACE FUNCTION log_sub_exp(score double precision, value double precision, floor double precision)
+       RETURNS double precision AS $$
+       SELECT CASE WHEN $2 - $1 < -700 THEN GREATEST($1, $3)
+              WHEN $2 >= $1 OR EXP($2 - $1) >= 1 THEN $3
+              ELSE GREATEST($1 + LN(1 - EXP($2 - $1)), $3) END
+       $$ LANGUAGE SQL IMMUTABLE''',
+]
+
+
+@event.listens_for(Podcast.__table__, 'after_create')
+def create_trending_functions(target, connection, **kw):
+    if connection.dialect.name == 'postgresql':
+        for statement in POSTGRES_TRENDING_FUNCTIONS:
+            connection.execute(text(statement))
+
+
+def event_value(podcast, weight, event_time):
+    '''
+    Likes and comments that were added before they had a creation time are counted as if
+    they had been added when the podcast was uploaded.
+    '''
+    return math.log(weight) + trending_time(max(event_time, podcast.created_at))
+
+
+def add_trending_event(podcast, weight, event_time):
+    '''
+    The code below will add a like or comment to the trending score of a podcast. Like the
+    counters, the caller commits the change.
+    '''
+    if weight > 0:
+        db.session.execute(text('UPDATE podcast SET trending_score = log_add_exp(trending_score, :value) WHERE id = :podcast_id'),
+                           {'value': event_value(podcast, weight, event_time), 'podcast_id': podcast.id})
+
+
+def remove_trending_event(podcast, weight, event_time):
+    '''
+    The code below will take a like or comment that is being removed back out of the
+    trending score of a podcast. 'event_time' is when the like or comment was added, so
+    exactly the amount that was added for it is taken away.
+    '''
+    if weight > 0:
+        db.session.execute(text('UPDATE podcast SET trending_score = log_sub_exp(trending_score, :value, :floor) WHERE id = :podcast_id'),
+                           {'value': event_value(podcast, weight, event_time), 'floor': initial_trending_score(podcast.created_at), 'podcast_id': podcast.id})
+
+
+def recompute_trending_scores(podcast_ids=None):
+    '''
+    The code below will recompute the trending scores of podcasts from their likes and
+    comments. This is only needed when likes or comments are removed in bulk (for example
+    when an account is deleted), when 'TRENDING_HALF_LIFE' or the weights are changed, and
+    when the column is first added. If a list of podcast ids is passed in, only those
+    podcasts are recomputed. The caller commits the changes.
+    '''
+    podcasts = Podcast.query.with_entities(Podcast.id, Podcast.created_at)
+    if podcast_ids is not None:
+        podcasts = podcasts.filter(Podcast.id.in_(podcast_ids))
+    scores = {podcast_id: initial_trending_score(created_at)
+              for podcast_id, created_at in podcasts}
+    events = [(Like, app.config['TRENDING_LIKE_WEIGHT']),
+              (Comment, app.config['TRENDING_COMMENT_WEIGHT'])]
+    for model, weight in events:
+        if weight <= 0:
+            continue
+        rows = db.session.query(model.podcast_id, model.created_at, Podcast.created_at).join(
+            Podcast, Podcast.id == model.podcast_id)
+        if podcast_ids is not None:
+            rows = rows.filter(model.podcast_id.in_(podcast_ids))
+        for podcast_id, event_time, created_at in rows:
+            scores[podcast_id] = log_add_exp(scores[podcast_id], math.log(
+                weight) + trending_time(max(event_time, created_at)))
+    if scores:
+        db.session.execute(text('UPDATE podcast SET trending_score = :score WHERE id = :podcast_id'),
+                           [{'score': score, 'podcast_id': podcast_id} for podcast_id, score in scores.items()])
@@ -4,7 +4,13 @@
 from configs import *
 from models import *
 from routes import *
+from commands import *
+from migrations import upgrade_database
+import os
 
 if __name__ == "__main__":
-    db.create_all()
+    upgrade_database()
+    # The development server runs jobs in its own threads instead of needing 'flask run-jobs'.
+    if "JOB_THREADS" not in os.environ:
+        app.config['JOB_THREADS'] = 2
     app.run(debug=True, port='8080')